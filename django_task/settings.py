@@ -19,6 +19,12 @@ AUTH_PROFILE_MODULE = 'task.Profile'
 # The location to store the taskwarrior database(s)
 TASKDATA_ROOT = os.path.join(DIRNAME, 'taskdb')
 
+# How much of each user's undo log `./manage.py archive_undo` keeps in the
+# database (the rest is archived under TASKDATA_ROOT). None keeps it all;
+# users can override these in their profile.
+TASK_UNDO_KEEP_DAYS = None
+TASK_UNDO_KEEP_ENTRIES = None
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3', # Add 'postgresql_psycopg2',
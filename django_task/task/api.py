@@ -0,0 +1,133 @@
+""" A read API streaming tasks as JSON lines.
+
+    Only the columns and relations of the requested fields are loaded:
+    the rows of a page are read `CHUNK_SIZE` at a time with `values()`,
+    and the annotations and dependencies of a chunk with one query each,
+    when they're asked for. Pages are keyed on the task id, so each one
+    costs the same however far into the list it is.
+"""
+import json
+
+from task.models import Task, PRIORITY_MAP, CHUNK_SIZE, datetime2ts
+from task.util import chunked, group_by_task, split_tags
+
+# the lookup each field is read from
+FIELDS = {
+    'id': 'pk',
+    'uuid': 'uuid',
+    'description': 'description',
+    'status': 'status',
+    'entry': 'entry',
+    'due': 'due',
+    'end': 'end',
+    'priority': 'priority__weight',
+    'project': 'project__name',
+    'tags': 'tags_summary',
+    'annotation_count': 'annotation_count',
+}
+
+# fields loaded with a query per chunk rather than from the task row
+RELATIONS = ('annotations', 'depends')
+
+DEFAULT_FIELDS = ('id', 'uuid', 'description', 'status', 'entry', 'due',
+                  'end', 'priority', 'project', 'tags')
+
+PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+
+def _timestamp(value):
+    return value and datetime2ts(value)
+
+
+# turn the value read from the database into the one that's served
+CONVERTERS = {
+    'entry': _timestamp,
+    'due': _timestamp,
+    'end': _timestamp,
+    'priority': lambda weight: PRIORITY_MAP.get(weight) or None,
+    'tags': split_tags,
+}
+
+
+def parse_fields(value):
+    """ Return the field names in the comma-separated `value`, or the
+        default ones if it's empty. Raises `ValueError` for fields that
+        don't exist.
+    """
+    if not value:
+        return DEFAULT_FIELDS
+
+    fields = []
+    for name in value.split(','):
+        if name not in FIELDS and name not in RELATIONS:
+            raise ValueError('Unknown field: %s' % name)
+        if name not in fields:
+            fields.append(name)
+
+    return tuple(fields)
+
+
+def page(tasks, after=None, limit=PAGE_SIZE):
+    """ Return the ids of the first `limit` tasks in the `tasks`
+        queryset with an id greater than `after`, and the id to pass as
+        `after` for the next page (or None if this is the last one).
+    """
+    tasks = tasks.order_by('pk')
+    if after is not None:
+        tasks = tasks.filter(pk__gt=after)
+
+    ids = list(tasks.values_list('pk', flat=True)[:limit + 1])
+    if len(ids) > limit:
+        del ids[limit:]
+        return ids, ids[-1]
+
+    return ids, None
+
+
+def iterdicts(ids, fields=DEFAULT_FIELDS):
+    """ Yield a dict with `fields` for each task in `ids`, in order.
+    """
+    lookups = [FIELDS[name] for name in fields if name in FIELDS]
+    for chunk in chunked(ids, CHUNK_SIZE):
+        rows = (Task.objects.filter(pk__in=chunk)
+                            .order_by('pk')
+                            .values('pk', *lookups))
+
+        annotations = {}
+        if 'annotations' in fields:
+            annotations = group_by_task(Task.annotations.through.objects
+                        .filter(task__in=chunk)
+                        .order_by('annotation__time', 'annotation')
+                        .values_list('task', 'annotation__time',
+                                     'annotation__data'))
+        depends = {}
+        if 'depends' in fields:
+            depends = group_by_task(Task.dependencies.through.objects
+                        .filter(from_task__in=chunk)
+                        .order_by('to_task')
+                        .values_list('from_task', 'to_task__uuid'))
+
+        for row in rows:
+            task = {}
+            for name in fields:
+                if name == 'annotations':
+                    value = [{'entry': datetime2ts(when), 'description': data}
+                             for (when, data)
+                             in annotations.get(row['pk'], ())]
+                elif name == 'depends':
+                    value = [uuid for (uuid,) in depends.get(row['pk'], ())]
+                else:
+                    value = row[FIELDS[name]]
+                    if name in CONVERTERS:
+                        value = CONVERTERS[name](value)
+                task[name] = value
+            yield task
+
+
+def iterserialize(ids, fields=DEFAULT_FIELDS):
+    """ Yield the tasks in `ids` as JSON lines, a chunk at a time.
+    """
+    tasks = iterdicts(ids, fields)
+    for chunk in chunked(tasks, CHUNK_SIZE):
+        yield ''.join(json.dumps(task) + '\n' for task in chunk)
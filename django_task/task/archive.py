@@ -0,0 +1,139 @@
+""" Retention of the undo log.
+
+    Each user keeps the entries of their undo log that are newer than
+    `undo_keep_days` days, or the last `undo_keep_entries` of them (the
+    fields of their profile, falling back to the `TASK_UNDO_KEEP_DAYS`
+    and `TASK_UNDO_KEEP_ENTRIES` settings), in the `Undo` table. The
+    older ones are moved, oldest first and a batch at a time, into gzip
+    files under `TASKDATA_ROOT` that are indexed by `UndoArchive` rows,
+    so they can still be streamed in order.
+"""
+import datetime
+import gzip
+import os
+
+from django.conf import settings
+from django.db import transaction
+
+from task.models import (Undo, UndoArchive, Profile, CHUNK_SIZE,
+                         batch_touches, datetime2ts, undo_checksum)
+from task.util import chunked, decompress_chunks
+
+KEEP_DAYS = getattr(settings, 'TASK_UNDO_KEEP_DAYS', None)
+KEEP_ENTRIES = getattr(settings, 'TASK_UNDO_KEEP_ENTRIES', None)
+
+# the number of entries moved into each archive file
+BATCH_SIZE = 5000
+
+# bytes read from an archive file at a time when streaming it
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def archive_root():
+    return os.path.join(settings.TASKDATA_ROOT, 'undo-archive')
+
+
+def policy(user):
+    """ Return the number of days and of entries of `user`'s undo log
+        that are kept in the `Undo` table, either of which can be None
+        for no limit.
+    """
+    days, entries = KEEP_DAYS, KEEP_ENTRIES
+    try:
+        profile = user.get_profile()
+    except Profile.DoesNotExist:
+        return days, entries
+
+    if profile.undo_keep_days is not None:
+        days = profile.undo_keep_days
+    if profile.undo_keep_entries is not None:
+        entries = profile.undo_keep_entries
+    return days, entries
+
+
+def expired(user, now=None):
+    """ Return the number of `user`'s oldest undo entries that are
+        beyond their policy.
+    """
+    days, entries = policy(user)
+    undos = Undo.objects.filter(user=user)
+    count = 0
+    if days is not None:
+        cutoff = (now or datetime.datetime.now()) - datetime.timedelta(days)
+        count = undos.filter(time__lt=cutoff).count()
+    if entries is not None:
+        count = max(count, undos.count() - entries)
+    return count
+
+
+def _write(user, undos):
+    """ Write `undos` to a new archive file of `user`, returning its
+        path relative to the archive root.
+    """
+    path = os.path.join(str(user.pk), '%s-%s.gz' % (undos[0].pk,
+                                                     undos[-1].pk))
+    filename = os.path.join(archive_root(), path)
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+
+    # written under a temporary name so a half written file is never
+    # mistaken for an archive
+    f = gzip.open(filename + '.tmp', 'wb')
+    try:
+        for chunk in chunked(undos, CHUNK_SIZE):
+            f.write(u''.join(undo.encode() for undo in chunk).encode('utf-8'))
+    finally:
+        f.close()
+    os.rename(filename + '.tmp', filename)
+    return path
+
+
+def archive(user, count, batch_size=BATCH_SIZE):
+    """ Move the `count` oldest undo entries of `user` into archive
+        files of `batch_size` entries, each in its own transaction.
+        Returns the number of entries that were archived.
+    """
+    archived = 0
+    while archived < count:
+        with transaction.commit_on_success():
+            undos = list(Undo.objects.filter(user=user)
+                                     .order_by('time', 'id')
+                                     [:min(batch_size, count - archived)])
+            if not undos:
+                break
+
+            path = _write(user, undos)
+            try:
+                last = undos[-1]
+                UndoArchive.objects.create(
+                        user=user, path=path, count=len(undos),
+                        first_time=undos[0].time, last_time=last.time,
+                        last_checksum=last.checksum or undo_checksum(
+                            datetime2ts(last.time), last.old, last.new))
+                with batch_touches():
+                    for chunk in chunked([undo.pk for undo in undos],
+                                         CHUNK_SIZE):
+                        Undo.objects.filter(pk__in=chunk).delete()
+            except Exception:
+                os.remove(os.path.join(archive_root(), path))
+                raise
+
+        archived += len(undos)
+
+    return archived
+
+
+def iterarchive(user, since=None):
+    """ Yield the archived undo entries of `user` in the format
+        expected by taskwarrior, a chunk at a time. With `since`, only
+        the files with entries logged from then on are read.
+    """
+    archives = UndoArchive.objects.filter(user=user)
+    if since is not None:
+        archives = archives.filter(last_time__gte=since)
+
+    for undo_archive in archives:
+        with open(os.path.join(archive_root(), undo_archive.path), 'rb') as f:
+            chunks = iter(lambda: f.read(READ_CHUNK_SIZE), '')
+            for data in decompress_chunks(chunks):
+                yield data
@@ -0,0 +1,65 @@
+""" Caching of the serialized taskdb files.
+
+    Each file is cached per user together with the etag of the
+    `TaskDbVersion` it was generated for, and the entry is deleted
+    whenever that version is bumped. Comparing the etag as well means a
+    file that was still being generated when the data changed is never
+    served afterwards.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+
+TIMEOUT = getattr(settings, 'TASKDB_CACHE_TIMEOUT', 60 * 60 * 24)
+
+STATS_KEY = 'taskdb:stats:%s'
+
+
+def cache_key(user_id, filename):
+    return 'taskdb:%s:%s' % (user_id, filename)
+
+
+def _incr(counter):
+    key = STATS_KEY % counter
+    cache.add(key, 0, TIMEOUT)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # expired between the `add` and the `incr`
+        cache.set(key, 1, TIMEOUT)
+
+
+def get(user_id, filename, etag):
+    """ Return the cached file, or None if it isn't cached for `etag`.
+    """
+    cached = cache.get(cache_key(user_id, filename))
+    if cached is not None and cached[0] == etag:
+        _incr('hits')
+        return cached[1]
+
+    _incr('misses')
+    return None
+
+
+def caching(chunks, user_id, filename, etag):
+    """ Yield `chunks`, caching the whole file for `etag` once all of
+        them have been generated.
+    """
+    data = []
+    for chunk in chunks:
+        chunk = smart_str(chunk)
+        data.append(chunk)
+        yield chunk
+
+    cache.set(cache_key(user_id, filename), (etag, ''.join(data)), TIMEOUT)
+
+
+def invalidate(user_id, filename):
+    cache.delete(cache_key(user_id, filename))
+
+
+def stats():
+    """ Return the number of cache `hits` and `misses` so far.
+    """
+    return {'hits': cache.get(STATS_KEY % 'hits', 0),
+            'misses': cache.get(STATS_KEY % 'misses', 0)}
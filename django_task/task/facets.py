@@ -0,0 +1,88 @@
+""" Tag and project counts for the sidebars of the task lists.
+
+    The counts for a status are worked out with a single aggregated
+    query and cached under the version of the taskdb file tasks with
+    that status are stored in. Every change to those tasks bumps the
+    version, so stale counts are never read.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Count, Sum
+
+from task.models import Task, TaskDbVersion, taskdb_filename
+
+TIMEOUT = getattr(settings, 'TASK_FACETS_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+def _version(status, user):
+    """ Return a string that changes whenever the tasks with `status`
+        that belong to `user` (or to anyone, if `user` is None) do.
+    """
+    filename = taskdb_filename(status)
+    if user is not None:
+        return TaskDbVersion.get_for(user, filename).etag
+
+    versions = TaskDbVersion.objects.filter(filename=filename).aggregate(
+            count=Count('pk'), total=Sum('version'))
+    return '%(count)s-%(total)s' % versions
+
+
+def _query(status, user):
+    """ Return the SQL and parameters of the query for `(kind, name,
+        count)` rows for the tags and projects of the tasks with `status`.
+    """
+    tasks = {'task__status': status}
+    if user is not None:
+        tasks['task__user'] = user
+    tags = (Task.tags.through.objects.filter(**tasks)
+                                     .order_by()
+                                     .values_list('tag__tag')
+                                     .annotate(count=Count('task')))
+
+    tasks = {'status': status, 'project__isnull': False}
+    if user is not None:
+        tasks['user'] = user
+    projects = (Task.objects.filter(**tasks)
+                            .order_by()
+                            .values_list('project__name')
+                            .annotate(count=Count('pk')))
+
+    tags_sql, tags_params = tags.query.sql_with_params()
+    projects_sql, projects_params = projects.query.sql_with_params()
+    return ("SELECT 'tag', tags.* FROM (%s) tags "
+            "UNION ALL "
+            "SELECT 'project', projects.* FROM (%s) projects"
+            % (tags_sql, projects_sql),
+            tuple(tags_params) + tuple(projects_params))
+
+
+def _count(status, user):
+    cursor = connection.cursor()
+    cursor.execute(*_query(status, user))
+    return cursor.fetchall()
+
+
+def facets(status, user=None):
+    """ Return the tags and projects of the tasks with `status` as two
+        lists of dicts with their `tag` or `name` and the `count` of
+        tasks, sorted by name. Only `user`'s tasks are counted, unless
+        `user` is None.
+    """
+    key = 'taskfacets:%s:%s:%s' % (user and user.pk, status,
+                                   _version(status, user))
+    result = cache.get(key)
+    if result is None:
+        tags = []
+        projects = []
+        for kind, name, count in _count(status, user):
+            if kind == 'tag':
+                tags.append({'tag': name, 'count': count})
+            else:
+                projects.append({'name': name, 'count': count})
+
+        result = (sorted(tags, key=lambda t: t['tag']),
+                  sorted(projects, key=lambda p: p['name']))
+        cache.set(key, result, TIMEOUT)
+
+    return result
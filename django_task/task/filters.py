@@ -0,0 +1,340 @@
+""" Taskwarrior filter expressions.
+
+    A filter like `+home -work due.before:eom pri:H` is parsed into a
+    single `Q`, so it runs in the database like any other lookup. It's
+    made of terms:
+
+        +tag, -tag              tasks with or without the tag
+        name:value              an attribute, name[.modifier]:value
+        word, "some words"      tasks whose description contains them
+
+    that are joined with `and` (or nothing at all), `or`, and grouped
+    with parentheses; `and` binds tighter than `or`. Attribute names can
+    be abbreviated, as long as they're unambiguous. Dates are unix
+    timestamps, ISO dates (`2012-09-08`, `2012-09-08T14:30`) or one of
+    `now`, `today`, `yesterday`, `tomorrow` and the `sod`/`eod`,
+    `sow`/`eow`, `som`/`eom` and `soy`/`eoy` boundaries of the current
+    day, week (starting on Sunday, as in taskwarrior), month and year.
+"""
+import datetime
+import re
+
+from django.db.models import Q
+
+from task.models import Task, PRIORITY_MAP_R, ts2datetime
+
+# the lookup and kind of value of each attribute
+ATTRIBUTES = {
+    'description': ('description', 'text'),
+    'due': ('due', 'date'),
+    'end': ('end', 'date'),
+    'entry': ('entry', 'date'),
+    'priority': ('priority__weight', 'priority'),
+    'project': ('project__name', 'text'),
+    'status': ('status', 'text'),
+    'tags': ('tags', 'tags'),
+    'uuid': ('uuid', 'text'),
+}
+
+# the shortest abbreviation of an attribute name that's recognized
+ABBREVIATION_MINIMUM = 2
+
+# modifier aliases
+MODIFIERS = {
+    '': '',
+    'is': 'is', 'equals': 'is',
+    'isnt': 'isnt', 'not': 'isnt',
+    'has': 'has', 'contains': 'has',
+    'hasnt': 'hasnt',
+    'startswith': 'startswith', 'left': 'startswith',
+    'endswith': 'endswith', 'right': 'endswith',
+    'before': 'before', 'under': 'before', 'below': 'before',
+    'after': 'after', 'over': 'after', 'above': 'after',
+    'none': 'none',
+    'any': 'any',
+}
+
+OPERATORS = ('and', 'or')
+
+TOKEN_RE = re.compile(r'''[()]|(?:[^\s()"']|"[^"]*"|'[^']*')+''')
+ATTRIBUTE_RE = re.compile(r'^([a-z]+)(?:\.([a-z]+))?:(.*)$', re.DOTALL)
+
+
+class FilterError(ValueError):
+    """ Raised for a filter that can't be parsed.
+    """
+    pass
+
+
+def tokenize(text):
+    """ Split `text` into the terms, operators and parentheses of a
+        filter. Quoted strings are kept together.
+    """
+    tokens = []
+    pos = 0
+    for match in TOKEN_RE.finditer(text):
+        if text[pos:match.start()].strip():
+            # only an unclosed quote isn't part of a token
+            raise FilterError('Unbalanced quotes: %s' % text[pos:])
+        tokens.append(match.group())
+        pos = match.end()
+
+    if text[pos:].strip():
+        raise FilterError('Unbalanced quotes: %s' % text[pos:])
+    return tokens
+
+
+def unquote(value):
+    if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    return value
+
+
+def attribute(name):
+    """ Return the attribute `name` is an abbreviation of, or None if it
+        isn't one. Raises `FilterError` if it's ambiguous.
+    """
+    if name in ATTRIBUTES:
+        return name
+    if len(name) < ABBREVIATION_MINIMUM:
+        return None
+
+    matches = sorted(attr for attr in ATTRIBUTES if attr.startswith(name))
+    if len(matches) > 1:
+        raise FilterError('Ambiguous attribute %s: %s'
+                          % (name, ', '.join(matches)))
+    return matches and matches[0] or None
+
+
+def _start_of_month(day, months=0):
+    month = day.month - 1 + months
+    return datetime.datetime(day.year + month // 12, month % 12 + 1, 1)
+
+
+def parse_date(value, now=None):
+    """ Return the `datetime` `value` stands for, raising `FilterError`
+        if it isn't a date.
+    """
+    now = now or datetime.datetime.now()
+    today = datetime.datetime(now.year, now.month, now.day)
+    one_day = datetime.timedelta(days=1)
+    # taskwarrior weeks start on Sunday
+    sow = today - datetime.timedelta(days=(today.weekday() + 1) % 7)
+    named = {
+        'now': now,
+        'today': today,
+        'sod': today,
+        'eod': today + one_day,
+        'yesterday': today - one_day,
+        'tomorrow': today + one_day,
+        'sow': sow,
+        'eow': sow + 7 * one_day,
+        'som': _start_of_month(today),
+        'eom': _start_of_month(today, 1),
+        'soy': datetime.datetime(today.year, 1, 1),
+        'eoy': datetime.datetime(today.year + 1, 1, 1),
+    }
+    if value.lower() in named:
+        return named[value.lower()]
+    if value.isdigit():
+        try:
+            return ts2datetime(value)
+        except (ValueError, OverflowError):
+            raise FilterError('Date out of range: %s' % value)
+
+    for format in ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            pass
+
+    raise FilterError('Not a date: %s' % value)
+
+
+def has_tag(tag):
+    """ Return a `Q` matching the tasks tagged with `tag`, through a
+        subquery rather than a join, so no task is matched twice.
+    """
+    tagged = Task.tags.through.objects.filter(tag__tag=tag)
+    return Q(pk__in=tagged.values('task'))
+
+
+def _tags_q(modifier, value):
+    tagged = Q(pk__in=Task.tags.through.objects.values('task'))
+    if modifier == 'none' or (modifier in ('', 'is') and not value):
+        return ~tagged
+    if modifier == 'any':
+        return tagged
+    if modifier in ('', 'is', 'has'):
+        return has_tag(value)
+    if modifier in ('isnt', 'hasnt'):
+        return ~has_tag(value)
+    raise FilterError('Unsupported modifier for tags: %s' % modifier)
+
+
+def _date_q(lookup, modifier, value):
+    if modifier == 'none' or (modifier in ('', 'is') and not value):
+        return Q(**{lookup + '__isnull': True})
+    if modifier == 'any':
+        return Q(**{lookup + '__isnull': False})
+
+    when = parse_date(value)
+    if modifier == 'before':
+        return Q(**{lookup + '__lt': when})
+    if modifier == 'after':
+        return Q(**{lookup + '__gt': when})
+
+    # dates are equal when they're on the same day
+    day = datetime.datetime(when.year, when.month, when.day)
+    same_day = Q(**{lookup + '__gte': day,
+                    lookup + '__lt': day + datetime.timedelta(days=1)})
+    if modifier in ('', 'is'):
+        return same_day
+    if modifier == 'isnt':
+        return ~same_day
+    raise FilterError('Unsupported modifier for dates: %s' % modifier)
+
+
+def _priority_q(lookup, modifier, value):
+    try:
+        weight = PRIORITY_MAP_R[value.upper()]
+    except KeyError:
+        raise FilterError('Not a priority: %s' % value)
+
+    unset = Q(**{lookup + '__isnull': True}) | Q(**{lookup: 0})
+    if modifier == 'none' or (modifier in ('', 'is') and not weight):
+        return unset
+    if modifier == 'any':
+        return ~unset
+    if modifier in ('', 'is'):
+        return Q(**{lookup: weight})
+    if modifier == 'isnt':
+        return ~Q(**{lookup: weight})
+    if modifier == 'before':
+        return Q(**{lookup + '__lt': weight}) | unset
+    if modifier == 'after':
+        return Q(**{lookup + '__gt': weight})
+    raise FilterError('Unsupported modifier for priority: %s' % modifier)
+
+
+def _text_q(lookup, modifier, value):
+    # only a project can be missing, but any text can be empty
+    unset = Q(**{lookup: ''})
+    if lookup == 'project__name':
+        unset = Q(project__isnull=True)
+
+    if modifier == 'none' or (modifier in ('', 'is') and not value):
+        return unset
+    if modifier == 'any':
+        return ~unset
+
+    lookups = {
+        # like taskwarrior, a bare attribute matches on the left
+        '': 'startswith',
+        'is': 'exact',
+        'isnt': 'exact',
+        'has': 'icontains',
+        'hasnt': 'icontains',
+        'startswith': 'startswith',
+        'endswith': 'endswith',
+        'before': 'lt',
+        'after': 'gt',
+    }
+    q = Q(**{'%s__%s' % (lookup, lookups[modifier]): value})
+    if modifier in ('isnt', 'hasnt'):
+        return ~q
+    return q
+
+
+def term(token):
+    """ Return the `Q` matching the tasks selected by a single term.
+    """
+    if token[0] in '+-' and len(token) > 1:
+        q = has_tag(unquote(token[1:]))
+        return token[0] == '-' and ~q or q
+
+    match = ATTRIBUTE_RE.match(token)
+    name = match and attribute(match.group(1))
+    if not name:
+        return Q(description__icontains=unquote(token))
+
+    modifier = match.group(2) or ''
+    if modifier not in MODIFIERS:
+        raise FilterError('Unknown modifier: %s' % modifier)
+    modifier = MODIFIERS[modifier]
+    value = unquote(match.group(3))
+
+    lookup, kind = ATTRIBUTES[name]
+    if kind == 'tags':
+        return _tags_q(modifier, value)
+    if kind == 'date':
+        return _date_q(lookup, modifier, value)
+    if kind == 'priority':
+        return _priority_q(lookup, modifier, value)
+    return _text_q(lookup, modifier, value)
+
+
+class _Parser(object):
+    """ A recursive descent parser of the grammar
+
+        expression := conjunction ('or' conjunction)*
+        conjunction := factor (['and'] factor)*
+        factor := '(' expression ')' | term
+    """
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def expression(self):
+        q = self.conjunction()
+        while self.peek() == 'or':
+            self.next()
+            q = q | self.conjunction()
+        return q
+
+    def conjunction(self):
+        q = self.factor()
+        while self.peek() not in (None, 'or', ')'):
+            if self.peek() == 'and':
+                self.next()
+            q = q & self.factor()
+        return q
+
+    def factor(self):
+        token = self.next()
+        if token is None:
+            raise FilterError('Unexpected end of filter')
+        if token in OPERATORS or token == ')':
+            raise FilterError('Unexpected %s' % token)
+        if token == '(':
+            q = self.expression()
+            if self.next() != ')':
+                raise FilterError('Missing )')
+            return q
+        return term(token)
+
+
+def parse(text):
+    """ Return the `Q` selecting the tasks that match the filter `text`,
+        raising `FilterError` if it isn't a valid filter. An empty filter
+        matches every task.
+    """
+    tokens = tokenize(text)
+    if not tokens:
+        return Q()
+
+    parser = _Parser(tokens)
+    q = parser.expression()
+    if parser.peek() is not None:
+        raise FilterError('Unexpected %s' % parser.peek())
+    return q
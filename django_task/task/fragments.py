@@ -0,0 +1,33 @@
+""" Caching of rendered task grid cells.
+
+    Every task row holds a version token, `Task.cell_version`, and cells
+    are cached under the token that was current when they were rendered.
+    Bumping a task gives it a new token, so the next page view renders
+    the task's cells again; the stale cells simply expire. The tokens are
+    stored with the tasks rather than in the cache, so a bump is seen by
+    every process, whatever the cache backend.
+"""
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+TIMEOUT = getattr(settings, 'TASKGRID_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+def new_version():
+    """ Return a new version token, which no cells are cached under.
+    """
+    return uuid.uuid4().hex
+
+
+def cell_key(pk, version, column_id, last):
+    return 'taskgrid:cell:%s:%s:%s:%d' % (pk, version, column_id, last)
+
+
+def get_cells(keys):
+    return cache.get_many(keys)
+
+
+def set_cell(key, cell):
+    cache.set(key, cell, TIMEOUT)
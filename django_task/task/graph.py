@@ -0,0 +1,96 @@
+""" Queries over the graph of task dependencies.
+
+    A task is blocked while any task it depends on is still pending (or
+    waiting), and ready otherwise. The transitive blockers of tasks are
+    found with a single recursive query, which only follows the edges
+    to blocking tasks and visits each one once per starting task, so it
+    terminates on cycles too.
+"""
+from django.db import connection
+
+from task.models import Task, CHUNK_SIZE
+from task.util import chunked
+
+# statuses of the tasks that block the tasks depending on them
+BLOCKING_STATUSES = ('pending', 'waiting')
+
+
+def _blocking_edges():
+    return Task.dependencies.through.objects.filter(
+            to_task__status__in=BLOCKING_STATUSES)
+
+
+def blocked(tasks):
+    """ Return the tasks in the `tasks` queryset with a blocking
+        dependency.
+    """
+    return tasks.filter(pk__in=_blocking_edges().values('from_task'))
+
+
+def ready(tasks):
+    """ Return the tasks in the `tasks` queryset without a blocking
+        dependency.
+    """
+    return tasks.exclude(pk__in=_blocking_edges().values('from_task'))
+
+
+def _closure_sql(count):
+    qn = connection.ops.quote_name
+    through = Task.dependencies.through._meta
+    edges = {
+        'edges': qn(through.db_table),
+        'from': qn(through.get_field('from_task').column),
+        'to': qn(through.get_field('to_task').column),
+        'task': qn(Task._meta.db_table),
+        'id': qn(Task._meta.pk.column),
+        'status': qn(Task._meta.get_field('status').column),
+        'statuses': ', '.join(['%s'] * len(BLOCKING_STATUSES)),
+        'starts': ', '.join(['%s'] * count),
+    }
+    # pysqlite commits before any statement that doesn't start with a
+    # DML keyword, so the recursive query is wrapped in a SELECT
+    return ("SELECT start, node FROM ("
+            "WITH RECURSIVE reach (start, node) AS ("
+            " SELECT e.%(from)s, e.%(to)s FROM %(edges)s e"
+            " INNER JOIN %(task)s t ON t.%(id)s = e.%(to)s"
+            " WHERE e.%(from)s IN (%(starts)s)"
+            " AND t.%(status)s IN (%(statuses)s)"
+            " UNION"
+            " SELECT reach.start, e.%(to)s FROM reach"
+            " INNER JOIN %(edges)s e ON e.%(from)s = reach.node"
+            " INNER JOIN %(task)s t ON t.%(id)s = e.%(to)s"
+            " WHERE t.%(status)s IN (%(statuses)s)"
+            ") SELECT start, node FROM reach) closure" % edges)
+
+
+def closure(pks):
+    """ Return a dict mapping each task pk in `pks` to the set of pks of
+        the tasks blocking it, directly or through other blocked tasks.
+        A task on a cycle of dependencies is in its own set; tasks that
+        aren't blocked are left out.
+    """
+    result = {}
+    cursor = connection.cursor()
+    for chunk in chunked(pks, CHUNK_SIZE):
+        cursor.execute(_closure_sql(len(chunk)),
+                       list(chunk) + list(BLOCKING_STATUSES) * 2)
+        for start, node in cursor.fetchall():
+            result.setdefault(start, set()).add(node)
+
+    return result
+
+
+def blockers(task):
+    """ Return a queryset of the tasks blocking `task`, directly or
+        through other blocked tasks.
+    """
+    pks = closure([task.pk]).get(task.pk, set())
+    pks.discard(task.pk)
+    return Task.objects.filter(pk__in=pks)
+
+
+def cycles(pks):
+    """ Return the set of the tasks in `pks` that block themselves
+        through a cycle of dependencies, and so can never be done.
+    """
+    return set(pk for pk, nodes in closure(pks).iteritems() if pk in nodes)
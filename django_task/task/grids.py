@@ -1,11 +1,23 @@
-from django.db.models import Min
-from django.utils.html import urlize
+import urllib
+
+from django.db.models import Q
+from django.template.context import Context
+from django.template.loader import render_to_string
+from django.utils.html import escape, urlize
+from django.utils.safestring import mark_safe
 
 from djblets.datagrid import grids
+from task import fragments
+from task import graph
 from task.models import Task
 
 
 class Column(grids.Column):
+    # relations the column reads, joined or prefetched by the grid
+    # only while the column is visible
+    select_related = ()
+    prefetch_related = ()
+
     def render_data(self, obj):
         value = super(Column, self).render_data(obj)
         if value is None:
@@ -14,23 +26,97 @@ class Column(grids.Column):
         return value
 
 
+class CachedCellMixin(object):
+    """ Reuses the cells rendered for a task until the task, its tags
+        or its annotations change, so only for columns that show nothing
+        else.
+    """
+    def collect_objects(self, object_list):
+        super(CachedCellMixin, self).collect_objects(object_list)
+        self.datagrid.collect_cached_cells(object_list)
+
+    def render_cell(self, obj, render_context):
+        key = self.datagrid.cell_keys.get((self.id, obj.pk))
+        cell = self.datagrid.cached_cells.get(key)
+        if cell is None:
+            cell = super(CachedCellMixin, self).render_cell(obj,
+                                                            render_context)
+            if key is not None:
+                fragments.set_cell(key, cell)
+
+        return cell
+
+
 class IDColumn(grids.Column):
-    """ `taskwarrior` represents id in sequence starting from 1, so
-         this column emulates that by shifting the `Task` id column
-         so they start at 1.
+    """ `taskwarrior` numbers the pending tasks in sequence starting
+        from 1, so this column shows that working set id rather than
+        the `Task` id. Completed tasks don't have one.
+    """
+    def reset(self):
+        super(IDColumn, self).reset()
+        self.working_set_ids = {}
+
+    def collect_objects(self, object_list):
+        # look up the ids of every row on the page at once
+        users = set(obj.user_id for obj in object_list)
+        self.working_set_ids.update(Task.working_set_ids(users))
+
+    def render_data(self, obj):
+        if obj.status != 'pending':
+            return '-'
+
+        if obj.pk not in self.working_set_ids:
+            self.collect_objects([obj])
+
+        return self.working_set_ids[obj.pk]
+
+
+class BlockersColumn(grids.Column):
+    """ Shows how many pending tasks block each task, directly or
+        through the tasks they depend on, and flags cycles.
+    """
+    def reset(self):
+        super(BlockersColumn, self).reset()
+        self.blockers = {}
+
+    def collect_objects(self, object_list):
+        # walk the dependencies of every row on the page at once
+        self.blockers.update(graph.closure([obj.pk for obj in object_list]))
+
+    def render_data(self, obj):
+        blockers = self.blockers.get(obj.pk, ())
+        if obj.pk in blockers:
+            return '%d (cycle)' % (len(blockers) - 1)
+
+        return len(blockers)
+
+
+class RelatedColumn(Column):
+    """ A column showing a foreign key. The related object is joined
+        into the grid's query instead of being looked up separately.
     """
+    @property
+    def select_related(self):
+        return (self.field_name,)
+
+    def collect_objects(self, object_list):
+        pass
+
     def render_data(self, obj):
-        # This doesn't actually work unless db ids are
-        # sequential...
-        value = super(IDColumn, self).render_data(obj)
-        min_id = Task.objects.aggregate(Min('id'))['id__min']
-        return value - min_id + 1
+        value = getattr(obj, self.field_name)
+        if value is None:
+            return ''
 
+        return escape(value)
 
-class TagColumn(Column):
+
+def link_to_project(obj, value):
+    return obj.project.get_absolute_url()
+
+
+class TagColumn(CachedCellMixin, Column):
     def render_data(self, obj):
-        value = super(TagColumn, self).render_data(obj)
-        return ', '.join([t.tag for t in value.all()])
+        return escape(obj.tags_summary.replace(',', ', '))
 
 
 class ShortDateTimeSinceColumn(grids.DateTimeSinceColumn):
@@ -43,11 +129,43 @@ class ShortDateTimeSinceColumn(grids.DateTimeSinceColumn):
         return value.split(',')[0]
 
 
-class DescriptionWithAnnotationColumn(Column):
+class DateTimeColumn(CachedCellMixin, grids.DateTimeColumn):
+    pass
+
+
+class DescriptionWithAnnotationColumn(CachedCellMixin, Column):
+    """ Shows the description of a task followed by its annotations.
+        They're only loaded for the rows whose cells aren't cached.
+    """
+    def reset(self):
+        super(DescriptionWithAnnotationColumn, self).reset()
+        self.annotations = {}
+
+    def collect_objects(self, object_list):
+        super(DescriptionWithAnnotationColumn,
+              self).collect_objects(object_list)
+
+        # look up the annotations of every row to render at once
+        pks = [obj.pk for obj in object_list
+               if self.datagrid.cell_keys.get((self.id, obj.pk))
+               not in self.datagrid.cached_cells]
+        for pk in pks:
+            self.annotations[pk] = []
+        if pks:
+            links = (Task.annotations.through.objects
+                                     .filter(task__in=pks)
+                                     .select_related('annotation'))
+            for link in links:
+                self.annotations[link.task_id].append(link.annotation)
+
     def render_data(self, obj):
         description = super(DescriptionWithAnnotationColumn,
                             self).render_data(obj)
-        annotations = [str(a) for a in obj.annotations.all().order_by('time')]
+        annotations = self.annotations.get(obj.pk)
+        if annotations is None:
+            annotations = obj.annotations.all()
+        annotations = [str(a) for a in sorted(annotations,
+                                              key=lambda a: a.time)]
         value = description + "<br/>"
         for note in annotations:
             note = urlize(note)
@@ -59,16 +177,33 @@ class DescriptionWithAnnotationColumn(Column):
 class TaskDataGrid(grids.DataGrid):
     id_ = IDColumn('ID', sortable=True, shrink=True, field_name='id', link=True)
     entry = ShortDateTimeSinceColumn('Age', sortable=True)
-    due = grids.DateTimeColumn('Due', sortable=True)
-    end = grids.DateTimeColumn('Completed', sortable=True)
-    project = Column('Proj', sortable=True, shrink=True, link=True, link_func=grids.DataGrid.link_to_value)
-    tags = TagColumn('Tags', sortable=True)
-    priority = Column('Pri', sortable=True, shrink=True)
+    due = DateTimeColumn('Due', sortable=True)
+    end = DateTimeColumn('Completed', sortable=True)
+    project = RelatedColumn('Proj', sortable=True, shrink=True, link=True,
+                            link_func=link_to_project)
+    tags = TagColumn('Tags', sortable=True, db_field='tags_summary')
+    priority = RelatedColumn('Pri', sortable=True, shrink=True)
     description = DescriptionWithAnnotationColumn('Description', sortable=True,
                                                   expand=True)
     uuid = Column('uuid', sortable=True)
-    user = Column('User', sortable=True, shrink=True)
+    user = RelatedColumn('User', sortable=True, shrink=True)
     status = Column('Status', sortable=True, shrink=True)
+    blockers = BlockersColumn('Blocked by', shrink=True)
+
+    # columns the grid can page through with a cursor rather than an
+    # offset, and the lookup they're ordered by ('-' reverses it)
+    keyset_fields = {
+        'id_': 'id',
+        'entry': 'entry',
+        'due': 'due',
+        'end': 'end',
+        'description': 'description',
+        'uuid': 'uuid',
+        'status': 'status',
+        'tags': 'tags_summary',
+        'priority': '-priority__weight',
+    }
+    keyset_listview_template = 'task/datagrid_listview.html'
 
     def __init__(self, request, queryset=Task.objects.all(), **kwargs):
         super(TaskDataGrid, self).__init__(request, queryset=queryset, **kwargs)
@@ -77,3 +212,225 @@ class TaskDataGrid(grids.DataGrid):
                                 'due', 'description']
         self.profile_sort_field = 'sort_task_columns'
         self.profile_columns_field = 'task_columns'
+        self.next_url = None
+        self.previous_url = None
+        self.first_url = None
+        self.cell_keys = {}
+        self.cached_cells = {}
+
+    def load_extra_state(self, profile):
+        # searches list the best matches first unless asked for an order
+        if self.request.GET.get('q') and 'sort' not in self.request.GET:
+            self.sort_list = []
+        return False
+
+    def precompute_objects(self, render_context=None):
+        # djblets only post-processes the page when it optimizes the
+        # sort, so prepare the base queryset as well
+        self.queryset = self.post_process_queryset(self.queryset)
+
+        key = self._keyset_key()
+        if key is None:
+            super(TaskDataGrid, self).precompute_objects(render_context)
+        else:
+            self._precompute_keyset_page(key, render_context)
+
+    def _keyset_key(self):
+        """ Returns the lookup the page is keyed on, whether it and
+            the tie-breaking id are descending, and the field that's null
+            when the lookup is, or None if the sort has to be paged by
+            offset.
+        """
+        sort_list = [item for item in self.sort_list
+                     if item.lstrip('-') in self.db_field_map]
+        if not sort_list:
+            return None
+
+        lookup = self.keyset_fields.get(sort_list[0].lstrip('-'))
+        if lookup is None:
+            return None
+
+        descending = sort_list[0].startswith('-')
+        lookup_descending = descending != lookup.startswith('-')
+        lookup = lookup.lstrip('-')
+        field = Task._meta.get_field(lookup.split('__')[0])
+        return (lookup, lookup_descending, descending,
+                field.null and field or None)
+
+    def _cursor(self):
+        """ Returns the direction and `Task` id of the cursor in the
+            request. A cursor taken under another sort order is ignored.
+        """
+        sort = ','.join(self.sort_list)
+        for direction in ('after', 'before'):
+            cursor_sort, _, pk = self.request.GET.get(direction,
+                                                      '').rpartition(':')
+            if cursor_sort == sort and pk.isdigit():
+                return direction, int(pk)
+
+        return None, None
+
+    def _cursor_url(self, direction=None, obj=None):
+        params = [(key, value) for key, value in self.request.GET.items()
+                  if key not in ('after', 'before', 'page', 'gridonly',
+                                 'datagrid-id')]
+        if direction:
+            params.append((direction,
+                           '%s:%s' % (','.join(self.sort_list), obj.pk)))
+
+        return '?' + urllib.urlencode(params)
+
+    def _precompute_keyset_page(self, key, render_context):
+        """ Fetches the page after or before the cursor by filtering on
+            the sort key rather than skipping the earlier rows, so every
+            page costs the same. Tasks without a value sort last.
+        """
+        direction, pk = self._cursor()
+        boundary = direction and self._boundary(key, pk)
+        if boundary is None:
+            direction = None
+
+        before = direction == 'before'
+        limit = self.paginate_by + 1
+        object_list = []
+        for query in self._keyset_queries(key, boundary, before):
+            object_list.extend(query[:limit - len(object_list)])
+            if len(object_list) == limit:
+                break
+
+        more = len(object_list) > self.paginate_by
+        del object_list[self.paginate_by:]
+        if before:
+            object_list.reverse()
+
+        has_previous = before and more or direction == 'after'
+        has_next = before or more
+        if object_list and has_previous:
+            self.previous_url = self._cursor_url('before', object_list[0])
+            self.first_url = self._cursor_url()
+        if object_list and has_next:
+            self.next_url = self._cursor_url('after', object_list[-1])
+
+        for column in self.columns:
+            column.collect_objects(object_list)
+
+        if render_context is None:
+            render_context = self._build_render_context()
+
+        self.rows = [
+            {
+                'object': obj,
+                'cells': [column.render_cell(obj, render_context)
+                          for column in self.columns]
+            }
+            for obj in object_list
+        ]
+
+    def _boundary(self, key, pk):
+        """ Returns the sort key and id of the task with `pk`, or None if
+            it doesn't exist.
+        """
+        try:
+            return Task.objects.values(key[0], 'pk').get(pk=pk)
+        except Task.DoesNotExist:
+            return None
+
+    def _keyset_queries(self, key, boundary, before):
+        """ Yields the querysets that fetch the rows beyond `boundary`,
+            in the order they're fetched in. A nullable sort key is split
+            into the rows with a value and the ones without, so that each
+            range is read in the order of an index rather than sorted.
+        """
+        lookup, lookup_descending, descending, null_field = key
+        order = [(lookup_descending != before and '-' or '') + lookup,
+                 (descending != before and '-' or '') + 'id']
+        values = self.queryset.order_by(*order)
+        if null_field is None:
+            if boundary is not None:
+                values = values.filter(self._keyset_filter(key, boundary,
+                                                           before))
+            yield values
+            return
+
+        isnull = '%s__isnull' % null_field.name
+        values = values.filter(**{isnull: False})
+        nulls = self.queryset.filter(**{isnull: True}).order_by(order[1])
+        if boundary is not None and boundary[lookup] is None:
+            pk_op = before != descending and 'lt' or 'gt'
+            nulls = nulls.filter(**{'pk__%s' % pk_op: boundary['pk']})
+            if not before:
+                # every row with a value comes before the boundary
+                values = None
+        elif boundary is not None:
+            values = values.filter(self._keyset_filter(key, boundary, before))
+            if before:
+                nulls = None
+
+        for query in (before and (nulls, values) or (values, nulls)):
+            if query is not None:
+                yield query
+
+    def _keyset_filter(self, key, boundary, before):
+        """ Returns a `Q` matching the rows with a value beyond
+            `boundary` in the order they're fetched. The range on the
+            sort key alone lets the database seek into its index.
+        """
+        lookup, lookup_descending, descending, null_field = key
+        value, pk = boundary[lookup], boundary['pk']
+        op = before != lookup_descending and 'lt' or 'gt'
+        pk_op = before != descending and 'lt' or 'gt'
+        return (Q(**{'%s__%se' % (lookup, op): value}) &
+                (Q(**{'%s__%s' % (lookup, op): value}) |
+                 Q(**{'pk__%s' % pk_op: pk})))
+
+    def render_listview(self, render_context=None):
+        if render_context is None:
+            render_context = self._build_render_context()
+
+        self.load_state(render_context)
+        if self.page is not None:
+            return super(TaskDataGrid, self).render_listview(render_context)
+
+        context = Context({
+            'datagrid': self,
+            'is_paginated': bool(self.next_url or self.previous_url),
+            'next_url': self.next_url,
+            'previous_url': self.previous_url,
+            'first_url': self.first_url,
+        })
+        context.update(self.extra_context)
+        context.update(render_context)
+
+        return mark_safe(render_to_string(self.keyset_listview_template,
+                                          context))
+
+    def collect_cached_cells(self, object_list):
+        """ Looks up the cached cells of every row on the page at once,
+            the first time a caching column asks for them.
+        """
+        if self.cell_keys:
+            return
+
+        columns = [column for column in self.columns
+                   if isinstance(column, CachedCellMixin)]
+        for obj in object_list:
+            for column in columns:
+                self.cell_keys[(column.id, obj.pk)] = fragments.cell_key(
+                        obj.pk, obj.cell_version, column.id, column.last)
+        self.cached_cells = fragments.get_cells(self.cell_keys.values())
+
+    def post_process_queryset(self, queryset):
+        select_related = set()
+        prefetch_related = set()
+        for column in self.columns:
+            select_related.update(getattr(column, 'select_related', ()))
+            prefetch_related.update(getattr(column, 'prefetch_related', ()))
+
+        # select_related() replaces any earlier call, so every column's
+        # relations are added at once
+        if select_related:
+            queryset = queryset.select_related(*sorted(select_related))
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*sorted(prefetch_related))
+
+        return super(TaskDataGrid, self).post_process_queryset(queryset)
@@ -0,0 +1,58 @@
+from django.db import connection, transaction, DatabaseError
+from django.db.models.signals import post_syncdb
+
+from task import models as task_app
+from task import search
+
+# Composite indexes, by model, that Django can't declare on the fields.
+INDEXES = {
+    # the cursor pagination in `TaskDataGrid`: each list is filtered on
+    # status and paged on a sort column plus id; a user's taskdb files,
+    # working-set ids and sidebar counts read the tasks with a status
+    # that belong to them, in order of entry
+    task_app.Task: [
+        ('status', 'id'),
+        ('status', 'entry', 'id'),
+        ('status', 'due', 'id'),
+        ('status', 'end', 'id'),
+        ('status', 'priority', 'id'),
+        ('user', 'status', 'entry', 'id'),
+    ],
+    # undo.data is written out (and synced) per user in order of time
+    task_app.Undo: [
+        ('user', 'time', 'id'),
+    ],
+}
+
+
+def create_search_index(sender, **kwargs):
+    search.create_index()
+
+
+def create_indexes(sender, created_models=(), **kwargs):
+    """ Create the `INDEXES` of the tables syncdb just created. The
+        column names are quoted by the backend, as some are keywords.
+        flush sends the signal as well, when the indexes already exist.
+    """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for model, indexes in INDEXES.items():
+        if model not in created_models:
+            continue
+        table = model._meta.db_table
+        for fields in indexes:
+            name = '%s_%s' % (table, '_'.join(fields))
+            columns = [model._meta.get_field(field).column
+                       for field in fields]
+            try:
+                cursor.execute('CREATE INDEX %s ON %s (%s)'
+                               % (qn(name), qn(table),
+                                  ', '.join(qn(column)
+                                            for column in columns)))
+            except DatabaseError:
+                transaction.rollback_unless_managed()
+            else:
+                transaction.commit_unless_managed()
+
+post_syncdb.connect(create_search_index, sender=task_app)
+post_syncdb.connect(create_indexes, sender=task_app)
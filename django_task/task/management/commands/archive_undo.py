@@ -0,0 +1,46 @@
+""" Move the undo entries beyond each user's retention policy out of
+    the `Undo` table and into compressed archive files.
+
+    Run it periodically, e.g. from cron. Each archive file is written
+    and its entries deleted in a transaction of its own, so it can be
+    interrupted and run again.
+"""
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from task import archive
+
+
+class Command(BaseCommand):
+    help = 'Archive the undo entries beyond the retention policy'
+    args = '[username ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=archive.BATCH_SIZE,
+                    help='The number of entries in each archive file'),
+        make_option('--dry-run', action='store_true', default=False,
+                    help="Report what would be archived, but don't"),
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+
+        users = User.objects.order_by('pk')
+        if args:
+            users = users.filter(username__in=args)
+            missing = set(args).difference(users.values_list('username',
+                                                             flat=True))
+            if missing:
+                raise CommandError('Unknown users: %s'
+                                   % ', '.join(sorted(missing)))
+
+        for user in users.iterator():
+            count = archive.expired(user)
+            if count and not options['dry_run']:
+                count = archive.archive(user, count, options['batch_size'])
+            if count:
+                self.stdout.write('%s: %d entries %s\n' % (
+                        user.username, count,
+                        options['dry_run'] and 'to archive' or 'archived'))
@@ -0,0 +1,188 @@
+""" Benchmarks for the hot paths of taskweb.
+
+    Run them all with `./manage.py benchmark`, or name the ones to run.
+"""
+import os
+import resource
+import tempfile
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from task.models import Task, Tag
+from task.util import iterparse_undo
+
+UNDO_ENTRY = ('time %(ts)s\n'
+              'old [description:"task %(n)s" entry:"%(ts)s" status:"pending" '
+              'uuid:"%(n)08d-7c9c-4418-ae8f-25ba123e072a"]\n'
+              'new [description:"task %(n)s" end:"%(ts)s" entry:"%(ts)s" '
+              'status:"completed" uuid:"%(n)08d-7c9c-4418-ae8f-25ba123e072a"]\n'
+              '---\n')
+
+
+def _parse_undo_split(data):
+    """ The original `parse_undo()`, which splits the whole file up front.
+    """
+    undo_list = []
+    for segment in data.split('---'):
+        parsed = {}
+        undo = [line for line in segment.splitlines() if line.strip()]
+        if not undo:
+            continue
+
+        parsed['time'] = undo[0].split(' ', 1)[1]
+        if undo[1].startswith('old'):
+            parsed['old'] = undo[1].split(' ', 1)[1] + "\n"
+            parsed['new'] = undo[2].split(' ', 1)[1] + "\n"
+        else:
+            parsed['new'] = undo[1].split(' ', 1)[1] + "\n"
+
+        undo_list.append(parsed)
+
+    return undo_list
+
+
+def _measure(func, *args):
+    """ Run `func` in a child process, returning the seconds it took and
+        how much it grew the child's peak memory use (in KiB).
+    """
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_end, '%r %r' % (elapsed, after - before))
+        os._exit(0)
+
+    os.close(write_end)
+    result = os.read(read_end, 1024)
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    elapsed, grown = result.split()
+    return float(elapsed), int(grown)
+
+
+def bench_undo_parse(stdout, entries=50000):
+    """ Parse an undo.data file with the original and streaming parsers.
+    """
+    fd, path = tempfile.mkstemp(suffix='.data')
+    with os.fdopen(fd, 'w') as f:
+        for n in xrange(entries):
+            f.write(UNDO_ENTRY % {'ts': 1347125849 + n, 'n': n})
+
+    def split():
+        with open(path) as f:
+            for entry in _parse_undo_split(f.read()):
+                pass
+
+    def streaming():
+        with open(path) as f:
+            for entry in iterparse_undo(f):
+                pass
+
+    try:
+        stdout.write('undo_parse (%s entries, %s KiB)\n'
+                     % (entries, os.path.getsize(path) / 1024))
+        for name, func in (('split', split), ('streaming', streaming)):
+            elapsed, grown = _measure(func)
+            stdout.write('  %-10s %8.3fs %10s KiB peak memory growth\n'
+                         % (name, elapsed, grown))
+    finally:
+        os.remove(path)
+
+
+def _ignore_relations(method):
+    """ Wrap a state method of `Task` so it reads the relations itself,
+        like `Task.save()` did before they were shared.
+    """
+    def _wrapper(self, relations=None):
+        return method(self)
+    return _wrapper
+
+
+def _time_saves(tasks, change):
+    """ Apply `change` to each of `tasks` and save it, returning the
+        seconds and the number of queries per save.
+    """
+    del connection.queries[:]
+    start = time.time()
+    for task in tasks:
+        change(task)
+        task.save()
+    elapsed = time.time() - start
+    return elapsed / len(tasks), float(len(connection.queries)) / len(tasks)
+
+
+def bench_task_save(stdout, tasks=200):
+    """ Save edited tasks, reading their relations for each of the
+        states the undo entry is made of, and once for all of them.
+        Everything is rolled back afterwards.
+    """
+    def edit_description(task):
+        task.description += '!'
+
+    def add_tag(task):
+        task._snapshot_relations()
+        task.tags.add(tag)
+
+    changes = (('description', edit_description), ('tag', add_tag))
+    original = Task._todict, Task._original_todict
+
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    try:
+        with transaction.commit_manually():
+            try:
+                user = User.objects.create(username='benchmark-task-save')
+                tag = Tag.objects.create(tag='benchmark-task-save')
+                objs = []
+                for n in xrange(tasks):
+                    task = Task(description='task %s' % n, user=user)
+                    task.save(track=False)
+                    objs.append(task)
+
+                stdout.write('task_save (%s tasks)\n' % tasks)
+                for change_name, change in changes:
+                    Task._todict, Task._original_todict = map(
+                            _ignore_relations, original)
+                    try:
+                        separate = _time_saves(objs, change)
+                    finally:
+                        Task._todict, Task._original_todict = original
+                    shared = _time_saves(objs, change)
+
+                    for name, (elapsed, queries) in (('separate', separate),
+                                                     ('shared', shared)):
+                        stdout.write('  %-12s %-10s %8.2fms %6.1f queries '
+                                     'per save\n' % (change_name, name,
+                                                      elapsed * 1000, queries))
+            finally:
+                transaction.rollback()
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+
+
+BENCHMARKS = {
+    'task_save': bench_task_save,
+    'undo_parse': bench_undo_parse,
+    }
+
+
+class Command(BaseCommand):
+    args = '[benchmark ...]'
+    help = ('Run the named benchmarks (all of them by default): %s'
+            % ', '.join(sorted(BENCHMARKS)))
+
+    def handle(self, *args, **options):
+        for name in args:
+            if name not in BENCHMARKS:
+                raise CommandError('Unknown benchmark: %s' % name)
+
+        for name in args or sorted(BENCHMARKS):
+            BENCHMARKS[name](self.stdout)
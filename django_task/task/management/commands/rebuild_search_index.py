@@ -0,0 +1,25 @@
+""" Create the full-text search index and index every task in it.
+
+    The index is created by syncdb and kept up to date as tasks change,
+    so this is only needed for databases created before it existed.
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from task import search
+from task.models import Task
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index of task descriptions'
+
+    def handle(self, *args, **options):
+        search.create_index()
+        if not search.enabled():
+            raise CommandError('The database has no full-text search')
+
+        pks = list(Task.objects.values_list('pk', flat=True))
+        with transaction.commit_on_success():
+            Task.update_search_index(pks)
+
+        self.stdout.write('%d tasks indexed\n' % len(pks))
@@ -0,0 +1,22 @@
+""" Recompute the denormalized tag and annotation summaries of tasks.
+
+    The summaries are kept up to date as tasks change, so this is only
+    needed after changing the relations behind taskweb's back, or to
+    fill them in for tasks stored before they existed.
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from task.models import Task
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the tag and annotation summaries of every task'
+
+    def handle(self, *args, **options):
+        pks = list(Task.objects.values_list('pk', flat=True))
+        with transaction.commit_on_success():
+            changed = Task.update_summaries(pks)
+
+        self.stdout.write('%d of %d tasks updated\n' % (len(changed),
+                                                        len(pks)))
@@ -1,14 +1,27 @@
 import uuid
 import datetime
+import hashlib
+import heapq
+import itertools
 import time
+import threading
+from contextlib import contextmanager
 from operator import itemgetter
 
-from django.db import models
+from django.db import models, router, transaction
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.utils.encoding import smart_str, force_unicode
+from django.db.models import F, Sum
+from django.db.models.signals import (pre_save, post_save, post_delete,
+                                      pre_delete, m2m_changed)
 
 from taskw.utils import encode_task as _encode_task
 
+from task import cache as taskdb_cache
+from task import fragments
+from task import search
+from task.util import chunked, group_by_task, split_tags
+
 PRIORITY_CHOICES = (
         (0, ''),  # unprioritized
         (1, 'L'),
@@ -19,6 +32,22 @@ PRIORITY_CHOICES = (
 PRIORITY_MAP = dict(PRIORITY_CHOICES)
 PRIORITY_MAP_R = dict((v, k) for (k, v) in PRIORITY_CHOICES)
 
+# number of rows handled per chunk when streaming or importing the taskdb
+# files (also bounds the size of the `IN` clauses used for bulk lookups)
+CHUNK_SIZE = 500
+
+# the number of rows of each of Priority, Project and Tag kept in the
+# process-local `LookupCache`s
+LOOKUP_CACHE_SIZE = 1000
+
+# `Task` fields that map directly onto a `taskwarrior` attribute
+TASKW_FIELDS = ('description', 'due', 'end', 'entry', 'priority', 'project',
+                'status', 'user', 'uuid')
+TASKW_DATE_FIELDS = ('due', 'end', 'entry')
+
+# denormalized from the tags and annotations of a `Task`
+SUMMARY_FIELDS = ('tags_summary', 'annotation_count', 'latest_annotation')
+
 
 def get_or_create_task(**kwargs):
     """ Return an existing task or new task if it doesn't exist.
@@ -47,7 +76,10 @@ def undo(func):
     """
     def _decorator(self, *args, **kwargs):
         track = kwargs.pop('track', True)
-        if track:
+        if track and _begin_undo(self):
+            # recorded when the unit of work ends
+            func(self, *args, **kwargs)
+        elif track:
             old = encode_task(self.todict())
             func(self, *args, **kwargs)
             new = encode_task(self.todict())
@@ -59,12 +91,193 @@ def undo(func):
     return _decorator
 
 
+_undo_units = threading.local()
+
+
+def _begin_undo(task):
+    """ Record the state of `task` before it's first changed in the
+        current unit of work. Returns False if there isn't one.
+    """
+    tasks = getattr(_undo_units, 'tasks', None)
+    if tasks is None:
+        return False
+
+    if id(task) not in tasks:
+        old = task.pk and encode_task(task._original_todict()) or None
+        tasks[id(task)] = (task, old)
+    return True
+
+
+@contextmanager
+def undo_unit(*tasks):
+    """ Context manager that makes the tracked changes to each task
+        inside it a single undoable step.
+
+        A task is encoded when it's first changed (or on entry, for the
+        `tasks` given) and again on exit, when one `Undo` entry is
+        written for it if it changed. Nothing is written if the block
+        raises.
+    """
+    outer = getattr(_undo_units, 'tasks', None)
+    if outer is None:
+        _undo_units.tasks = {}
+
+    try:
+        for task in tasks:
+            _begin_undo(task)
+        yield
+        if outer is None:
+            for task, old in _undo_units.tasks.values():
+                if task.pk is None:
+                    # deleted inside the unit
+                    continue
+                new = encode_task(task.todict())
+                if new != old:
+                    Undo.objects.create(old=old, new=new, user=task.user)
+    finally:
+        if outer is None:
+            _undo_units.tasks = None
+
+
 def datetime2ts(dt):
     """ Convert a `datetime` object to unix timestamp (seconds since epoch).
     """
     return int(time.mktime(dt.timetuple()))
 
 
+def undo_checksum(ts, old, new):
+    """ Return a checksum identifying the undo entry made at the unix
+        timestamp `ts` with the `old` and `new` task data.
+    """
+    data = u'%s\n%s\n%s' % (ts, old or u'', new)
+    return hashlib.sha1(smart_str(data)).hexdigest()
+
+
+def _undo_dict_checksum(d):
+    return undo_checksum(d['time'], d.get('old'), d['new'])
+
+
+def _undo_row_checksum(checksum, time_, old, new):
+    # entries stored before checksums were have a blank one
+    return checksum or undo_checksum(datetime2ts(time_), old, new)
+
+
+def taskdb_filename(status):
+    """ Return the name of the taskdb file that tasks with `status`
+        are stored in.
+    """
+    if status in ('completed', 'deleted'):
+        return 'completed.data'
+
+    return 'pending.data'
+
+
+def ts2datetime(ts):
+    """ Convert a unix timestamp (as a string or number) to a `datetime`,
+        returning None if there isn't one.
+    """
+    if ts is None or ts == '':
+        return None
+
+    return datetime.datetime.fromtimestamp(int(ts))
+
+
+def taskw_dict(fields, tags=(), annotations=(), depends=()):
+    """ Build a `taskwarrior` task dictionary.
+
+        `fields` maps the names in `TASKW_FIELDS` to their python values,
+        `tags` is a list of tag names, `annotations` a list of
+        `(time, data)` pairs and `depends` a list of uuids.
+    """
+    task = {}
+    for fieldname, value in fields.iteritems():
+        if not value:
+            continue
+
+        if fieldname in TASKW_DATE_FIELDS:
+            value = int(datetime2ts(value))
+
+        if str(value):
+            task[fieldname] = str(value)
+
+    tags = ','.join(tags)
+    if tags:
+        task['tags'] = str(tags)
+
+    for when, data in annotations:
+        task['annotation_%s' % datetime2ts(when)] = data
+
+    depends = ','.join(depends)
+    if depends:
+        task['depends'] = depends
+
+    return task
+
+
+def _summary_fields(tags, annotations):
+    """ Return the summary fields of a task with `tags` (names, in the
+        order of the `Tag` pks) and `annotations` (`(time, data)` pairs).
+    """
+    annotations = sorted(annotations)
+    return {
+        'tags_summary': ','.join(tags),
+        'annotation_count': len(annotations),
+        'latest_annotation': annotations and annotations[-1][1] or '',
+        }
+
+
+def _bulk_lookup(model, fieldname, values):
+    """ Return a dict mapping each of `values` that exists to the pk of
+        the `model` row whose `fieldname` has that value.
+    """
+    found = {}
+    for chunk in chunked(values, CHUNK_SIZE):
+        rows = (model._default_manager
+                    .filter(**{'%s__in' % fieldname: chunk})
+                    .values_list(fieldname, 'pk'))
+        found.update(rows)
+
+    return found
+
+
+def _bulk_get_or_create(model, fieldname, values):
+    """ Like `_bulk_lookup`, but create the rows that don't exist yet.
+    """
+    values = set(values)
+    found = _bulk_lookup(model, fieldname, values)
+    missing = values.difference(found)
+    if missing:
+        model._default_manager.bulk_create(
+                [model(**{fieldname: value}) for value in sorted(missing)])
+        found.update(_bulk_lookup(model, fieldname, missing))
+
+    return found
+
+
+def _split_depends(depends):
+    return [dep for dep in (depends or '').split(',') if dep]
+
+
+def _comparable(d):
+    """ Return the parts of a task dictionary that are stored on a `Task`,
+        in a form that can be compared with another task dictionary.
+    """
+    result = {}
+    for key, value in d.iteritems():
+        if key == 'tags':
+            value = frozenset(split_tags(value))
+        elif key == 'depends':
+            value = frozenset(_split_depends(value))
+        elif key == 'user' or not (key in TASKW_FIELDS or
+                                   key.startswith('annotation_')):
+            continue
+
+        if value:
+            result[key] = value
+
+    return result
+
+
 class Priority(models.Model):
     weight = models.PositiveSmallIntegerField(choices=PRIORITY_CHOICES,
                                               unique=True)
@@ -84,6 +297,95 @@ class Profile(models.Model):
     sort_task_columns = models.CharField(max_length=256, blank=True)
     task_columns = models.CharField(max_length=256, blank=True)
 
+    # how much of the undo log is kept in the `Undo` table before it's
+    # archived; None falls back to the site-wide settings
+    undo_keep_days = models.PositiveIntegerField(null=True, blank=True)
+    undo_keep_entries = models.PositiveIntegerField(null=True, blank=True)
+
+
+@contextmanager
+def commit_on_success_unless_managed():
+    """ Context manager that runs the block in a transaction of its own,
+        committed if it succeeds, unless a transaction is already being
+        managed, which the block then becomes part of. (A nested
+        `commit_on_success` would commit the outer transaction early.)
+    """
+    if transaction.is_managed():
+        yield
+    else:
+        with transaction.commit_on_success():
+            yield
+
+
+_touches = threading.local()
+
+
+@contextmanager
+def batch_touches():
+    """ Context manager that collects the `TaskDbVersion.touch()`es made
+        inside it and applies each distinct one once, on exit.
+    """
+    outer = getattr(_touches, 'pending', None)
+    if outer is None:
+        _touches.pending = set()
+
+    try:
+        yield
+    finally:
+        if outer is None:
+            pending, _touches.pending = _touches.pending, None
+            for user_id, filename in pending:
+                TaskDbVersion.touch(user_id, filename)
+
+
+class TaskDbVersion(models.Model):
+    """ The version of one of a user's taskdb files, bumped whenever the
+        data in it changes.
+    """
+    user = models.ForeignKey(User)
+    filename = models.CharField(max_length=32)
+    version = models.PositiveIntegerField(default=0)
+    modified = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('user', 'filename')
+
+    def __unicode__(self):
+        return u'<TaskDbVersion: %s, %s, %s>' % (self.user_id, self.filename,
+                                                 self.version)
+
+    @property
+    def etag(self):
+        return '%s-%s-%s' % (self.pk, self.version,
+                             datetime2ts(self.modified))
+
+    @classmethod
+    def get_for(cls, user, filename):
+        version, created = cls.objects.get_or_create(
+                user=user, filename=filename,
+                defaults={'modified': datetime.datetime.now()})
+        return version
+
+    @classmethod
+    def touch(cls, user_id, filename):
+        """ Bump the version of `filename` for the user with `user_id`.
+        """
+        if user_id is None:
+            return
+
+        pending = getattr(_touches, 'pending', None)
+        if pending is not None:
+            pending.add((user_id, filename))
+            return
+
+        taskdb_cache.invalidate(user_id, filename)
+        now = datetime.datetime.now()
+        updated = (cls.objects.filter(user=user_id, filename=filename)
+                              .update(version=F('version') + 1, modified=now))
+        if not updated:
+            cls.objects.create(user_id=user_id, filename=filename,
+                               version=1, modified=now)
+
 
 class Undo(models.Model):
     """ Representation of taskwarrior undo.data
@@ -92,9 +394,10 @@ class Undo(models.Model):
     time = models.DateTimeField()
     new = models.TextField()
     old = models.TextField(blank=True, null=True)
+    checksum = models.CharField(max_length=40, blank=True, editable=False)
 
     class Meta:
-        ordering = ['time']
+        ordering = ['time', 'id']
 
     def __unicode__(self):
         return u'<Undo: %s, %s, %s>' % (self.time, self.new, self.old)
@@ -103,6 +406,10 @@ class Undo(models.Model):
         if not self.time:
             self.time = datetime.datetime.now()
 
+        if not self.checksum:
+            self.checksum = undo_checksum(datetime2ts(self.time), self.old,
+                                          self.new)
+
         super(Undo, self).save(*args, **kwargs)
 
     @classmethod
@@ -118,18 +425,167 @@ class Undo(models.Model):
         return undo
 
     @classmethod
-    def serialize(cls):
+    def sync(cls, dicts, user):
+        """ Make the undo log of `user` match the entries in `dicts`.
+
+            The log only ever grows, so usually the stored entries are
+            a prefix of `dicts`. That's confirmed by comparing the
+            checksums of the last stored entry and its counterpart, and
+            only the entries after them are inserted. If the logs have
+            diverged, `dicts` is iterated again from the start to find
+            the first difference, and the stored entries from there on
+            are replaced. Entries that have been archived are skipped
+            rather than stored again.
+
+            `dicts` is consumed lazily and the new entries are inserted
+            `CHUNK_SIZE` at a time, so it can be a parser reading the
+            upload, as long as it can be iterated more than once.
+            Returns a dict with the number of entries that were
+            `created` and `deleted`.
+        """
+        if iter(dicts) is dicts:
+            raise TypeError('The undo entries must be iterable more '
+                            'than once')
+
+        archived = 0
+        boundary = UndoArchive.boundary(user)
+        if boundary is not None:
+            # a log that doesn't start with the archived entries (one
+            # downloaded after they were archived, say) is used whole
+            count, checksum = boundary
+            last = _last_entry(iter(dicts), count)
+            if last is not None and _undo_dict_checksum(last) == checksum:
+                archived = count
+
+        stored = cls.objects.filter(user=user).order_by('time', 'id')
+        fields = ('checksum', 'time', 'old', 'new')
+
+        with commit_on_success_unless_managed():
+            # the common case: the last stored entry is where we'd expect
+            # it, so it's the only one whose checksum is compared
+            count = stored.count()
+            entries = _skip_entries(iter(dicts), archived)
+            prefix = 0
+            pending = []
+            if count:
+                last = _last_entry(entries, count)
+                row = stored.reverse().values_list(*fields)[0]
+                if (last is not None and _undo_row_checksum(*row) ==
+                        _undo_dict_checksum(last)):
+                    prefix = count
+
+            if count and prefix != count:
+                # walk both logs in step from the start until they differ
+                entries = _skip_entries(iter(dicts), archived)
+                for row in stored.values_list(*fields).iterator():
+                    d = next(entries, None)
+                    if d is None:
+                        break
+                    if _undo_row_checksum(*row) != _undo_dict_checksum(d):
+                        pending.append(d)
+                        break
+                    prefix += 1
+
+            with batch_touches():
+                deleted = list(stored.values_list('pk', flat=True)[prefix:])
+                for chunk in chunked(deleted, CHUNK_SIZE):
+                    cls.objects.filter(pk__in=chunk).delete()
+
+                created = 0
+                for chunk in chunked(itertools.chain(pending, entries),
+                                     CHUNK_SIZE):
+                    cls.objects.bulk_create(
+                        [cls(user=user, time=ts2datetime(d['time']),
+                             old=d.get('old'), new=d['new'],
+                             checksum=_undo_dict_checksum(d))
+                            for d in chunk])
+                    created += len(chunk)
+
+                if created:
+                    TaskDbVersion.touch(user.pk, 'undo.data')
+
+        return {'created': created, 'deleted': len(deleted)}
+
+    def encode(self):
+        """ Return the undo entry in the format expected by taskwarrior.
+        """
+        data = [u'time %s\n' % int(datetime2ts(self.time))]
+        if self.old:
+            data.append(u'old %s' % self.old)
+        data.append(u'new %s' % self.new)
+        data.append(u'---\n')
+        return u''.join(data)
+
+    @classmethod
+    def iterserialize(cls, user=None, chunk_size=CHUNK_SIZE):
+        """ Yield the table (or just the entries of `user`) in the format
+            expected by taskwarrior, `chunk_size` entries at a time.
+        """
+        undos = cls.objects.all()
+        if user is not None:
+            undos = undos.filter(user=user)
+
+        for chunk in chunked(undos.iterator(), chunk_size):
+            yield u''.join(undo.encode() for undo in chunk)
+
+    @classmethod
+    def serialize(cls, user=None):
         """ Serialze the table into a format expected by taskwarrior
         """
-        data = ''
-        for undo in cls.objects.all():
-            data += u'time %s\n' % int(datetime2ts(undo.time))
-            if undo.old:
-                data += u'old %s' % undo.old
-            data += u'new %s' % undo.new
-            data += u'---\n'
+        return u''.join(cls.iterserialize(user))
+
+
+def _skip_entries(entries, count):
+    """ Consume the first `count` entries of the iterator `entries`,
+        without keeping them, and return it.
+    """
+    next(itertools.islice(entries, count, count), None)
+    return entries
+
+
+def _last_entry(entries, count):
+    """ Consume the first `count` entries of the iterator `entries`,
+        keeping only the last one, which is returned. Returns None if
+        there are fewer.
+    """
+    n, last = 0, None
+    for n, last in enumerate(itertools.islice(entries, count), 1):
+        pass
+    if n != count:
+        return None
+    return last
+
+
+class UndoArchive(models.Model):
+    """ A compressed file of a user's oldest undo entries, moved out of
+        the `Undo` table by the `archive_undo` command. The rows index
+        the files in the order their entries were logged.
+    """
+    user = models.ForeignKey(User)
+    path = models.CharField(max_length=255)
+    first_time = models.DateTimeField()
+    last_time = models.DateTimeField()
+    count = models.PositiveIntegerField()
+    last_checksum = models.CharField(max_length=40)
+
+    class Meta:
+        ordering = ['id']
+
+    def __unicode__(self):
+        return u'<UndoArchive: %s, %s, %s>' % (self.user_id, self.path,
+                                               self.count)
+
+    @classmethod
+    def boundary(cls, user):
+        """ Return the number of archived entries of `user` and the
+            checksum of the last one, or None if none are archived.
+        """
+        archives = cls.objects.filter(user=user)
+        total = archives.aggregate(total=Sum('count'))['total']
+        if not total:
+            return None
 
-        return data
+        return total, archives.order_by('-id')[0].last_checksum
 
 
 class Annotation(models.Model):
@@ -167,39 +623,173 @@ class Project(models.Model):
         return ("task.views.detail_project", [str(self.id)])
 
 
+class LookupCache(object):
+    """ A process-local cache of the rows of a small table that rarely
+        changes, looked up by its unique `field`, holding at most `size`
+        of the most recently used ones.
+
+        Only rows read outside of a transaction that has written
+        anything are cached. A row created earlier in the transaction
+        could otherwise be cached and outlive a rollback. Saving or
+        deleting a row drops it from the cache.
+
+        Each row is stamped when it's used; when the cache is full, the
+        least recently used quarter of the rows is dropped at once.
+    """
+    def __init__(self, model, field, size=LOOKUP_CACHE_SIZE):
+        self.model = model
+        self.field = field
+        self.size = size
+        self._rows = {}
+        self._used = {}
+        self._clock = itertools.count()
+        self._lock = threading.Lock()
+
+    def _cached(self, value):
+        with self._lock:
+            obj = self._rows.get(value)
+            if obj is not None:
+                self._used[value] = next(self._clock)
+            return obj
+
+    def get(self, value):
+        """ Return the row with `value`, raising `DoesNotExist` if there
+            isn't one.
+        """
+        obj = self._cached(value)
+        if obj is None:
+            obj = self.model.objects.get(**{self.field: value})
+            if transaction.is_managed() and transaction.is_dirty():
+                return obj
+            with self._lock:
+                self._rows[value] = obj
+                self._used[value] = next(self._clock)
+                if len(self._rows) > self.size:
+                    self._evict(len(self._rows) - self.size + self.size // 4)
+
+        return obj
+
+    def _evict(self, count):
+        for value in heapq.nsmallest(count, self._used, key=self._used.get):
+            del self._rows[value]
+            del self._used[value]
+
+    def get_or_create(self, value):
+        try:
+            return self.get(value), False
+        except self.model.DoesNotExist:
+            return self.model.objects.get_or_create(**{self.field: value})
+
+    def discard(self, obj):
+        with self._lock:
+            for value, cached in self._rows.items():
+                if cached.pk == obj.pk:
+                    del self._rows[value]
+                    del self._used[value]
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+            self._used.clear()
+
+
+priority_lookups = LookupCache(Priority, 'weight')
+project_lookups = LookupCache(Project, 'name')
+tag_lookups = LookupCache(Tag, 'tag')
+
+LOOKUP_CACHES = {
+    Priority: priority_lookups,
+    Project: project_lookups,
+    Tag: tag_lookups,
+}
+
+
 class DirtyFieldsMixin(object):
     """ Mixin for Models to track whether a model is 'dirty'.
+
+        The concrete fields (foreign keys by id) are recorded when the
+        instance is created, which doesn't need any queries. The state
+        of the relations is only recorded by `_snapshot_relations()`,
+        right before a relation is first changed. Until then the
+        relations are known to be unchanged, so read-only instances
+        never have to load them.
+
+        Fields named in `untracked_fields` are derived data and never
+        make the instance dirty.
     """
+    untracked_fields = ()
+
     def __init__(self, *args, **kwargs):
-        self._original_state = self._as_dict()
+        self._reset_state()
+
+    def _reset_state(self):
+        self._original_fields = self._field_state()
+        self._original_relations = None
+
+    def _field_state(self):
+        return dict((f.name, getattr(self, f.attname))
+                    for f in self._meta.local_fields
+                    if not f.primary_key and
+                       f.name not in self.untracked_fields)
+
+    def _relation_state(self):
+        """ Return a dict of the comparable state of the relations.
+        """
+        return {}
+
+    def _snapshot_relations(self):
+        if self._original_relations is None and self.pk:
+            self._original_relations = self._relation_state()
 
     def _as_dict(self):
         return self._todict()
 
-    def _get_dirty_fields(self):
-        new_state = self._as_dict()
-
+    def _get_dirty_fields(self, relations=None):
+        """ Return a dict of the fields that changed. `relations` is the
+            current `_relation_state()`, if the caller already has it.
+        """
         if not self.pk:
-            return new_state
+            return self._as_dict()
 
-        missing = object()
         result = {}
-        for key, value in new_state.iteritems():
-            if value != self._original_state.get(key, missing):
+        for key, value in self._field_state().iteritems():
+            if value != self._original_fields.get(key):
                 result[key] = value
 
+        if self._original_relations is not None:
+            if relations is None:
+                relations = self._relation_state()
+            for key, value in relations.iteritems():
+                if value != self._original_relations.get(key):
+                    result[key] = value
+
         return result
 
-    def _is_dirty(self):
+    def _is_dirty(self, relations=None):
         """ Return True if the data in the model is 'dirty', or
             not flushed to the db.
         """
-        if self._get_dirty_fields():
+        if self._get_dirty_fields(relations):
             return True
 
         return False
 
 
+class TaskQuerySet(models.query.QuerySet):
+    """ Marks the tasks it loads, whose rows are known to hold the
+        state the tasks start out with.
+    """
+    def iterator(self):
+        for task in super(TaskQuerySet, self).iterator():
+            task._loaded = True
+            yield task
+
+
+class TaskManager(models.Manager):
+    def get_query_set(self):
+        return TaskQuerySet(self.model, using=self._db)
+
+
 class Task(models.Model, DirtyFieldsMixin):
     """ Representation of a `taskwarrior` task.
     """
@@ -217,6 +807,24 @@ class Task(models.Model, DirtyFieldsMixin):
     dependencies = models.ManyToManyField('self', symmetrical=False,
                                             null=True, blank=True)
 
+    # summaries of the tags and annotations, so that listing tasks
+    # doesn't need the relations; kept up to date by `update_summaries()`
+    tags_summary = models.TextField(blank=True, editable=False)
+    annotation_count = models.PositiveIntegerField(default=0, editable=False)
+    latest_annotation = models.TextField(blank=True, editable=False)
+
+    # the version of the task's cached grid cells; see `task.fragments`
+    cell_version = models.CharField(max_length=32, editable=False,
+                                    default=fragments.new_version)
+
+    untracked_fields = SUMMARY_FIELDS + ('cell_version',)
+
+    # whether the row is known to hold the original fields, so that an
+    # unchanged task doesn't need saving; set for loaded and saved tasks
+    _loaded = False
+
+    objects = TaskManager()
+
     class Meta:
         get_latest_by = 'entry'
         ordering = ['-entry']
@@ -265,44 +873,268 @@ class Task(models.Model, DirtyFieldsMixin):
                 user=d['user'],
                 )
 
-        # add the priority
-        task.set_priority(d.get('priority'), track=False)
-
-        # add the project
-        task.set_project(d.get('project'), track=False)
+        # record the changes as one undo entry, if they're tracked
+        with undo_unit():
+            # add the priority
+            task.set_priority(d.get('priority'), track=False)
+
+            # add the project
+            task.set_project(d.get('project'), track=False)
+
+            # we have to save before we can add ManyToMany
+            if not task.pk:
+                task.save(track=track)
+
+            # add the tags (for some reason it is a list of tags now and
+            # not a comma-separated string --danny)
+            for tag in d.get('tags', ''):
+                if tag:
+                    task.add_tag(tag, track=False)
+
+            # dependencies
+            for dep in d.get('depends', '').split(','):
+                if dep:
+                    task.add_dependency(dep, track=False)
+
+            # add the annotations
+            annotations = []
+            for k, v in d.items():
+                if k.startswith('annotation'):
+                    note = {}
+                    note['note'] = v
+                    ts = int(k.split('_')[1])
+                    note['time'] = datetime.datetime.fromtimestamp(ts)
+                    annotations.append(note)
+
+            for note in annotations:
+                note.update({'track': False})
+                task.annotate(**note)
 
-        # we have to save before we can add ManyToMany
-        if not task.pk:
             task.save(track=track)
 
-        # add the tags (for some reason it is a list of tags now and
-        # not a comma-separated string --danny)
-        for tag in d.get('tags', ''):
-            if tag:
-                task.add_tag(tag, track=False)
-
-        # dependencies
-        for dep in d.get('depends', '').split(','):
-            if dep:
-                task.add_dependency(dep, track=False)
-
-        # add the annotations
-        annotations = []
-        for k, v in d.items():
-            if k.startswith('annotation'):
-                note = {}
-                note['note'] = v
-                ts = int(k.split('_')[1])
-                note['time'] = datetime.datetime.fromtimestamp(ts)
-                annotations.append(note)
-
-        for note in annotations:
-            note.update({'track': False})
-            task.annotate(**note)
+        return task
 
-        task.save(track=track)
+    @classmethod
+    def bulk_fromdict(cls, dicts, user):
+        """ Create or update the tasks in `dicts` for `user`.
+
+            This is the equivalent of calling `fromdict()` (without
+            tracking) for each task, except that priorities, projects,
+            tags and existing tasks are resolved with one query per
+            chunk, and the new rows are inserted with `bulk_create`,
+            all in a single transaction (the caller's, if there is one).
+            The relations of existing tasks are replaced by the ones in
+            `dicts`.
+
+            Returns the number of tasks that were created and updated.
+        """
+        now = datetime.datetime.now()
+
+        # the last occurrence of a uuid wins, like repeated `fromdict()`s
+        by_uuid = {}
+        uuids = []
+        for d in dicts:
+            uuid_ = d.get('uuid') or str(uuid.uuid4())
+            if uuid_ not in by_uuid:
+                uuids.append(uuid_)
+            by_uuid[uuid_] = d
+
+        with commit_on_success_unless_managed():
+            # a task whose status changed moves between files, so the
+            # file it was stored in changes too
+            existing = {}
+            statuses = set(d.get('status') for d in by_uuid.itervalues())
+            for chunk in chunked(uuids, CHUNK_SIZE):
+                rows = (cls.objects.filter(uuid__in=chunk)
+                                   .values_list('uuid', 'pk', 'status'))
+                for uuid_, pk, status in rows:
+                    existing[uuid_] = pk
+                    statuses.add(status)
+
+            for filename in set(taskdb_filename(status)
+                                for status in statuses):
+                TaskDbVersion.touch(user.pk, filename)
+
+            weights = set([0])
+            projects = set()
+            tags = set()
+            depends = set()
+            for d in by_uuid.itervalues():
+                weights.add(PRIORITY_MAP_R[d.get('priority') or ''])
+                if d.get('project'):
+                    projects.add(d['project'])
+                tags.update(split_tags(d.get('tags')))
+                depends.update(_split_depends(d.get('depends')))
+
+            weights = _bulk_get_or_create(Priority, 'weight', weights)
+            projects = _bulk_get_or_create(Project, 'name', projects)
+            tags = _bulk_get_or_create(Tag, 'tag', tags)
+
+            new = []
+            for uuid_ in uuids:
+                d = by_uuid[uuid_]
+                fields = {
+                    'description': d['description'],
+                    'status': d.get('status') or 'pending',
+                    'entry': ts2datetime(d.get('entry')) or now,
+                    'due': ts2datetime(d.get('due')),
+                    'end': ts2datetime(d.get('end')),
+                    'user': user,
+                    }
+                fields.update(_summary_fields(
+                    sorted(set(split_tags(d.get('tags'))), key=tags.get),
+                    [(ts2datetime(key.split('_')[1]), value)
+                        for key, value in d.items()
+                        if key.startswith('annotation')]))
+                project = projects.get(d.get('project'))
+                priority = weights[PRIORITY_MAP_R[d.get('priority') or '']]
+                if uuid_ in existing:
+                    cls.objects.filter(pk=existing[uuid_]).update(
+                            project=project, priority=priority, **fields)
+                else:
+                    new.append(cls(uuid=uuid_, project_id=project,
+                                   priority_id=priority, **fields))
+
+            cls.objects.bulk_create(new)
+
+            pks = _bulk_lookup(cls, 'uuid', depends.union(uuids))
+            pks.update(cls._bulk_placeholders(depends.difference(pks)))
+
+            for chunk in chunked(existing.values(), CHUNK_SIZE):
+                Annotation.objects.filter(task__in=chunk).delete()
+                cls.tags.through.objects.filter(task__in=chunk).delete()
+                cls.dependencies.through.objects.filter(
+                        from_task__in=chunk).delete()
+
+            task_tags = []
+            task_depends = []
+            notes = []
+            for uuid_ in uuids:
+                d = by_uuid[uuid_]
+                pk = pks[uuid_]
+                for tag in set(split_tags(d.get('tags'))):
+                    task_tags.append(cls.tags.through(task_id=pk,
+                                                      tag_id=tags[tag]))
+                for dep in set(_split_depends(d.get('depends'))):
+                    task_depends.append(cls.dependencies.through(
+                            from_task_id=pk, to_task_id=pks[dep]))
+                for key, value in d.items():
+                    if key.startswith('annotation'):
+                        notes.append((pk, ts2datetime(key.split('_')[1]),
+                                      value))
+
+            cls.tags.through.objects.bulk_create(task_tags)
+            cls.dependencies.through.objects.bulk_create(task_depends)
+            cls.bump_cells(existing.values())
+
+            # `bulk_create()` doesn't give us the new pks, and they
+            # needn't be handed out in order, so the new annotations are
+            # found again by their contents among the ones without a
+            # task; identical ones are interchangeable
+            Annotation.objects.bulk_create(
+                    [Annotation(time=time_, data=data)
+                        for (pk, time_, data) in notes])
+            unlinked = {}
+            times = set(time_ for (pk, time_, data) in notes)
+            for chunk in chunked(times, CHUNK_SIZE):
+                rows = (Annotation.objects.filter(time__in=chunk,
+                                                  task__isnull=True)
+                                          .order_by('pk')
+                                          .values_list('time', 'data', 'pk'))
+                for time_, data, apk in rows:
+                    unlinked.setdefault((time_, data), []).append(apk)
+            links = []
+            for pk, time_, data in notes:
+                apk = unlinked[time_, force_unicode(data)].pop()
+                links.append(cls.annotations.through(task_id=pk,
+                                                     annotation_id=apk))
+            cls.annotations.through.objects.bulk_create(links)
+
+            if search.enabled():
+                texts = dict((pk, []) for pk in pks.itervalues())
+                for pk, time_, data in sorted(notes):
+                    texts[pk].append(data)
+                search.delete(existing.values())
+                search.add([(pks[uuid_], by_uuid[uuid_]['description'],
+                             '\n'.join(texts[pks[uuid_]]))
+                            for uuid_ in uuids])
+
+        return len(new), len(existing)
 
-        return task
+    @classmethod
+    def _bulk_placeholders(cls, uuids):
+        """ Create an empty task for each of `uuids`, for dependencies
+            on tasks we don't know about yet, like `get_or_create_task()`
+            does. Returns a dict mapping the uuids to the new pks.
+        """
+        if not uuids:
+            return {}
+
+        now = datetime.datetime.now()
+        weights = _bulk_get_or_create(Priority, 'weight', [0])
+        cls.objects.bulk_create([cls(uuid=uuid_, description='',
+                                     status='pending', entry=now,
+                                     priority_id=weights[0])
+                                 for uuid_ in uuids])
+        return _bulk_lookup(cls, 'uuid', uuids)
+
+    @classmethod
+    def sync(cls, tasks, dicts, user):
+        """ Make the `tasks` queryset match the tasks in `dicts`.
+
+            Only the tasks that were added, changed or removed are
+            written, so tasks that are the same keep their rows (and
+            ids). Returns a dict with the number of tasks that were
+            `created`, `updated` and `deleted`.
+        """
+        stored = {}
+        for d in cls.bulk_todict(tasks):
+            stored[d['uuid']] = _comparable(d)
+
+        changed = []
+        seen = set()
+        for d in dicts:
+            uuid_ = d.get('uuid')
+            seen.add(uuid_)
+            if uuid_ not in stored or stored[uuid_] != _comparable(d):
+                changed.append(d)
+
+        with commit_on_success_unless_managed():
+            with batch_touches():
+                created, updated = cls.bulk_fromdict(changed, user)
+
+                removed = _bulk_lookup(cls, 'uuid',
+                                       set(stored).difference(seen))
+                # a removed task that a remaining one depends on has moved
+                # to the other file, most likely; rather than let the
+                # delete cascade to the dependency, it's pointed at a
+                # placeholder that the upload of the task fills in
+                links = cls.dependencies.through.objects
+                dependents = []
+                for chunk in chunked(removed.values(), CHUNK_SIZE):
+                    dependents.extend(links.filter(to_task__in=chunk)
+                                           .values_list('from_task',
+                                                        'to_task__uuid'))
+                removed_pks = set(removed.values())
+                dependents = [(pk, uuid_) for pk, uuid_ in dependents
+                              if pk not in removed_pks]
+
+                for chunk in chunked(removed.values(), CHUNK_SIZE):
+                    Annotation.objects.filter(task__in=chunk).delete()
+                    links.filter(to_task__in=chunk).delete()
+                    cls.objects.filter(pk__in=chunk).delete()
+                if search.enabled():
+                    search.delete(removed.values())
+
+                placeholders = cls._bulk_placeholders(
+                        set(uuid_ for pk, uuid_ in dependents))
+                links.bulk_create([links.model(from_task_id=pk,
+                                               to_task_id=placeholders[uuid_])
+                                   for pk, uuid_ in dependents])
+                cls.bump_cells(set(pk for pk, uuid_ in dependents))
+
+        return {'created': created, 'updated': updated,
+                'deleted': len(removed)}
 
     @undo
     def set_priority(self, priority):
@@ -312,7 +1144,7 @@ class Task(models.Model, DirtyFieldsMixin):
         if isinstance(priority, (str, unicode)):
             priority = PRIORITY_MAP_R[priority]
 
-        pri, created = Priority.objects.get_or_create(weight=priority)
+        pri, created = priority_lookups.get_or_create(priority)
         self.priority = pri
 
     @undo
@@ -321,18 +1153,18 @@ class Task(models.Model, DirtyFieldsMixin):
             self.project = None
             return
 
-        proj, created = Project.objects.get_or_create(name=project)
+        proj, created = project_lookups.get_or_create(project)
         self.project = proj
 
     @undo
     def add_tag(self, tag):
-        tag, created = Tag.objects.get_or_create(tag=tag)
+        tag, created = tag_lookups.get_or_create(tag)
         self.tags.add(tag)
 
     @undo
     def remove_tag(self, tag):
         try:
-            tag = Tag.objects.get(tag=tag)
+            tag = tag_lookups.get(tag)
         except Tag.DoesNotExist:
             return
         self.tags.remove(tag)
@@ -360,8 +1192,13 @@ class Task(models.Model, DirtyFieldsMixin):
     def save(self, *args, **kwargs):
         """ Automatically populate optional fields if they haven't been
             specified in __init__.
+
+            The row of a saved task is only written if one of its fields
+            changed, so saving an unchanged task doesn't touch the taskdb
+            versions or the cached grid cells.
         """
         track = kwargs.pop('track', True)
+        in_unit = track and _begin_undo(self)
 
         if not self.uuid:
             self.uuid = str(uuid.uuid4())
@@ -372,80 +1209,478 @@ class Task(models.Model, DirtyFieldsMixin):
         if not self.entry:
             self.entry = datetime.datetime.now()
 
-        if not self.priority:
-            self.priority = Priority.objects.get_or_create(weight=0)[0]
+        if not self.priority_id:
+            self.priority = priority_lookups.get_or_create(0)[0]
 
+        # saving only writes the task row, so the relations are read
+        # at most once and shared by the old and new states
         data = {}
-        is_dirty = self._is_dirty()
-        if self.pk and is_dirty:
-            old = self._original_state
-            data['old'] = encode_task(old)
-
-        super(Task, self).save(*args, **kwargs)
-
-        if track and is_dirty:
+        relations = None
+        is_dirty = False
+        if track and not in_unit:
+            if self._original_relations is not None:
+                relations = self._relation_state()
+            is_dirty = self._is_dirty(relations)
+
+        if is_dirty:
+            if not self.pk:
+                # a new task can't have any relations yet
+                relations = {'tags': [], 'annotations': [],
+                             'dependencies': []}
+            elif relations is None:
+                relations = self._relation_state()
+            if self.pk:
+                data['old'] = encode_task(self._original_todict(relations))
+
+        if not self.pk or args or kwargs:
+            # a new task, or one saved with options only `Model.save()`
+            # understands
+            if self.pk:
+                self.cell_version = fragments.new_version()
+            super(Task, self).save(*args, **kwargs)
+        elif (not self._loaded or
+                self._field_state() != self._original_fields):
+            # a task built with a pk may differ from the row in anything
+            self._save_row()
+
+        if is_dirty:
             # add to undo table
-            data['new'] = encode_task(self.todict())
+            data['new'] = encode_task(self.todict(relations))
             data['user'] = self.user
             Undo.objects.create(**data)
 
-        self._original_state = self._as_dict()
+        self._reset_state()
+        self._loaded = True
+
+    def _save_row(self):
+        """ Write the row of a saved task, leaving out the summaries.
+            They may have been updated through another instance, so they
+            aren't overwritten with stale values (or read back first).
+
+            Django 1.4's `Model.save()` can't write only some of the
+            columns, so the save signals are sent here, once the row is
+            known to exist. If it's gone, `Model.save()` stores it again
+            and sends them itself.
+        """
+        using = router.db_for_write(Task, instance=self)
+        self.cell_version = fragments.new_version()
+        values = dict((f.name, f.pre_save(self, False))
+                      for f in self._meta.local_fields
+                      if not f.primary_key and f.name not in SUMMARY_FIELDS)
+        if not Task.objects.using(using).filter(pk=self.pk).update(**values):
+            super(Task, self).save(force_insert=True, using=using)
+            return
 
-    def _todict(self):
-        # TODO: This is ugly, i need  to find a better way...
-        task = {}
-        for fieldname in self._meta.get_all_field_names():
-            if fieldname in ['task', 'id']:
-                # skip these fields
-                continue
+        pre_save.send(sender=Task, instance=self, raw=False, using=using)
+        post_save.send(sender=Task, instance=self, created=False, raw=False,
+                       using=using)
 
+    def _field_values(self):
+        """ Return the raw values of the fields stored on the task row.
+        """
+        values = {}
+        for fieldname in TASKW_FIELDS:
             try:
-                value = getattr(self, fieldname)
+                values[fieldname] = getattr(self, fieldname)
             except ValueError:
-                value = None
-
-            if value:
-                if fieldname in ['end', 'entry', 'due']:
-                    value = int(datetime2ts(value))
-                elif isinstance(value, list):
-                    value = ','.join(value)
-                elif fieldname == 'dependencies':
-                    value = ','.join([t.uuid for t in value.all().order_by('pk')])
-                    if value:
-                        task['depends'] = value
-                    continue
-                elif fieldname == 'annotations':
-                    for annotation in value.all():
-                        key = 'annotation_%s' % datetime2ts(annotation.time)
-                        task[key] = annotation.data
-                    continue
-                elif fieldname == 'tags':
-                    value = ','.join([t.tag for t in value.all()])
+                values[fieldname] = None
 
-                if value and str(value):
-                    task[fieldname] = str(value)
+        return values
 
-        return task
+    def _relation_state(self):
+        return {
+            'tags': list(self.tags.order_by('pk')
+                                  .values_list('tag', flat=True)),
+            'annotations': list(self.annotations.values_list('time', 'data')),
+            'dependencies': list(self.dependencies.order_by('pk')
+                                                  .values_list('uuid', flat=True)),
+            }
 
-    def todict(self):
-        d = self._todict()
+    def _todict(self, relations=None):
+        if not self.pk:
+            # relations can't be used before the task is saved
+            return taskw_dict(self._field_values())
+
+        if relations is None:
+            relations = self._relation_state()
+        return taskw_dict(self._field_values(), relations['tags'],
+                          relations['annotations'], relations['dependencies'])
+
+    def _original_todict(self, relations=None):
+        """ Return `_todict()` as it was when the state of the task
+            was last recorded. `relations` is the current
+            `_relation_state()`, if the caller already has it.
+        """
+        values = {}
+        for fieldname in TASKW_FIELDS:
+            field = self._meta.get_field(fieldname)
+            value = self._original_fields[fieldname]
+            if value is not None and field.rel:
+                if value == getattr(self, field.attname):
+                    value = getattr(self, fieldname)
+                else:
+                    try:
+                        value = field.rel.to._default_manager.get(pk=value)
+                    except field.rel.to.DoesNotExist:
+                        value = None
+            values[fieldname] = value
+
+        if self._original_relations is not None:
+            relations = self._original_relations
+        elif relations is None:
+            # not changed since the state was recorded
+            relations = self._relation_state()
+
+        return taskw_dict(values, relations['tags'],
+                          relations['annotations'], relations['dependencies'])
+
+    def todict(self, relations=None):
+        d = self._todict(relations)
         d.pop('user', None)  # not a valid field for taskwarrior
         return d
 
     @classmethod
-    def serialize(cls, status=None):
-        """ Serialze the tasks to a string suitable for taskwarrior.
+    def update_summaries(cls, pks):
+        """ Recompute the tag and annotation summaries of the tasks in
+            `pks` from their relations, writing the ones that changed.
+
+            Returns a dict mapping the pk of each changed task to its
+            new summary fields.
+        """
+        changed = {}
+        for chunk in chunked(pks, CHUNK_SIZE):
+            tags = group_by_task(cls.tags.through.objects
+                        .filter(task__in=chunk)
+                        .order_by('tag')
+                        .values_list('task', 'tag__tag'))
+            annotations = group_by_task(cls.annotations.through.objects
+                        .filter(task__in=chunk)
+                        .values_list('task', 'annotation__time',
+                                     'annotation__data'))
+            current = cls.objects.filter(pk__in=chunk).values_list(
+                    'pk', *SUMMARY_FIELDS)
+
+            for row in current:
+                pk = row[0]
+                fields = _summary_fields(
+                        [t for (t,) in tags.get(pk, ())],
+                        annotations.get(pk, ()))
+                if row[1:] != tuple(fields[name] for name in SUMMARY_FIELDS):
+                    cls.objects.filter(pk=pk).update(**fields)
+                    changed[pk] = fields
+
+        return changed
+
+    @classmethod
+    def bump_cells(cls, pks):
+        """ Drop the grid cells cached for the tasks in `pks`, by giving
+            them a new `cell_version`.
+        """
+        version = fragments.new_version()
+        for chunk in chunked(pks, CHUNK_SIZE):
+            cls.objects.filter(pk__in=chunk).update(cell_version=version)
+
+    @classmethod
+    def update_search_index(cls, pks):
+        """ Index the description and annotations of the tasks in `pks`
+            for full-text search, if the database has a search index.
+        """
+        if not search.enabled():
+            return
+
+        for chunk in chunked(pks, CHUNK_SIZE):
+            notes = group_by_task(cls.annotations.through.objects
+                        .filter(task__in=chunk)
+                        .order_by('annotation__time')
+                        .values_list('task', 'annotation__data'))
+            rows = [(pk, description,
+                     '\n'.join(data for (data,) in notes.get(pk, ())))
+                    for (pk, description) in cls.objects.filter(pk__in=chunk)
+                                            .values_list('pk', 'description')]
+            search.delete(chunk)
+            search.add(rows)
+
+    @classmethod
+    def working_set_ids(cls, users):
+        """ Return a dict mapping the pk of each pending task of `users`
+            (user ids, or None for tasks without a user) to the id
+            `taskwarrior` gives it: its position in the user's
+            pending.data, counting from 1.
+        """
+        query = models.Q(user__in=[user for user in users if user is not None])
+        if None in users:
+            query |= models.Q(user__isnull=True)
+
+        tasks = (cls.objects.filter(query, status='pending')
+                            .order_by('user', 'entry', 'id')
+                            .values_list('pk', 'user'))
+        ids = {}
+        last_user = object()
+        for pk, user in tasks:
+            if user != last_user:
+                last_user = user
+                position = 0
+            position += 1
+            ids[pk] = position
+
+        return ids
+
+    @classmethod
+    def bulk_todict(cls, tasks, chunk_size=CHUNK_SIZE):
+        """ Yield `todict()` for every task in the `tasks` queryset.
+
+            Rather than querying the relations of each task separately,
+            the tasks are read `chunk_size` rows at a time and the tags,
+            annotations and dependencies of a chunk are loaded with one
+            query each. The tags are read from the relation rather than
+            `tags_summary`, so that a summary that's out of date can't
+            lose tags on the client's next sync.
+        """
+        rows = tasks.values_list('pk', 'description', 'due', 'end', 'entry',
+                                 'priority__weight', 'project__name',
+                                 'status', 'uuid')
+
+        for chunk in chunked(rows.iterator(), chunk_size):
+            ids = [row[0] for row in chunk]
+            tags = group_by_task(cls.tags.through.objects
+                        .filter(task__in=ids)
+                        .order_by('tag')
+                        .values_list('task', 'tag__tag'))
+            annotations = group_by_task(cls.annotations.through.objects
+                        .filter(task__in=ids)
+                        .order_by('-annotation__time')
+                        .values_list('task', 'annotation__time',
+                                     'annotation__data'))
+            depends = group_by_task(cls.dependencies.through.objects
+                        .filter(from_task__in=ids)
+                        .order_by('to_task')
+                        .values_list('from_task', 'to_task__uuid'))
+
+            for (pk, description, due, end, entry, weight, project,
+                    status, uuid) in chunk:
+                fields = {
+                    'description': description,
+                    'due': due,
+                    'end': end,
+                    'entry': entry,
+                    'priority': PRIORITY_MAP.get(weight),
+                    'project': project,
+                    'status': status,
+                    'uuid': uuid,
+                    }
+                yield taskw_dict(fields,
+                                 [t for (t,) in tags.get(pk, ())],
+                                 annotations.get(pk, ()),
+                                 [d for (d,) in depends.get(pk, ())])
+
+    @classmethod
+    def iterserialize(cls, status=None, user=None, chunk_size=CHUNK_SIZE):
+        """ Yield the tasks serialized for taskwarrior, `chunk_size`
+            tasks at a time, without loading the whole queryset.
         """
         if status is None:
-            tasks = cls.objects.order_by('entry')
+            tasks = cls.objects.order_by('entry', 'id')
         else:
-            tasks = cls.objects.filter(status=status).order_by('entry')
+            tasks = cls.objects.filter(status=status).order_by('entry', 'id')
 
-        data = ''
-        for task in tasks:
-            data += encode_task(task.todict())
+        if user is not None:
+            tasks = tasks.filter(user=user)
+
+        tasks = cls.bulk_todict(tasks, chunk_size)
+        for chunk in chunked(tasks, chunk_size):
+            yield ''.join(encode_task(task) for task in chunk)
+
+    @classmethod
+    def serialize(cls, status=None, user=None):
+        """ Serialze the tasks to a string suitable for taskwarrior.
+        """
+        return ''.join(cls.iterserialize(status, user))
+
+
+def snapshot_task_relations(sender, instance, action, reverse, **kwargs):
+    """ Record the relations of a task before they are first changed.
+    """
+    if not reverse and action in ('pre_add', 'pre_remove', 'pre_clear'):
+        instance._snapshot_relations()
+
+
+for through in (Task.tags.through, Task.annotations.through,
+                Task.dependencies.through):
+    m2m_changed.connect(snapshot_task_relations, sender=through)
+
+
+def touch_task(sender, instance, **kwargs):
+    """ Bump the versions of the taskdb files a changed task is (or
+        was) stored in.
+    """
+    statuses = set([instance.status, instance._original_fields['status']])
+    for status in statuses:
+        if status:
+            TaskDbVersion.touch(instance.user_id, taskdb_filename(status))
 
-        return data
+
+def _touch_tasks(tasks):
+    for user_id, status in set(tasks.values_list('user', 'status')):
+        TaskDbVersion.touch(user_id, taskdb_filename(status))
+
+
+TASK_RELATIONS = dict((getattr(Task, name).through, name)
+                      for name in ('tags', 'annotations', 'dependencies'))
+
+
+def touch_task_relations(sender, instance, action, reverse, pk_set,
+                         **kwargs):
+    if not reverse:
+        if action.startswith('post_'):
+            touch_task(sender, instance)
+    elif action in ('post_add', 'post_remove'):
+        _touch_tasks(Task.objects.filter(pk__in=pk_set))
+    elif action == 'pre_clear':
+        _touch_tasks(Task.objects.filter(**{TASK_RELATIONS[sender]: instance}))
+
+
+def touch_related_tasks(sender, instance, **kwargs):
+    """ Bump the versions of the taskdb files of the tasks with a changed
+        annotation, tag or project, which are written out with them.
+    """
+    name = {Annotation: 'annotations', Tag: 'tags', Project: 'project'}
+    _touch_tasks(Task.objects.filter(**{name[sender]: instance}))
+
+
+def touch_undo(sender, instance, **kwargs):
+    TaskDbVersion.touch(instance.user_id, 'undo.data')
+
+
+def update_task_summaries(sender, instance, action, reverse, pk_set,
+                          **kwargs):
+    """ Keep the tag and annotation summaries of tasks in step with
+        their relations.
+    """
+    if not reverse:
+        if action.startswith('post_'):
+            changed = Task.update_summaries([instance.pk])
+            for name, value in changed.get(instance.pk, {}).items():
+                setattr(instance, name, value)
+    elif action in ('post_add', 'post_remove'):
+        Task.update_summaries(pk_set)
+    elif action == 'pre_clear':
+        instance._related_tasks = _related_tasks(sender, instance)
+    elif action == 'post_clear':
+        Task.update_summaries(instance._related_tasks)
+
+
+def _related_tasks(sender, instance):
+    """ Return the pks of the tasks related to a tag or annotation (or
+        through `sender`), or the ones collected before it was deleted.
+    """
+    tasks = getattr(instance, '_related_tasks', None)
+    if tasks is None:
+        name = TASK_RELATIONS.get(sender) or (sender is Tag and 'tags'
+                                              or 'annotations')
+        tasks = list(Task.objects.filter(**{name: instance})
+                                 .values_list('pk', flat=True))
+    return tasks
+
+
+def collect_related_tasks(sender, instance, **kwargs):
+    """ Remember the tasks of a tag or annotation that's about to be
+        deleted, to update them afterwards.
+    """
+    instance._related_tasks = _related_tasks(sender, instance)
+
+
+def update_related_task_summaries(sender, instance, **kwargs):
+    Task.update_summaries(_related_tasks(sender, instance))
+
+
+def update_task_search_index(sender, instance, created=False, **kwargs):
+    """ Reindex a task whose description changed.
+    """
+    if (created or instance.description !=
+            instance._original_fields['description']):
+        Task.update_search_index([instance.pk])
+
+
+def remove_task_search_index(sender, instance, **kwargs):
+    if search.enabled():
+        search.delete([instance.pk])
+
+
+def update_task_annotations_search_index(sender, instance, action, reverse,
+                                         pk_set, **kwargs):
+    if not reverse:
+        if action.startswith('post_'):
+            Task.update_search_index([instance.pk])
+    elif action in ('post_add', 'post_remove'):
+        Task.update_search_index(pk_set)
+    elif action == 'post_clear':
+        Task.update_search_index(instance._related_tasks)
+
+
+def update_related_search_index(sender, instance, **kwargs):
+    Task.update_search_index(_related_tasks(sender, instance))
+
+
+def bump_task_row_relations(sender, instance, action, reverse, pk_set,
+                            **kwargs):
+    """ Drop the grid cells cached for a task whose relations changed.
+        (Saving a task gives it a new cell version itself.)
+    """
+    if not reverse:
+        if action.startswith('post_'):
+            Task.bump_cells([instance.pk])
+    elif action in ('post_add', 'post_remove'):
+        Task.bump_cells(pk_set)
+    elif action == 'pre_clear':
+        tasks = Task.objects.filter(**{TASK_RELATIONS[sender]: instance})
+        Task.bump_cells(tasks.values_list('pk', flat=True))
+
+
+def bump_related_task_rows(sender, instance, **kwargs):
+    """ Drop the grid cells of the tasks showing a changed annotation
+        or tag.
+    """
+    name = sender is Tag and 'tags' or 'annotations'
+    Task.bump_cells(Task.objects.filter(**{name: instance})
+                                .values_list('pk', flat=True))
+
+
+post_save.connect(touch_task, sender=Task)
+post_delete.connect(touch_task, sender=Task)
+for through in TASK_RELATIONS:
+    m2m_changed.connect(touch_task_relations, sender=through)
+for model in (Annotation, Tag, Project):
+    post_save.connect(touch_related_tasks, sender=model)
+    pre_delete.connect(touch_related_tasks, sender=model)
+post_save.connect(touch_undo, sender=Undo)
+post_delete.connect(touch_undo, sender=Undo)
+for through in (Task.tags.through, Task.annotations.through):
+    m2m_changed.connect(update_task_summaries, sender=through)
+for model in (Tag, Annotation):
+    post_save.connect(update_related_task_summaries, sender=model)
+    pre_delete.connect(collect_related_tasks, sender=model)
+    post_delete.connect(update_related_task_summaries, sender=model)
+post_save.connect(update_task_search_index, sender=Task)
+post_delete.connect(remove_task_search_index, sender=Task)
+m2m_changed.connect(update_task_annotations_search_index,
+                    sender=Task.annotations.through)
+post_save.connect(update_related_search_index, sender=Annotation)
+post_delete.connect(update_related_search_index, sender=Annotation)
+for through in TASK_RELATIONS:
+    m2m_changed.connect(bump_task_row_relations, sender=through)
+post_save.connect(bump_related_task_rows, sender=Annotation)
+pre_delete.connect(bump_related_task_rows, sender=Annotation)
+post_save.connect(bump_related_task_rows, sender=Tag)
+pre_delete.connect(bump_related_task_rows, sender=Tag)
+
+
+def discard_lookup(sender, instance, **kwargs):
+    LOOKUP_CACHES[sender].discard(instance)
+
+
+for model in LOOKUP_CACHES:
+    post_save.connect(discard_lookup, sender=model)
+    post_delete.connect(discard_lookup, sender=model)
 
 
 def create_user_profile(sender, instance, created, **kwargs):
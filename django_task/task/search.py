@@ -0,0 +1,122 @@
+""" Full-text search over task descriptions and annotations.
+
+    On SQLite the text of each task is kept in an FTS5 table whose rowid
+    is the task's id, and searches are ranked by it. Other databases, or
+    SQLite builds without FTS5, fall back to case-insensitive matching
+    of every word, without ranking.
+"""
+import operator
+import re
+
+from django.db import connection, transaction, DatabaseError
+from django.db.models import Q
+
+from task.util import chunked
+
+FTS_TABLE = 'task_search'
+
+# the number of rows written with one statement
+CHUNK_SIZE = 500
+
+_enabled = None
+
+
+def create_index():
+    """ Create the FTS table if the database supports it.
+    """
+    global _enabled
+    # DDL commits the transaction that's in progress on SQLite
+    if connection.vendor != 'sqlite' or enabled():
+        return
+
+    cursor = connection.cursor()
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING "
+                       "fts5(description, annotations, "
+                       "tokenize='porter unicode61')"
+                       % connection.ops.quote_name(FTS_TABLE))
+    except DatabaseError:
+        # no FTS5 in this build of SQLite
+        transaction.rollback_unless_managed()
+        return
+
+    transaction.commit_unless_managed()
+    _enabled = True
+
+
+def enabled():
+    """ Return True if searches use the FTS table.
+    """
+    global _enabled
+    if _enabled is None:
+        _enabled = (connection.vendor == 'sqlite' and
+                    FTS_TABLE in connection.introspection.table_names())
+    return _enabled
+
+
+def delete(pks):
+    """ Remove the tasks in `pks` from the index.
+    """
+    cursor = connection.cursor()
+    for chunk in chunked(pks, CHUNK_SIZE):
+        cursor.execute('DELETE FROM %s WHERE rowid IN (%s)' % (
+                connection.ops.quote_name(FTS_TABLE),
+                ', '.join(['%s'] * len(chunk))), chunk)
+
+
+def add(rows):
+    """ Index `(pk, description, annotations)` rows, which must not
+        be in the index already.
+    """
+    cursor = connection.cursor()
+    cursor.executemany('INSERT INTO %s (rowid, description, annotations) '
+                       'VALUES (%%s, %%s, %%s)'
+                       % connection.ops.quote_name(FTS_TABLE), rows)
+
+
+def words(text):
+    return re.findall(r'\w+', text, re.UNICODE)
+
+
+def fts_query(text):
+    """ Turn the words of `text` into an FTS5 query matching the tasks
+        containing all of them, the last one as a prefix.
+    """
+    terms = ['"%s"' % word for word in words(text)]
+    if terms:
+        terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def filter_tasks(tasks, text):
+    """ Return the tasks in the `tasks` queryset matching `text`, the
+        best matches first if the FTS table is available.
+    """
+    if not words(text):
+        return tasks.none()
+
+    if not enabled():
+        return _filter_words(tasks, text)
+
+    qn = connection.ops.quote_name
+    return tasks.extra(
+            select={'search_rank': '%s.rank' % qn(FTS_TABLE)},
+            tables=[FTS_TABLE],
+            where=['%s.rowid = %s.%s' % (qn(FTS_TABLE),
+                                         qn(tasks.model._meta.db_table),
+                                         qn(tasks.model._meta.pk.column)),
+                   '%s MATCH %%s' % qn(FTS_TABLE)],
+            params=[fts_query(text)]).order_by('search_rank')
+
+
+def _filter_words(tasks, text):
+    """ The fallback without the FTS table: the tasks whose description
+        or an annotation contains each word, in a single filter. The
+        annotations are matched in a subquery, so no task is repeated.
+    """
+    annotated = tasks.model.annotations.through.objects
+    return tasks.filter(reduce(operator.and_, [
+            Q(description__icontains=word) |
+            Q(pk__in=annotated.filter(annotation__data__icontains=word)
+                              .values('task'))
+            for word in words(text)]))
@@ -1,18 +1,51 @@
 """ Various tests for taskweb
 """
+import datetime
+import json
 import os
-
-from django.test import TestCase
-from django.contrib.auth.models import User
-
-from task.models import Task, Tag, Undo, Priority, Project
-from task.util import parse_undo
-from task.grids import IDColumn, DescriptionWithAnnotationColumn
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase
+from django.utils import unittest
+from django.test.client import RequestFactory
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache, get_cache
+from django.db import connection, transaction
+from django.db.models.signals import pre_save, post_save
+from django.db.models.sql import Query
+
+from taskw import decode_task
+
+from task.models import (Task, Tag, Undo, UndoArchive, Annotation, Priority,
+                         Project, TaskDbVersion, LOOKUP_CACHES, encode_task,
+                         datetime2ts, ts2datetime, undo_unit)
+from task.util import parse_undo, iterparse_undo, iterlines, Reiterable
+from task.grids import (IDColumn, DescriptionWithAnnotationColumn,
+                        TaskDataGrid)
+from task import archive
+from task import models
 from task import forms
+from task import fragments
+from task import graph
+from task import cache as taskdb_cache
+from task import search
+from task import facets as task_facets
+from task import filters
+from task.facets import facets
 
 TASK_DATA = os.path.join(os.path.dirname(__file__), 'data')
 
 class TaskTestCase(TestCase):
+    def setUp(self):
+        # the caches aren't rolled back with the database
+        cache.clear()
+        for lookups in LOOKUP_CACHES.values():
+            lookups.clear()
+
     def create_user(self, username='foo', passw='baz'):
         users = User.objects.filter(username=username)
         if users:
@@ -73,9 +106,30 @@ class TestGrids(TaskTestCase):
         for x in range(1, 3):
             Task.objects.get(id=x).delete()
 
+        # the ids are worked out once per request
+        column.reset()
         value = column.render_data(Task.objects.get(id=3))
         self.assertEqual(value, 1)
 
+    def test_idcolumn_working_set(self):
+        """ ids are numbered per user, skip completed tasks, and are
+            looked up once for the whole page.
+        """
+        user = self.create_user()
+        other = self.create_user('bar')
+        for x in range(3):
+            Task.objects.create(description='test %s' % x, user=user)
+            Task.objects.create(description='other %s' % x, user=other)
+        Task.objects.get(description='test 0').done()
+
+        column = IDColumn('id_', field_name='id')
+        tasks = list(Task.objects.order_by('id'))
+        with self.assertNumQueries(1):
+            column.collect_objects(tasks)
+            values = [column.render_data(task) for task in tasks]
+
+        self.assertEqual(values, ['-', 1, 1, 2, 2, 3])
+
     def test_description_column(self):
         from django.utils.html import urlize
 
@@ -91,6 +145,162 @@ class TestGrids(TaskTestCase):
         value = column.render_data(Task.objects.get(id=1))
         self.assertIn(urlize(annotation_str), value)
 
+    def _grid(self, query_string=''):
+        request = RequestFactory().get('/completed/' + query_string)
+        request.user = AnonymousUser()
+        grid = TaskDataGrid(request)
+        grid.paginate_by = 3
+        grid.load_state()
+        return grid
+
+    def _walk(self, url, link):
+        """ Follows the grid's `link` from `url`, returning the ids on
+            each page and the last grid.
+        """
+        pages = []
+        while url is not None:
+            grid = self._grid(url)
+            pages.append([row['object'].pk for row in grid.rows])
+            url = getattr(grid, link)
+        return pages, grid
+
+    def _assert_keyset_pages(self, sort, expected):
+        pages, last = self._walk('?sort=%s' % sort, 'next_url')
+        self.assertIsNone(last.page)
+        self.assertEqual(sum(pages, []), expected)
+        self.assertTrue(all(len(page) == 3 for page in pages[:-1]))
+
+        # and back again from the last page
+        back, first = self._walk(last.previous_url, 'previous_url')
+        self.assertEqual(back[::-1] + pages[-1:], pages)
+        self.assertIsNone(first.previous_url)
+
+    def test_keyset_pages(self):
+        user = self.create_user()
+        end = datetime.datetime(2012, 1, 1)
+        for x in range(8):
+            Task.objects.create(description='test %s' % x, user=user,
+                                status='completed',
+                                end=end + datetime.timedelta(days=x % 3))
+        tasks = Task.objects.all()
+        expected = sorted(tasks, key=lambda t: (t.end, t.pk), reverse=True)
+        self._assert_keyset_pages('-end', [t.pk for t in expected])
+
+    def test_keyset_pages_nulls_last(self):
+        user = self.create_user()
+        due = datetime.datetime(2012, 1, 1)
+        priorities = list(Priority.objects.all())
+        for x in range(10):
+            Task.objects.create(description='test %s' % x, user=user,
+                                due=(due + datetime.timedelta(x % 2)
+                                     if x % 3 else None),
+                                priority=priorities[x % 4])
+        tasks = Task.objects.all()
+
+        expected = sorted(tasks, key=lambda t: (t.due is None, t.due, t.pk))
+        self._assert_keyset_pages('due,id_', [t.pk for t in expected])
+
+        # the tasks without a due date still come last
+        expected = sorted(tasks, key=lambda t: (t.due is None, t.due, t.pk),
+                          reverse=True)
+        expected = ([t for t in expected if t.due is not None] +
+                    [t for t in expected if t.due is None])
+        self._assert_keyset_pages('-due,id_', [t.pk for t in expected])
+
+        expected = sorted(tasks, key=lambda t: (-t.priority.weight, t.pk))
+        self._assert_keyset_pages('priority,id_', [t.pk for t in expected])
+
+    def test_keyset_cursor_from_another_sort(self):
+        user = self.create_user()
+        for x in range(5):
+            Task.objects.create(description='test %s' % x, user=user)
+
+        grid = self._grid('?sort=-id_&after=id_:3')
+        self.assertEqual([row['object'].pk for row in grid.rows], [5, 4, 3])
+
+    def test_offset_pages_for_relations(self):
+        grid = self._grid('?sort=project')
+        self.assertIsNotNone(grid.page)
+
+    def test_cached_cells(self):
+        """ a row's cells are rendered again only once the task, its
+            tags or its annotations change.
+        """
+        user = self.create_user()
+        task = Task.objects.create(description='first', user=user)
+        other = Task.objects.create(description='other', user=user)
+
+        def descriptions():
+            grid = self._grid('?columns=description,tags')
+            return ''.join(row['cells'][0] for row in grid.rows)
+
+        self.assertIn('first', descriptions())
+
+        # updates skip the signals, so the old cell is still used
+        Task.objects.filter(pk=task.pk).update(description='second')
+        Task.objects.filter(pk=other.pk).update(description='changed')
+        self.assertIn('first', descriptions())
+
+        # saving a task that didn't change doesn't either
+        task = Task.objects.get(pk=task.pk)
+        task.save()
+        self.assertIn('first', descriptions())
+
+        task.description = 'third'
+        task.save()
+        self.assertIn('third', descriptions())
+        self.assertIn('other', descriptions())
+
+        Task.objects.get(pk=other.pk).annotate('note')
+        self.assertIn('changed', descriptions())
+        self.assertIn('note', descriptions())
+
+    def test_cached_cells_other_process(self):
+        """ a task changed by a process with a cache of its own has its
+            cells rendered again.
+        """
+        user = self.create_user()
+        task = Task.objects.create(description='first', user=user)
+        grid = self._grid('?columns=description')
+        self.assertIn('first', grid.rows[0]['cells'][0])
+
+        local_cache = fragments.cache
+        fragments.cache = get_cache(
+                'django.core.cache.backends.locmem.LocMemCache',
+                LOCATION='other-process')
+        try:
+            task.description = 'second'
+            task.save()
+        finally:
+            fragments.cache = local_cache
+
+        grid = self._grid('?columns=description')
+        self.assertIn('second', grid.rows[0]['cells'][0])
+
+    def test_cached_cells_annotations(self):
+        """ annotations are only read for the rows that are rendered.
+        """
+        user = self.create_user()
+        for x in range(3):
+            task = Task.objects.create(description='task %s' % x, user=user)
+            task.annotate('note %s' % x)
+
+        def annotation_queries():
+            use_debug_cursor = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+            try:
+                start = len(connection.queries)
+                grid = self._grid('?columns=description')
+                queries = connection.queries[start:]
+            finally:
+                connection.use_debug_cursor = use_debug_cursor
+            self.assertEqual(
+                ['note' in row['cells'][0] for row in grid.rows], [True] * 3)
+            return [q['sql'] for q in queries if 'task_annotation' in q['sql']]
+
+        self.assertEqual(len(annotation_queries()), 1)
+        self.assertEqual(annotation_queries(), [])
+
 
 class TestTaskModel(TaskTestCase):
     def test_create_task_no_params(self):
@@ -141,6 +351,68 @@ class TestTaskModel(TaskTestCase):
         self.assertEqual(len(Undo.serialize().splitlines()), 7)
         self.assertNotIn('annotation_', Undo.serialize().splitlines()[4])
 
+    def test_undo_unit(self):
+        user = self.create_user()
+        task = Task.objects.create(description='foobar', user=user)
+        other = Task.objects.create(description='other', user=user)
+
+        with undo_unit(task):
+            task.description = 'foobaz'
+            task.set_priority('H')
+            task.set_project('home')
+            for x in range(5):
+                task.add_tag('tag%s' % x)
+            task.annotate('note')
+            task.save()
+            with undo_unit():
+                other.done()
+
+        undos = list(Undo.objects.order_by('pk'))[2:]
+        self.assertEqual(len(undos), 2)
+        undo = [u for u in undos if 'foobaz' in u.new][0]
+        self.assertIn('description:"foobar"', undo.old)
+        self.assertNotIn('tags:', undo.old)
+        self.assertIn('priority:"H"', undo.new)
+        self.assertIn('project:"home"', undo.new)
+        self.assertIn('annotation_', undo.new)
+
+    def test_undo_unit_unchanged(self):
+        user = self.create_user()
+        task = Task.objects.create(description='foobar', user=user)
+        with undo_unit(task):
+            task.add_tag('tag1')
+            task.remove_tag('tag1')
+            task.save()
+        self.assertEqual(Undo.objects.count(), 1)
+
+    def test_undo_unit_error(self):
+        user = self.create_user()
+        task = Task.objects.create(description='foobar', user=user)
+        try:
+            with undo_unit():
+                task.add_tag('tag1')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(Undo.objects.count(), 1)
+
+        # the unit is over, so changes are tracked one by one again
+        task.add_tag('tag2')
+        self.assertEqual(Undo.objects.count(), 2)
+
+    def test_lookup_cache_invalidation(self):
+        lookups = LOOKUP_CACHES[Project]
+        project = Project.objects.create(name='home')
+        self.assertEqual(lookups.get('home'), project)
+
+        project.name = 'work'
+        project.save()
+        self.assertRaises(Project.DoesNotExist, lookups.get, 'home')
+        self.assertEqual(lookups.get('work').name, 'work')
+
+        project.delete()
+        self.assertRaises(Project.DoesNotExist, lookups.get, 'work')
+
     def test_task_saving_without_data_change(self):
         """ Make sure that saving a task twice without
             a change in data doesn't create duplicate Undo's
@@ -151,6 +423,74 @@ class TestTaskModel(TaskTestCase):
         task.save()
         self.assertEqual(len(Undo.objects.all()), 1)
 
+    def test_task_save_with_pk(self):
+        """ A task built with the pk of a stored one overwrites it, even
+            though nothing changed since it was built.
+        """
+        user = self.create_user()
+        task = Task.objects.create(description='orig', user=user)
+        task.add_tag('tag1')
+        Task(pk=task.pk, uuid=task.uuid, description='overwrite', user=user,
+             entry=task.entry, priority=task.priority,
+             status='pending').save()
+
+        task = Task.objects.get(pk=task.pk)
+        self.assertEqual(task.description, 'overwrite')
+        self.assertEqual(task.tags_summary, 'tag1')
+
+    def test_task_save_signals(self):
+        """ The save signals are sent once for each save that writes.
+        """
+        user = self.create_user()
+        task = Task.objects.create(description='foobar', user=user)
+        sent = []
+
+        def receiver(sender, instance, **kwargs):
+            sent.append(kwargs['signal'])
+        pre_save.connect(receiver, sender=Task)
+        post_save.connect(receiver, sender=Task)
+        try:
+            task.description = 'changed'
+            task.save()
+            self.assertEqual(sent, [pre_save, post_save])
+
+            # a row that's gone is stored again
+            del sent[:]
+            Task.objects.filter(pk=task.pk).update(uuid='gone')
+            Task.objects.filter(uuid='gone').delete()
+            task.description = 'changed again'
+            task.save()
+            self.assertEqual(sent, [pre_save, post_save])
+        finally:
+            pre_save.disconnect(receiver, sender=Task)
+            post_save.disconnect(receiver, sender=Task)
+        self.assertEqual(Task.objects.get(pk=task.pk).description,
+                         'changed again')
+
+    def test_task_save_num_queries(self):
+        user = self.create_user()
+        task = Task(description='foobar', user=user)
+        task.save()
+
+        # the relations are read once (3 queries) for both states of the
+        # undo entry, then the task is written, indexed and versioned
+        task.description = 'foobar2'
+        with self.assertNumQueries(11):
+            task.save()
+        # only the undo entry is written for a changed relation
+        task.add_tag('tag1', track=False)
+        with self.assertNumQueries(5):
+            task.save()
+        # and nothing at all if nothing changed
+        with self.assertNumQueries(0):
+            task.save()
+        self.assertEqual(Undo.objects.count(), 3)
+        self.assertEqual(Undo.objects.latest('pk').old,
+                         '[description:"foobar2" entry:"%s" '
+                         'status:"pending" uuid:"%s"]\n'
+                         % (datetime2ts(task.entry), task.uuid))
+        self.assertIn('tags:', Undo.objects.latest('pk').new)
+
     def test_task_is_dirty(self):
         user = self.create_user()
         task = Task(description='foobar', user=user)
@@ -183,6 +523,229 @@ class TestTaskModel(TaskTestCase):
         self.assertItemsEqual(task._get_dirty_fields().keys(), ['tags'])
         self.assertTrue(task._is_dirty())
 
+    def test_task_load_is_lazy(self):
+        """ Loading tasks shouldn't query their relations just to be
+            able to track changes.
+        """
+        user = self.create_user()
+        task = Task.objects.create(description='foobar', user=user)
+        task.add_tag('tag1')
+        with self.assertNumQueries(1):
+            task = Task.objects.get(pk=task.pk)
+        with self.assertNumQueries(0):
+            self.assertFalse(task._is_dirty())
+
+    def test_task_undo_old_state(self):
+        user = self.create_user()
+        task = Task.objects.create(description='foobar', user=user,
+                                   project=Project.objects.create(name='p1'))
+        task.add_tag('tag1')
+
+        task = Task.objects.get(pk=task.pk)
+        task.project = Project.objects.create(name='p2')
+        task.tags.clear()
+        task.save()
+
+        undo = Undo.objects.latest('pk')
+        self.assertIn('project:"p1"', undo.old)
+        self.assertIn('tags:', undo.old)
+        self.assertIn('project:"p2"', undo.new)
+        self.assertNotIn('tags:', undo.new)
+
+    def test_task_summaries(self):
+        import datetime
+        user = self.create_user()
+        task = Task.objects.create(description='foobar', user=user)
+        stale = Task.objects.get(pk=task.pk)
+
+        task.add_tag('tag1')
+        task.add_tag('tag2')
+        task.annotate('second', datetime.datetime(2012, 1, 2))
+        task.annotate('first', datetime.datetime(2012, 1, 1))
+        task.remove_tag('tag1')
+        self.assertEqual((task.tags_summary, task.annotation_count,
+                          task.latest_annotation), ('tag2', 2, 'second'))
+
+        # the summaries aren't task data
+        self.assertItemsEqual(task._get_dirty_fields().keys(),
+                              ['tags', 'annotations'])
+        self.assertNotIn('tags_summary', task.todict())
+
+        # changes through the other side of the relations
+        Tag.objects.get(tag='tag1').task_set.add(task)
+        task.annotations.get(data='second').delete()
+        stale.description = 'changed'
+        stale.save()
+
+        task = Task.objects.get(pk=task.pk)
+        self.assertEqual((task.tags_summary, task.annotation_count,
+                          task.latest_annotation), ('tag1,tag2', 1, 'first'))
+
+    def test_task_summaries_bulk(self):
+        user = self.create_user()
+        Task.bulk_fromdict([{'uuid': 'aaaa', 'description': 'bar',
+                             'tags': ['new', 'another'],
+                             'annotation_1324076995': 'old note',
+                             'annotation_1324076996': 'new note'}], user)
+
+        task = Task.objects.get(uuid='aaaa')
+        self.assertEqual(task.annotation_count, 2)
+        self.assertEqual(task.latest_annotation, 'new note')
+        self.assertEqual(Task.update_summaries([task.pk]), {})
+
+    def test_rebuild_task_summaries(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+
+        user = self.create_user()
+        task = Task.objects.create(description='foobar', user=user)
+        task.add_tag('tag1')
+        Task.objects.update(tags_summary='', annotation_count=3)
+
+        out = StringIO()
+        call_command('rebuild_task_summaries', stdout=out)
+        self.assertEqual(out.getvalue(), '1 of 1 tasks updated\n')
+        task = Task.objects.get(pk=task.pk)
+        self.assertEqual(task.tags_summary, 'tag1')
+        self.assertEqual(task.annotation_count, 0)
+
+    def _search(self, text):
+        return [task.description for task in
+                search.filter_tasks(Task.objects.all(), text)]
+
+    def test_search(self):
+        user = self.create_user()
+        Task.objects.create(description='paint the fence', user=user)
+        Task.objects.create(description='fence fence fence painting',
+                            user=user)
+        Task.objects.create(description='buy paint', user=user)
+
+        self.assertEqual(self._search('fence'), ['fence fence fence painting',
+                                                 'paint the fence'])
+        # words are stemmed and the last one matches as a prefix
+        self.assertEqual(sorted(self._search('painted fen')),
+                         ['fence fence fence painting', 'paint the fence'])
+        self.assertEqual(self._search('"; DROP'), [])
+        self.assertEqual(self._search('  '), [])
+
+    def test_search_index_follows_changes(self):
+        user = self.create_user()
+        task = Task.objects.create(description='foobar', user=user)
+        task.annotate('remember the milk')
+        self.assertEqual(self._search('milk'), ['foobar'])
+
+        task.description = 'groceries'
+        task.save()
+        self.assertEqual(self._search('foobar'), [])
+        self.assertEqual(self._search('milk'), ['groceries'])
+
+        task.annotations.all().delete()
+        self.assertEqual(self._search('milk'), [])
+
+        task.delete()
+        self.assertEqual(self._search('groceries'), [])
+
+    def test_search_bulk(self):
+        user = self.create_user()
+        Task.bulk_fromdict([{'uuid': 'aaaa', 'description': 'bar',
+                             'annotation_1324076995': 'old note'}], user)
+        self.assertEqual(self._search('note'), ['bar'])
+
+        Task.bulk_fromdict([{'uuid': 'aaaa', 'description': 'baz'}], user)
+        self.assertEqual(self._search('note'), [])
+        self.assertEqual(self._search('baz'), ['baz'])
+
+    def test_search_without_index(self):
+        user = self.create_user()
+        task = Task.objects.create(description='paint the fence', user=user)
+        task.annotate('white paint')
+        task.annotate('blue paint')
+        Task.objects.create(description='buy paint', user=user)
+
+        search._enabled = False
+        try:
+            self.assertEqual(self._search('PAINT fence'), ['paint the fence'])
+            self.assertEqual(self._search('white'), ['paint the fence'])
+            self.assertEqual(self._search('white blue fence'),
+                             ['paint the fence'])
+            # the words are matched with one filter, and the annotations
+            # in subqueries rather than joined to the tasks
+            query = search.filter_tasks(Task.objects.all(), 'white blue')
+            self.assertNotIn('JOIN', str(query.query).split(' WHERE ')[0])
+        finally:
+            search._enabled = None
+
+    def test_rebuild_search_index(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+
+        user = self.create_user()
+        Task.objects.create(description='foobar', user=user)
+        connection.cursor().execute('DELETE FROM task_search')
+
+        out = StringIO()
+        call_command('rebuild_search_index', stdout=out)
+        self.assertEqual(out.getvalue(), '1 tasks indexed\n')
+        self.assertEqual(self._search('foobar'), ['foobar'])
+
+    def _tasks(self, *names):
+        user = self.create_user()
+        return [Task.objects.create(description=name, user=user)
+                for name in names]
+
+    def test_ready_and_blocked(self):
+        a, b, c, d = self._tasks('a', 'b', 'c', 'd')
+        a.add_dependency(b)
+        b.add_dependency(c)
+        d.add_dependency(c)
+        c.done()
+        pending = Task.objects.filter(status='pending')
+
+        self.assertEqual(sorted(t.description for t in graph.ready(pending)),
+                         ['b', 'd'])
+        self.assertEqual([t.description for t in graph.blocked(pending)],
+                         ['a'])
+
+    def test_blockers(self):
+        a, b, c, d, e = self._tasks('a', 'b', 'c', 'd', 'e')
+        a.add_dependency(b)
+        a.add_dependency(c)
+        b.add_dependency(d)
+        c.add_dependency(d)
+        d.add_dependency(e)
+        self.assertEqual(sorted(t.description for t in graph.blockers(a)),
+                         ['b', 'c', 'd', 'e'])
+
+        # a done task stops blocking, and so do the tasks behind it
+        b.done()
+        c.done()
+        self.assertEqual(list(graph.blockers(a)), [])
+        self.assertEqual(graph.closure([a.pk, d.pk]), {d.pk: set([e.pk])})
+
+    def test_blockers_cycles(self):
+        a, b, c, d = self._tasks('a', 'b', 'c', 'd')
+        a.add_dependency(b)
+        b.add_dependency(c)
+        c.add_dependency(a)
+        d.add_dependency(a)
+
+        self.assertEqual(sorted(t.description for t in graph.blockers(a)),
+                         ['b', 'c'])
+        self.assertEqual(graph.cycles([a.pk, b.pk, c.pk, d.pk]),
+                         set([a.pk, b.pk, c.pk]))
+        self.assertEqual(len(graph.blockers(d)), 3)
+
+    def test_blockers_long_chain(self):
+        tasks = self._tasks(*['task %s' % x for x in range(300)])
+        Task.dependencies.through.objects.bulk_create(
+                [Task.dependencies.through(from_task=t1, to_task=t2)
+                 for t1, t2 in zip(tasks, tasks[1:])])
+
+        with self.assertNumQueries(1):
+            closure = graph.closure([tasks[0].pk, tasks[150].pk])
+        self.assertEqual(len(closure[tasks[0].pk]), 299)
+        self.assertEqual(len(closure[tasks[150].pk]), 149)
+
     def test_create_task_save_without_track(self):
         user = self.create_user()
         task = Task(description='foobar', user=user)
@@ -302,18 +865,17 @@ class TestTaskModel(TaskTestCase):
         # object from above
         task = Task.objects.all()[0]
 
-        # see reasoning in the add_tasks_POST test
-        self.assertEqual(Undo.objects.count(), 2)
+        # the task and its relations are recorded as one change
+        self.assertEqual(Undo.objects.count(), 1)
 
-        # this is a brand new task, the firts undo shouldn't
+        # this is a brand new task, the undo shouldn't
         # have an 'old' field.
-        self.assertEqual(Undo.objects.all()[0].old, None)
+        undo = Undo.objects.get()
+        self.assertEqual(undo.old, None)
+        self.assertIn('annotation_1324076995', undo.new)
         data.pop('user')
         self.assertEqual(data, task.todict())
 
-        undo2 = Undo.objects.all()[1]
-        self.assertNotEqual(undo2.old, undo2.new)
-
     def test_task_fromdict_priority_empty_string(self):
         user = self.create_user()
         data = {'description': 'foobar', 'uuid': 'sssssssss',
@@ -422,6 +984,95 @@ class TestTaskModel(TaskTestCase):
         data.pop('user')
         self.assertEqual(data, task.todict())
 
+    def test_task_bulk_fromdict(self):
+        user = self.create_user()
+        lines = [
+            '[annotation_1324076995:"a note" depends:"bbbb,cccc" '
+            'description:"foo" entry:"12345" priority:"H" project:"home" '
+            'status:"pending" uuid:"aaaa"]\n',
+            '[description:"bar" due:"45678" entry:"12346" status:"pending" '
+            'uuid:"bbbb"]\n',
+            ]
+        Task.bulk_fromdict([decode_task(line) for line in lines], user)
+
+        self.assertEqual(Task.objects.filter(user=user).count(), 2)
+        self.assertEqual(list(Undo.objects.all()), [])
+        # 'cccc' doesn't exist yet, so a placeholder is created for it
+        self.assertEqual(Task.objects.get(uuid='cccc').description, '')
+        self.assertEqual(Task.objects.get(uuid='bbbb').todict(),
+                         decode_task(lines[1]))
+        self.assertEqual(
+            encode_task(Task.objects.get(uuid='aaaa').todict()), lines[0])
+
+    def test_task_bulk_fromdict_existing(self):
+        user = self.create_user()
+        task = Task.objects.create(description='foo', uuid='aaaa', user=user)
+        task.add_tag('old')
+        task.annotate('old note')
+
+        Task.bulk_fromdict([{'uuid': 'aaaa', 'description': 'bar',
+                             'entry': '12345', 'status': 'completed',
+                             'tags': ['new', 'another'],
+                             'annotation_1324076995': 'new note'}], user)
+
+        task = Task.objects.get(pk=task.pk)
+        self.assertEqual(task.todict(),
+                         {'uuid': 'aaaa', 'description': 'bar',
+                          'entry': '12345', 'status': 'completed',
+                          'tags': 'another,new',
+                          'annotation_1324076995': 'new note'})
+
+    def test_task_bulk_fromdict_annotations(self):
+        """ New annotations are attached by their contents, not by the
+            order their pks were handed out in.
+        """
+        user = self.create_user()
+        # an annotation without a task, and another task's annotation,
+        # that look like the new ones
+        Annotation.objects.create(time=ts2datetime(1324076995),
+                                  data=u'caf\xe9')
+        other = Task.objects.create(description='other', user=user)
+        other.annotate('same note', time=ts2datetime(1324076995))
+
+        Task.bulk_fromdict([
+            {'uuid': 'aaaa', 'description': 'foo', 'entry': '12345',
+             'annotation_1324076995': u'caf\xe9',
+             'annotation_1324076996': 'second'},
+            {'uuid': 'bbbb', 'description': 'bar', 'entry': '12345',
+             'annotation_1324076995': 'same note'},
+            {'uuid': 'cccc', 'description': 'baz', 'entry': '12345',
+             'annotation_1324076995': 'same note'},
+            ], user)
+
+        notes = dict((uuid, sorted(Task.objects.get(uuid=uuid).annotations
+                                       .values_list('data', flat=True)))
+                     for uuid in ('aaaa', 'bbbb', 'cccc'))
+        self.assertEqual(notes, {'aaaa': [u'caf\xe9', 'second'],
+                                 'bbbb': ['same note'],
+                                 'cccc': ['same note']})
+        self.assertEqual(list(other.annotations.values_list('data',
+                                                            flat=True)),
+                         ['same note'])
+        self.assertNotEqual(Task.objects.get(uuid='bbbb').annotations.get(),
+                            Task.objects.get(uuid='cccc').annotations.get())
+
+    def test_task_bulk_fromdict_num_queries(self):
+        """ The number of queries shouldn't depend on the number of tasks.
+        """
+        user = self.create_user()
+
+        def dicts(prefix, count):
+            return [{'uuid': '%s%s' % (prefix, x), 'description': 'foo',
+                     'tags': ['tag%s' % x], 'project': 'proj%s' % x,
+                     'annotation_%s' % (1324076995 + x): 'note'}
+                    for x in range(count)]
+
+        TaskDbVersion.get_for(user, 'pending.data')
+        with self.assertNumQueries(16):
+            Task.bulk_fromdict(dicts('a', 2), user)
+        with self.assertNumQueries(16):
+            Task.bulk_fromdict(dicts('b', 20), user)
+
     def test_task_fromdict_optional_end(self):
         user = self.create_user()
         data = {'description': 'foobar', 'uuid': 'sssssssss',
@@ -436,6 +1087,59 @@ class TestTaskModel(TaskTestCase):
         data.pop('user')
         self.assertEqual(data, task.todict())
 
+    def test_task_iterserialize_chunks(self):
+        user = self.create_user()
+        for x in range(5):
+            Task.objects.create(description='test %s' % x, user=user)
+
+        chunks = list(Task.iterserialize('pending', chunk_size=2))
+        self.assertEqual(len(chunks), 3)
+        self.assertEqual(''.join(chunks), Task.serialize('pending'))
+        self.assertEqual(len(Task.serialize('pending').splitlines()), 5)
+
+    def test_task_bulk_todict(self):
+        import datetime
+        user = self.create_user()
+        project = Project.objects.create(name='home')
+        dep = Task.objects.create(description='dependency', user=user)
+        for x in range(5):
+            task = Task.objects.create(description='test %s' % x, user=user,
+                                       project=project)
+            task.set_priority('HML'[x % 3])
+            task.add_tag('tag%s' % x)
+            task.add_tag('common')
+            task.annotate('note %s' % x,
+                          datetime.datetime.fromtimestamp(1324076995 + x))
+            task.add_dependency(dep)
+            task.save()
+
+        tasks = Task.objects.order_by('entry')
+        expected = ''.join(encode_task(t.todict()) for t in tasks)
+        with self.assertNumQueries(4):
+            bulk = list(Task.bulk_todict(tasks))
+
+        self.assertEqual(bulk, [t.todict() for t in tasks])
+        self.assertEqual(''.join(encode_task(t) for t in bulk), expected)
+        self.assertEqual(Task.serialize(), expected)
+
+        # one query for the task rows and one for the tags, annotations
+        # and dependencies of each chunk
+        with self.assertNumQueries(1 + 3 * 3):
+            list(Task.bulk_todict(tasks, chunk_size=2))
+
+        # the tags don't depend on the summaries being up to date
+        Task.objects.update(tags_summary='')
+        self.assertEqual(Task.serialize(), expected)
+
+    def test_undo_iterserialize_chunks(self):
+        user = self.create_user()
+        for x in range(3):
+            Task.objects.create(description='test %s' % x, user=user)
+
+        chunks = list(Undo.iterserialize(chunk_size=2))
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(u''.join(chunks), Undo.serialize())
+
 
 class TestViews(TaskTestCase):
     def test_pending_tasks(self):
@@ -448,6 +1152,144 @@ class TestViews(TaskTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.context['datagrid'].rows), 1)
 
+    def test_facets(self):
+        user = self.create_user()
+        other = self.create_user('bar')
+        for x in range(3):
+            task = Task.objects.create(description='test %s' % x, user=user)
+            task.set_project('home')
+            task.add_tag('tag%s' % (x % 2))
+            task.save()
+        task = Task.objects.create(description='other', user=other)
+        task.add_tag('tag0')
+
+        tags, projects = facets('pending', user)
+        self.assertEqual(tags, [{'tag': 'tag0', 'count': 2},
+                                {'tag': 'tag1', 'count': 1}])
+        self.assertEqual(projects, [{'name': 'home', 'count': 3}])
+        self.assertEqual(facets('pending')[0][0], {'tag': 'tag0', 'count': 3})
+        self.assertEqual(facets('completed', user), ([], []))
+
+        # cached until the user's tasks change
+        with self.assertNumQueries(1):
+            facets('pending', user)
+        Task.objects.get(description='test 0').done()
+        tags, projects = facets('pending', user)
+        self.assertEqual(tags, [{'tag': 'tag0', 'count': 1},
+                                {'tag': 'tag1', 'count': 1}])
+        self.assertEqual(facets('completed', user)[1],
+                         [{'name': 'home', 'count': 1}])
+
+    def test_pending_tasks_facets(self):
+        self._create_user_and_login()
+        user = User.objects.get(username='foo')
+        Task.objects.create(description='test', user=user).add_tag('tag1')
+        Task.objects.create(description='other',
+                            user=self.create_user('bar')).add_tag('tag2')
+
+        response = self.client.get('/pending/')
+        self.assertEqual(response.context['tags'],
+                         [{'tag': 'tag1', 'count': 1}])
+
+    def test_pending_tasks_search(self):
+        user = self.create_user()
+        Task.objects.create(description='paint the fence', user=user)
+        Task.objects.create(description='fence fence fence', user=user)
+        Task.objects.create(description='other', user=user)
+
+        response = self.client.get('/pending/?q=fence')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['object'].description
+                          for row in response.context['datagrid'].rows],
+                         ['fence fence fence', 'paint the fence'])
+
+        response = self.client.get('/pending/?q=fence&sort=-description')
+        self.assertEqual([row['object'].description
+                          for row in response.context['datagrid'].rows],
+                         ['paint the fence', 'fence fence fence'])
+
+    def test_pending_tasks_filter(self):
+        user = self.create_user()
+        task = Task.objects.create(description='paint the fence', user=user)
+        task.add_tag('home')
+        Task.objects.create(description='other', user=user)
+
+        response = self.client.get('/pending/?filter=%2Bhome')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['object'].description
+                          for row in response.context['datagrid'].rows],
+                         ['paint the fence'])
+
+        response = self.client.get('/pending/?filter=(%2Bhome')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['datagrid'].rows), 0)
+        self.assertContains(response, 'Missing )')
+
+        response = self.client.get('/pending/?filter=due:99999999999999')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['datagrid'].rows), 0)
+
+    def test_ready_and_blocked_tasks(self):
+        user = self.create_user()
+        task = Task.objects.create(description='blocked', user=user)
+        task.add_dependency(Task.objects.create(description='first',
+                                                user=user))
+
+        response = self.client.get('/ready/')
+        self.assertEqual([row['object'].description
+                          for row in response.context['datagrid'].rows],
+                         ['first'])
+
+        response = self.client.get('/blocked/')
+        rows = response.context['datagrid'].rows
+        self.assertEqual([row['object'].description for row in rows],
+                         ['blocked'])
+        self.assertEqual(rows[0]['cells'][-1].split()[-2], '1')
+
+        connection.use_debug_cursor = True
+        try:
+            response = self.client.get('/detail/task/%s/' % task.pk)
+            closures = [query for query in connection.queries
+                        if 'WITH RECURSIVE' in query['sql']]
+        finally:
+            connection.use_debug_cursor = None
+        self.assertEqual([t.description for t in response.context['blockers']],
+                         ['first'])
+        self.assertFalse(response.context['in_cycle'])
+        self.assertEqual(len(closures), 1)
+
+    def _pending_queries(self):
+        # the query log is reset when each request starts
+        connection.use_debug_cursor = True
+        try:
+            response = self.client.get('/pending/')
+            self.assertEqual(response.status_code, 200)
+            return len(connection.queries)
+        finally:
+            connection.use_debug_cursor = None
+
+    def test_pending_tasks_queries(self):
+        """ rendering the grid takes the same number of queries
+            however many rows there are.
+        """
+        user = self.create_user()
+        project = Project.objects.create(name='proj')
+        priority = Priority.objects.get(weight=3)
+        tag = Tag.objects.create(tag='tag1')
+
+        def add_tasks(count):
+            for x in range(count):
+                task = Task.objects.create(description='test %s' % x,
+                                           user=user, project=project,
+                                           priority=priority)
+                task.add_tag(tag)
+                task.annotate('note %s' % x)
+
+        add_tasks(2)
+        queries = self._pending_queries()
+        add_tasks(8)
+        self.assertEqual(self._pending_queries(), queries)
+
     def test_completed_tasks(self):
         response = self.client.get('/completed/')
         self.assertEqual(response.status_code, 200)
@@ -486,12 +1328,31 @@ class TestViews(TaskTestCase):
         post_data.update({'tags': 'tag1'})
         self.assertEqual(post_data, taskdict)
 
-        # 2 undo objects: 1 for adding task, 1 for adding
-        # relations (tags, priority, etc...
-        # I'd rather have 1, but this is easier
+        # 1 undo object for adding the task and its relations
+        undo = Undo.objects.get()
+        self.assertEqual(undo.old, None)
+        self.assertIn('tags:', undo.new)
+
+    def test_edit_task_POST(self):
+        self._create_user_and_login()
+        user = User.objects.get(username='foo')
+        task = Task.objects.create(description='foobar', user=user)
+        tags = [Tag.objects.create(tag='tag%s' % x) for x in range(5)]
+        post_data = {'description': 'foobaz',
+                     'priority': '',
+                     'user': str(user.pk),
+                     'tags': [str(tag.pk) for tag in tags],
+                     'status': 'pending'
+                    }
+        response = self.client.post('/edit/task/%s/' % task.pk, post_data)
+        self.assertEqual(response.status_code, 302)
+
+        undo = Undo.objects.latest('pk')
         self.assertEqual(Undo.objects.count(), 2)
-        self.assertEqual(Undo.objects.all()[0].old, None)
-        self.assertNotEqual(Undo.objects.all()[1].new, None)
+        self.assertIn('description:"foobar"', undo.old)
+        self.assertNotIn('tags:', undo.old)
+        self.assertIn('description:"foobaz"', undo.new)
+        self.assertIn('tags:', undo.new)
 
     def test_add_tasks_POST_no_login(self):
         pass
@@ -506,6 +1367,120 @@ class TestViews(TaskTestCase):
         response = self.client.get('/taskdb/completed.data')
         self.assertEqual(response.status_code, 200)
 
+    def test_taskdb_GET_pending_streamed(self):
+        self._create_user_and_login()
+        user = User.objects.get(username='foo')
+        for x in range(3):
+            Task.objects.create(description='test %s' % x, user=user)
+
+        response = self.client.get('/taskdb/pending.data')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Content-Length'))
+        self.assertEqual(response.content, Task.serialize('pending'))
+
+    def _api_tasks(self, query_string=''):
+        response = self.client.get('/api/tasks/' + query_string)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        tasks = [json.loads(line) for line in response.content.splitlines()]
+        return tasks, response.get('Link')
+
+    def test_api_tasks(self):
+        self._create_user_and_login()
+        user = User.objects.get(username='foo')
+        task = Task.objects.create(description='paint the fence', user=user,
+                                   entry=datetime.datetime(2012, 1, 1))
+        task.set_project('home')
+        task.add_tag('tag1')
+        task.annotate('white', time=datetime.datetime(2012, 1, 2))
+        task.save()
+        Task.objects.create(description='other', user=user).done()
+        Task.objects.create(description='not mine',
+                            user=self.create_user('bar'))
+
+        tasks, link = self._api_tasks('?status=pending')
+        self.assertEqual(link, None)
+        self.assertEqual(tasks, [{
+            'id': task.pk,
+            'uuid': task.uuid,
+            'description': 'paint the fence',
+            'status': 'pending',
+            'entry': datetime2ts(task.entry),
+            'due': None,
+            'end': None,
+            'priority': None,
+            'project': 'home',
+            'tags': ['tag1'],
+            }])
+
+        tasks, link = self._api_tasks('?fields=uuid,annotations,depends')
+        self.assertEqual(len(tasks), 2)
+        self.assertEqual(tasks[0], {
+            'uuid': task.uuid,
+            'annotations': [{'entry': datetime2ts(datetime.datetime(2012, 1, 2)),
+                             'description': 'white'}],
+            'depends': [],
+            })
+
+        self.assertEqual(self._api_tasks('?tag=tag1&fields=id')[0],
+                         [{'id': task.pk}])
+        self.assertEqual(self._api_tasks('?q=fence&fields=id')[0],
+                         [{'id': task.pk}])
+
+    def test_api_tasks_pages(self):
+        self._create_user_and_login()
+        user = User.objects.get(username='foo')
+        pks = [Task.objects.create(description='test %s' % x, user=user).pk
+               for x in range(5)]
+
+        seen = []
+        url = '?fields=id&limit=2'
+        while url:
+            tasks, link = self._api_tasks(url)
+            seen.extend(task['id'] for task in tasks)
+            url = link and link[link.index('?'):link.index('>')]
+        self.assertEqual(seen, pks)
+
+    def test_api_tasks_queries(self):
+        """ only the requested columns and relations are loaded.
+        """
+        self._create_user_and_login()
+        user = User.objects.get(username='foo')
+        for x in range(3):
+            Task.objects.create(description='test %s' % x, user=user)
+
+        connection.use_debug_cursor = True
+        try:
+            response = self.client.get('/api/tasks/?fields=id,description')
+            self.assertEqual(len(response.content.splitlines()), 3)
+            # page ids, then the rows
+            self.assertEqual(len([q for q in connection.queries
+                                  if 'task_task' in q['sql']]), 2)
+            self.assertFalse([q for q in connection.queries
+                              if 'task_priority' in q['sql'] or
+                                 'task_annotation' in q['sql']])
+        finally:
+            connection.use_debug_cursor = None
+
+    def test_api_tasks_filter(self):
+        self._create_user_and_login()
+        user = User.objects.get(username='foo')
+        task = Task.objects.create(description='paint the fence', user=user)
+        task.set_priority('H')
+        task.save()
+        Task.objects.create(description='other', user=user)
+
+        tasks, link = self._api_tasks('?fields=description&filter=pri:H')
+        self.assertEqual(tasks, [{'description': 'paint the fence'}])
+
+    def test_api_tasks_bad_request(self):
+        self._create_user_and_login()
+        for query_string in ('?fields=id,nope', '?limit=0', '?after=x',
+                             '?filter=due:someday',
+                             '?filter=due:99999999999999'):
+            response = self.client.get('/api/tasks/' + query_string)
+            self.assertEqual(response.status_code, 400)
+
     def test_taskdb_GET_undo(self):
         self._create_user_and_login()
         response = self.client.get('/taskdb/undo.data')
@@ -524,6 +1499,236 @@ class TestViews(TaskTestCase):
         self.assertEqual(list(Undo.objects.all()), [])
         self.assertEqual(Task.serialize('pending'), data)
 
+    def test_taskdb_PUT_pending_diff(self):
+        """ Re-uploading pending.data should only touch the tasks that
+            changed.
+        """
+        self._create_user_and_login()
+        data = open(os.path.join(TASK_DATA, 'pending.data'), 'r').read()
+        response = self.client.put('/taskdb/pending.data',
+                        content_type='text/plain', data=data)
+        self.assertEqual(response.content,
+                         'created: 3\nupdated: 0\ndeleted: 0\n')
+        ids = dict(Task.objects.values_list('uuid', 'id'))
+
+        response = self.client.put('/taskdb/pending.data',
+                        content_type='text/plain', data=data)
+        self.assertEqual(response.content,
+                         'created: 0\nupdated: 0\ndeleted: 0\n')
+
+        lines = data.splitlines(True)
+        lines[0] = lines[0].replace('buy some milk', 'buy some bread')
+        response = self.client.put('/taskdb/pending.data',
+                        content_type='text/plain', data=''.join(lines[:2]))
+        self.assertEqual(response.content,
+                         'created: 0\nupdated: 1\ndeleted: 1\n')
+        self.assertEqual(Task.serialize('pending'), ''.join(lines[:2]))
+        for uuid, id_ in Task.objects.values_list('uuid', 'id'):
+            self.assertEqual(ids[uuid], id_)
+
+    def test_taskdb_GET_not_modified(self):
+        self._create_user_and_login()
+        response = self.client.get('/taskdb/pending.data')
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        response = self.client.get('/taskdb/pending.data',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/taskdb/pending.data',
+                                   HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        # completed.data has its own version
+        response = self.client.get('/taskdb/completed.data',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        user = User.objects.get(username='foo')
+        Task.objects.create(description='foo', user=user)
+        response = self.client.get('/taskdb/pending.data',
+                                   HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_taskdb_GET_not_modified_relations(self):
+        """ Renaming or deleting a tag or project changes the files of
+            the tasks that have it.
+        """
+        self._create_user_and_login()
+        user = User.objects.get(username='foo')
+        task = Task.objects.create(description='foo', user=user)
+        task.add_tag('tag1')
+        task.set_project('home')
+        task.save()
+
+        def rename(obj, field, name):
+            setattr(obj, field, name)
+            obj.save()
+
+        changes = (
+            lambda: rename(Tag.objects.get(tag='tag1'), 'tag', 'tag2'),
+            lambda: rename(Project.objects.get(name='home'), 'name', 'work'),
+            lambda: Tag.objects.get(tag='tag2').delete(),
+        )
+        for change in changes:
+            response = self.client.get('/taskdb/pending.data')
+            # the file is streamed, so it's read before the change
+            content = response.content
+            change()
+            changed = self.client.get('/taskdb/pending.data',
+                                      HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(changed.status_code, 200)
+            self.assertNotEqual(changed.content, content)
+
+    def test_taskdb_GET_cached(self):
+        self._create_user_and_login()
+        user = User.objects.get(username='foo')
+        Task.objects.create(description='foo', user=user)
+        stats = taskdb_cache.stats()
+
+        response = self.client.get('/taskdb/pending.data')
+        self.assertEqual(response['X-Taskdb-Cache'], 'miss')
+        data = response.content
+
+        response = self.client.get('/taskdb/pending.data')
+        self.assertEqual(response['X-Taskdb-Cache'], 'hit')
+        self.assertEqual(response.content, data)
+        self.assertEqual(taskdb_cache.stats(),
+                         {'hits': stats['hits'] + 1,
+                          'misses': stats['misses'] + 1})
+
+        Task.objects.create(description='bar', user=user)
+        response = self.client.get('/taskdb/pending.data')
+        self.assertEqual(response['X-Taskdb-Cache'], 'miss')
+        self.assertEqual(response.content, Task.serialize('pending', user))
+
+    def test_taskdb_version_touched(self):
+        user = self.create_user()
+        versions = dict((name, TaskDbVersion.get_for(user, name).version)
+                        for name in ('pending.data', 'completed.data',
+                                     'undo.data'))
+        task = Task.objects.create(description='foo', user=user)
+        task.add_tag('tag1')
+        task.done()
+
+        for name in versions:
+            self.assertTrue(TaskDbVersion.get_for(user, name).version >
+                            versions[name])
+
+    def test_taskdb_PUT_moves_task(self):
+        """ A task whose status changes moves from one file to the other,
+            so both of them change.
+        """
+        self._create_user_and_login()
+        data = open(os.path.join(TASK_DATA, 'pending.data'), 'r').read()
+        self.client.put('/taskdb/pending.data', content_type='text/plain',
+                        data=data)
+        etags = {}
+        for name in ('pending.data', 'completed.data'):
+            response = self.client.get('/taskdb/' + name)
+            response.content
+            etags[name] = response['ETag']
+
+        lines = data.splitlines(True)
+        lines[0] = lines[0].replace('status:"pending"', 'status:"completed"')
+        self.client.put('/taskdb/pending.data', content_type='text/plain',
+                        data=''.join(lines))
+        self.assertEqual(Task.objects.filter(status='pending').count(), 2)
+
+        for name in ('pending.data', 'completed.data'):
+            response = self.client.get('/taskdb/' + name,
+                                       HTTP_IF_NONE_MATCH=etags[name])
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['X-Taskdb-Cache'], 'miss')
+        self.assertEqual(response.content,
+                         Task.serialize('completed',
+                                        User.objects.get(username='foo')))
+
+    def test_taskdb_PUT_moves_dependency(self):
+        """ A pending task keeps depending on a task that moves to
+            completed.data, though pending.data is uploaded first.
+        """
+        self._create_user_and_login()
+        self.client.put('/taskdb/pending.data', content_type='text/plain',
+                        data='[description:"foo" status:"pending" '
+                             'uuid:"aaaa"]\n'
+                             '[depends:"aaaa" description:"bar" '
+                             'status:"pending" uuid:"bbbb"]\n')
+        self.client.put('/taskdb/pending.data', content_type='text/plain',
+                        data='[depends:"aaaa" description:"bar" '
+                             'status:"pending" uuid:"bbbb"]\n')
+        task = Task.objects.get(uuid='bbbb')
+        self.assertEqual([t.uuid for t in task.dependencies.all()], ['aaaa'])
+
+        self.client.put('/taskdb/completed.data', content_type='text/plain',
+                        data='[description:"foo" status:"completed" '
+                             'uuid:"aaaa"]\n')
+        moved = Task.objects.get(uuid='aaaa')
+        self.assertEqual((moved.description, moved.status, moved.user),
+                         ('foo', 'completed', task.user))
+        self.assertEqual(list(task.dependencies.all()), [moved])
+
+    def test_taskdb_GET_gzip(self):
+        import zlib
+        self._create_user_and_login()
+        user = User.objects.get(username='foo')
+        Task.objects.create(description='foo', user=user)
+        expected = Task.serialize('pending', user)
+
+        # once generated, once from the cache
+        for x in range(2):
+            response = self.client.get('/taskdb/pending.data',
+                                       HTTP_ACCEPT_ENCODING='gzip, deflate')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(zlib.decompress(response.content,
+                                             16 + zlib.MAX_WBITS), expected)
+
+        response = self.client.get('/taskdb/pending.data',
+                                   HTTP_ACCEPT_ENCODING='gzip;q=0, deflate')
+        self.assertEqual(response['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(response.content), expected)
+
+        response = self.client.get('/taskdb/pending.data')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.content, expected)
+
+    def test_taskdb_PUT_gzip(self):
+        import gzip
+        import StringIO
+        self._create_user_and_login()
+        data = open(os.path.join(TASK_DATA, 'pending.data'), 'r').read()
+        compressed = StringIO.StringIO()
+        f = gzip.GzipFile(fileobj=compressed, mode='wb')
+        f.write(data)
+        f.close()
+
+        response = self.client.put('/taskdb/pending.data',
+                        content_type='text/plain',
+                        data=compressed.getvalue(),
+                        HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Task.serialize('pending'), data)
+
+        response = self.client.put('/taskdb/pending.data',
+                        content_type='text/plain',
+                        data='not gzipped',
+                        HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 400)
+
+        # a cut off upload isn't taken for the whole file
+        truncated = compressed.getvalue()[:len(compressed.getvalue()) // 2]
+        response = self.client.put('/taskdb/pending.data',
+                        content_type='text/plain', data=truncated,
+                        HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Task.serialize('pending'), data)
+
+        response = self.client.put('/taskdb/pending.data',
+                        content_type='text/plain', data=data,
+                        HTTP_CONTENT_ENCODING='br')
+        self.assertEqual(response.status_code, 415)
+
     def test_taskdb_PUT_completed(self):
         self._create_user_and_login()
         data = open(os.path.join(TASK_DATA, 'completed.data'), 'r').read()
@@ -549,6 +1754,107 @@ class TestViews(TaskTestCase):
         actual_parsed = parse_undo(get_response.content)
         self.assertEqual(expected_parsed, actual_parsed)
 
+    def test_taskdb_PUT_undo_append(self):
+        self._create_user_and_login()
+        data = open(os.path.join(TASK_DATA, 'undo.data'), 'r').read()
+        segments = data.split('---\n')
+        head = '---\n'.join(segments[:3]) + '---\n'
+
+        response = self.client.put('/taskdb/undo.data',
+                        content_type='text/plain', data=head)
+        self.assertEqual(response.content, 'created: 3\ndeleted: 0\n')
+
+        # only the new entries are added
+        response = self.client.put('/taskdb/undo.data',
+                        content_type='text/plain', data=data)
+        self.assertEqual(response.content,
+                         'created: %s\ndeleted: 0\n' % (len(parse_undo(data)) - 3))
+        self.assertEqual(parse_undo(self.client.get('/taskdb/undo.data').content),
+                         parse_undo(data))
+
+        response = self.client.put('/taskdb/undo.data',
+                        content_type='text/plain', data=data)
+        self.assertEqual(response.content, 'created: 0\ndeleted: 0\n')
+
+        # a diverged history replaces the entries after the difference
+        diverged = head + segments[3].replace('important', 'urgent') + '---\n'
+        response = self.client.put('/taskdb/undo.data',
+                        content_type='text/plain', data=diverged)
+        self.assertEqual(response.content,
+                         'created: 1\ndeleted: %s\n' % (len(parse_undo(data)) - 3))
+        self.assertEqual(parse_undo(self.client.get('/taskdb/undo.data').content),
+                         parse_undo(diverged))
+
+    def test_undo_sync_num_queries(self):
+        user = self.create_user()
+        entries = parse_undo(open(os.path.join(TASK_DATA, 'undo.data')).read())
+        Undo.sync(entries[:3], user)
+
+        # entries stored before checksums were have a blank one
+        Undo.objects.filter(pk=Undo.objects.reverse()[0].pk).update(checksum='')
+
+        hashed = []
+        undo_checksum = models.undo_checksum
+
+        def counting_checksum(*args):
+            hashed.append(args)
+            return undo_checksum(*args)
+        models.undo_checksum = counting_checksum
+        try:
+            # only the last stored entry is compared with its counterpart
+            with self.assertNumQueries(6):
+                self.assertEqual(Undo.sync(entries, user),
+                                 {'created': len(entries) - 3, 'deleted': 0})
+            self.assertEqual(len(hashed), 2 + len(entries) - 3)
+
+            # the logs are walked when they've diverged
+            del hashed[:]
+            diverged = entries[:2] + [dict(entries[2], new='[]\n')]
+            self.assertEqual(Undo.sync(diverged, user),
+                             {'created': 1, 'deleted': len(entries) - 2})
+        finally:
+            models.undo_checksum = undo_checksum
+        self.assertEqual(parse_undo(Undo.serialize(user)), diverged)
+
+    def test_undo_sync_streams(self):
+        """ The entries that are already stored are read one at a time,
+            and the upload is only read again if the logs have diverged.
+        """
+        user = self.create_user()
+        entries = parse_undo(open(os.path.join(TASK_DATA, 'undo.data')).read())
+        Undo.sync(entries, user)
+
+        class Entry(dict):
+            live = peak = 0
+
+            def __init__(self, *args):
+                dict.__init__(self, *args)
+                Entry.live += 1
+                Entry.peak = max(Entry.peak, Entry.live)
+
+            def __del__(self):
+                Entry.live -= 1
+
+        iterations = []
+
+        def upload(entries):
+            iterations.append(entries)
+            for d in entries:
+                yield Entry(d)
+
+        self.assertEqual(Undo.sync(Reiterable(upload, entries), user),
+                         {'created': 0, 'deleted': 0})
+        self.assertEqual(len(iterations), 1)
+        self.assertTrue(Entry.peak <= 2)
+
+        diverged = entries[:2] + [dict(entries[2], new='[]\n')]
+        self.assertEqual(Undo.sync(Reiterable(upload, diverged), user),
+                         {'created': 1, 'deleted': len(entries) - 2})
+        self.assertEqual(len(iterations), 3)
+        self.assertEqual(parse_undo(Undo.serialize(user)), diverged)
+
+        self.assertRaises(TypeError, Undo.sync, iter(entries), user)
+
     def test_taskdb_PUT_all(self):
         self._create_user_and_login()
         for fname in ['pending', 'undo', 'completed']:
@@ -565,6 +1871,17 @@ class TestViews(TaskTestCase):
         for x in range(2):
             self.test_taskdb_PUT_all()
 
+    def test_iterparse_undo(self):
+        import StringIO
+        entries = iterparse_undo(StringIO.StringIO(UNDO_SAMPLE))
+        self.assertEqual(entries.next(), PARSED_UNDO_SAMPLE[0])
+        self.assertEqual(list(entries), PARSED_UNDO_SAMPLE[1:])
+
+    def test_iterlines(self):
+        chunks = ['first li', 'ne\nsecond line\nthi', 'rd', '\n', 'last']
+        self.assertEqual(list(iterlines(chunks)),
+                         ['first line\n', 'second line\n', 'third\n', 'last'])
+
     def test_parse_undo(self):
         parsed = parse_undo(UNDO_SAMPLE)
         self.assertEqual(parsed, PARSED_UNDO_SAMPLE)
@@ -592,6 +1909,318 @@ class TestViews(TaskTestCase):
         self.assertEqual(tag.tag, u'tag1')
 
 
+class TestFilters(TaskTestCase):
+    def setUp(self):
+        super(TestFilters, self).setUp()
+        user = self.create_user()
+        now = datetime.datetime.now()
+        self.today = datetime.datetime(now.year, now.month, now.day)
+
+        fence = Task.objects.create(description='paint the fence', user=user,
+                                    due=self.today + datetime.timedelta(1))
+        fence.set_project('home.garden')
+        fence.add_tag('home')
+        fence.add_tag('weekend')
+        fence.set_priority('H')
+        fence.save()
+
+        report = Task.objects.create(description='write the report',
+                                     user=user, due=self.today)
+        report.set_project('work')
+        report.add_tag('work')
+        report.set_priority('L')
+        report.save()
+
+        Task.objects.create(description='buy paint', user=user).done()
+
+    def _filter(self, text):
+        return sorted(Task.objects.filter(filters.parse(text))
+                                  .values_list('description', flat=True))
+
+    def test_tokenize(self):
+        self.assertEqual(filters.tokenize('(+home or pro:work)and "a b"'),
+                         ['(', '+home', 'or', 'pro:work', ')', 'and',
+                          '"a b"'])
+        self.assertEqual(filters.tokenize("desc:'a (b)'"), ["desc:'a (b)'"])
+        self.assertRaises(filters.FilterError, filters.tokenize, "don't")
+
+    def test_tags(self):
+        self.assertEqual(self._filter('+home'), ['paint the fence'])
+        self.assertEqual(self._filter('-home'), ['buy paint',
+                                                 'write the report'])
+        # both tags of the same task
+        self.assertEqual(self._filter('+home +weekend'), ['paint the fence'])
+        self.assertEqual(self._filter('+home +work'), [])
+        self.assertEqual(self._filter('tags.none:'), ['buy paint'])
+        self.assertEqual(self._filter('tags.hasnt:work'), ['buy paint',
+                                                           'paint the fence'])
+
+    def test_attributes(self):
+        self.assertEqual(self._filter('project:home'), ['paint the fence'])
+        self.assertEqual(self._filter('project.is:home'), [])
+        self.assertEqual(self._filter('pro:'), ['buy paint'])
+        self.assertEqual(self._filter('project.not:work'),
+                         ['buy paint', 'paint the fence'])
+        self.assertEqual(self._filter('status:completed'), ['buy paint'])
+        self.assertEqual(self._filter('desc.has:PAINT'), ['buy paint',
+                                                         'paint the fence'])
+        self.assertEqual(self._filter('"the fence"'), ['paint the fence'])
+        self.assertEqual(self._filter('pri:H'), ['paint the fence'])
+        self.assertEqual(self._filter('pri.above:L'), ['paint the fence'])
+        self.assertEqual(self._filter('pri.below:M'), ['buy paint',
+                                                       'write the report'])
+        self.assertEqual(self._filter('pri:'), ['buy paint'])
+
+    def test_dates(self):
+        self.assertEqual(self._filter('due:today'), ['write the report'])
+        self.assertEqual(self._filter('due.before:tomorrow'),
+                         ['write the report'])
+        self.assertEqual(self._filter('due.after:today'), ['paint the fence'])
+        self.assertEqual(self._filter('due.after:yesterday due.before:eod'),
+                         ['write the report'])
+        self.assertEqual(self._filter('due.none:'), ['buy paint'])
+        self.assertEqual(self._filter('due:%s' % datetime2ts(self.today)),
+                         ['write the report'])
+        self.assertEqual(self._filter('due:%s' % self.today.date()),
+                         ['write the report'])
+
+        now = datetime.datetime(2012, 9, 12, 14, 30)  # a Wednesday
+        self.assertEqual(filters.parse_date('sow', now),
+                         datetime.datetime(2012, 9, 9))
+        self.assertEqual(filters.parse_date('eow', now),
+                         datetime.datetime(2012, 9, 16))
+        self.assertEqual(filters.parse_date('eom', now),
+                         datetime.datetime(2012, 10, 1))
+        self.assertEqual(filters.parse_date('eoy', now),
+                         datetime.datetime(2013, 1, 1))
+        self.assertEqual(filters.parse_date('2012-09-08T14:30'),
+                         datetime.datetime(2012, 9, 8, 14, 30))
+
+    def test_operators(self):
+        self.assertEqual(self._filter('+home or +work'),
+                         ['paint the fence', 'write the report'])
+        self.assertEqual(self._filter('+home and pri:H'), ['paint the fence'])
+        # and binds tighter than or
+        self.assertEqual(self._filter('status:completed or +home pri:L'),
+                         ['buy paint'])
+        self.assertEqual(self._filter('(status:completed or +home) pri:H'),
+                         ['paint the fence'])
+        self.assertEqual(self._filter('-home (paint or report)'),
+                         ['buy paint', 'write the report'])
+        self.assertEqual(self._filter(''), ['buy paint', 'paint the fence',
+                                            'write the report'])
+
+    def test_errors(self):
+        for text in ('(+home', '+home)', 'or +home', '+home and',
+                     'due:someday', 'due:99999999999999', 'pri:X', 'project.nope:home', 'en:today',
+                     'tags.before:x', '"unclosed'):
+            self.assertRaises(filters.FilterError, filters.parse, text)
+
+        # a word that only looks like an attribute is searched for
+        self.assertEqual(self._filter('http://example.com'), [])
+
+
+class TestUndoArchive(TaskTestCase):
+    def setUp(self):
+        super(TestUndoArchive, self).setUp()
+        self.taskdata_root = settings.TASKDATA_ROOT
+        settings.TASKDATA_ROOT = tempfile.mkdtemp()
+        self.data = open(os.path.join(TASK_DATA, 'undo.data')).read()
+        self.user = self.create_user('foo', 'bar')
+        Undo.sync(parse_undo(self.data), self.user)
+
+    def tearDown(self):
+        shutil.rmtree(settings.TASKDATA_ROOT)
+        settings.TASKDATA_ROOT = self.taskdata_root
+
+    def _keep(self, days=None, entries=None):
+        profile = self.user.get_profile()
+        profile.undo_keep_days = days
+        profile.undo_keep_entries = entries
+        profile.save()
+
+    def _archive_undo(self, *args, **options):
+        out = StringIO()
+        call_command('archive_undo', *args, stdout=out, **options)
+        return out.getvalue()
+
+    def test_archive_by_entries(self):
+        self._keep(entries=2)
+        self.assertEqual(archive.expired(self.user), 4)
+        self.assertEqual(self._archive_undo(dry_run=True),
+                         'foo: 4 entries to archive\n')
+        self.assertEqual(Undo.objects.count(), 6)
+
+        self.assertEqual(self._archive_undo(batch_size=3),
+                         'foo: 4 entries archived\n')
+        self.assertEqual([a.count for a in UndoArchive.objects.all()], [3, 1])
+        entries = parse_undo(self.data)
+        self.assertEqual(parse_undo(Undo.serialize(self.user)), entries[4:])
+        self.assertEqual(parse_undo(''.join(archive.iterarchive(self.user))),
+                         entries[:4])
+
+        # nothing left to do
+        self.assertEqual(self._archive_undo(), '')
+
+    def test_archive_by_days(self):
+        entries = parse_undo(self.data)
+        now = datetime.datetime.fromtimestamp(int(entries[3]['time']))
+        self._keep(days=0)
+        self.assertEqual(archive.expired(self.user, now),
+                         len([e for e in entries
+                              if int(e['time']) < int(entries[3]['time'])]))
+        self._keep()
+        self.assertEqual(archive.expired(self.user, now), 0)
+
+    def test_sync_skips_archived(self):
+        self._keep(entries=2)
+        self._archive_undo()
+        entries = parse_undo(self.data)
+
+        # the whole log, or the part that's left after archiving
+        self.assertEqual(Undo.sync(entries, self.user),
+                         {'created': 0, 'deleted': 0})
+        self.assertEqual(Undo.sync(entries[4:], self.user),
+                         {'created': 0, 'deleted': 0})
+        self.assertEqual(Undo.objects.count(), 2)
+
+    def test_archive_failure_removes_file(self):
+        self._keep(entries=2)
+
+        def fail(*args, **kwargs):
+            raise ValueError
+        create = UndoArchive.objects.create
+        UndoArchive.objects.create = fail
+        try:
+            self.assertRaises(ValueError, archive.archive, self.user, 4)
+        finally:
+            UndoArchive.objects.create = create
+        self.assertEqual(os.listdir(os.path.join(archive.archive_root(),
+                                                 str(self.user.pk))), [])
+
+    def test_undo_archive_GET(self):
+        self._keep(entries=2)
+        self._archive_undo(batch_size=2)
+        self.client.login(username='foo', password='bar')
+        entries = parse_undo(self.data)
+
+        response = self.client.get('/undo/archive/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(parse_undo(response.content), entries[:4])
+
+        last = UndoArchive.objects.order_by('-id')[0]
+        response = self.client.get('/undo/archive/?since=%s'
+                                   % datetime2ts(last.first_time))
+        self.assertEqual(parse_undo(response.content), entries[2:4])
+        self.assertEqual(self.client.get('/undo/archive/?since=x').status_code,
+                         400)
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite',
+                     'query plans are checked on SQLite')
+class TestQueryPlans(TaskTestCase):
+    """ The queries behind every page and taskdb file must be answered
+        from an index, never by reading whole tables.
+
+        pysqlite commits before running EXPLAIN, so these tests mustn't
+        write anything; they use the id of a user that doesn't exist.
+    """
+    user = 1
+
+    def _plan(self, sql, params=()):
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+
+    def assertIndexed(self, query, ordered=False):
+        """ Fails if `query` (a queryset, or SQL and parameters) scans a
+            table, or with `ordered`, if its rows have to be sorted.
+        """
+        if hasattr(query, 'query'):
+            query = query.query.sql_with_params()
+        plan = self._plan(*query)
+        tables = set(connection.introspection.table_names())
+        for detail in plan:
+            # SQLite before 3.36 says "SCAN TABLE x", later ones "SCAN x"
+            words = detail.split()
+            if words[:2] == ['SCAN', 'TABLE']:
+                del words[1]
+            if words[0] == 'SCAN' and words[1] in tables:
+                self.fail('%s in %s' % (detail, plan))
+            if ordered and detail == 'USE TEMP B-TREE FOR ORDER BY':
+                self.fail('rows sorted in %s' % plan)
+
+    def test_taskdb_queries(self):
+        self.assertIndexed(Task.objects.filter(status='pending', user=self.user)
+                                       .order_by('entry', 'id'),
+                           ordered=True)
+        self.assertIndexed(Task.objects.filter(
+                status__in=['completed', 'deleted'], user=self.user))
+        self.assertIndexed(Undo.objects.filter(user=self.user)
+                                       .order_by('time', 'id'),
+                           ordered=True)
+        self.assertIndexed(TaskDbVersion.objects.filter(
+                user=self.user, filename='pending.data'))
+
+    def test_working_set_query(self):
+        self.assertIndexed(Task.objects.filter(status='pending',
+                                               user__in=[self.user])
+                                       .order_by('user', 'entry', 'id')
+                                       .values_list('pk', 'user'),
+                           ordered=True)
+
+    def _grid_queries(self, status, query_string, boundary=None):
+        """ Return the SQL and parameters of the queries `TaskDataGrid`
+            runs to show the tasks with `status`. There are no tasks to
+            page from, so the cursor's task has the sort key `boundary`.
+        """
+        queries = []
+
+        class RecordedQuery(Query):
+            # clones keep the class, so every query derived from the
+            # grid's queryset records its SQL and parameters
+            def get_compiler(self, *args, **kwargs):
+                compiler = super(RecordedQuery, self).get_compiler(*args,
+                                                                   **kwargs)
+                queries.append(compiler.as_sql())
+                return compiler
+
+        queryset = Task.objects.filter(status=status)
+        queryset.query = queryset.query.clone(klass=RecordedQuery)
+        request = RequestFactory().get('/%s/%s' % (status, query_string))
+        request.user = AnonymousUser()
+        grid = TaskDataGrid(request, queryset=queryset)
+        grid._boundary = lambda key, pk: {key[0]: boundary, 'pk': pk}
+        grid.load_state()
+        return queries
+
+    def test_grid_queries(self):
+        when = datetime.datetime(2012, 1, 1)
+        sorts = [('-id_', [5]), ('entry', [when]), ('-entry', [when]),
+                 ('due', [when, None]), ('-due', [when, None]),
+                 ('end', [when, None]), ('-end', [when, None])]
+        for status in ('pending', 'completed'):
+            for sort, boundaries in sorts:
+                queries = self._grid_queries(status, '?sort=%s' % sort)
+                for boundary in boundaries:
+                    for direction in ('after', 'before'):
+                        queries += self._grid_queries(
+                                status, '?sort=%s&%s=%s:5'
+                                % (sort, direction, sort), boundary)
+
+                self.assertTrue(queries)
+                for query in queries:
+                    self.assertIndexed(query, ordered=True)
+
+        # the weights are in another table, so they're only looked up
+        for query in self._grid_queries('pending', '?sort=priority', 2):
+            self.assertIndexed(query)
+
+    def test_facets_queries(self):
+        self.assertIndexed(task_facets._query('pending', self.user))
+        self.assertIndexed(task_facets._query('completed', None))
+
+
 PARSED_UNDO_SAMPLE = [
     {'time': '1326338657',
       'new': '[description:"note: this is a task\&dquot;" entry:"1326338657" status:"pending" uuid:"6f34e415-2441-4058-8c11-320f5c2b2792"]\n'
@@ -610,3 +2239,136 @@ time 1326338708
 old [description:"foo \&dquot;bar\&dquot;" entry:"1326250353" status:"pending" uuid:"4300e85d-9bbc-49a6-ba89-89f024bc0795"]
 new [description:"foo \&dquot;bar\&dquot;" end:"1326338705" entry:"1326250353" status:"deleted" uuid:"4300e85d-9bbc-49a6-ba89-89f024bc0795"]
 """
+
+
+class TestTransactions(TransactionTestCase):
+    """ Tests of what's committed, which `TestCase` can't tell.
+    """
+    def setUp(self):
+        cache.clear()
+        for lookups in LOOKUP_CACHES.values():
+            lookups.clear()
+        self.user = User.objects.create_user('foo', 'foo@test.com', 'baz')
+
+    def tearDown(self):
+        # the search index isn't flushed with the tables
+        if search.enabled():
+            search.delete(Task.objects.values_list('pk', flat=True))
+            transaction.commit_unless_managed()
+
+    def test_lookup_cache(self):
+        task = Task.objects.create(description='foobar', user=self.user)
+        task.set_project('home', track=False)
+        task.add_tag('tag1', track=False)
+        task.set_priority('H', track=False)
+        task.set_project('home', track=False)
+        task.set_priority('H', track=False)
+
+        # the rows are cached once they've been read
+        with self.assertNumQueries(0):
+            task.set_project('home', track=False)
+            task.set_priority('H', track=False)
+        self.assertEqual(task.project.name, 'home')
+        self.assertEqual(task.priority.weight, 3)
+
+        # but not the ones that were just created
+        with self.assertNumQueries(1):
+            LOOKUP_CACHES[Tag].get('tag1')
+        with self.assertNumQueries(0):
+            self.assertEqual(LOOKUP_CACHES[Tag].get_or_create('tag1')[1],
+                             False)
+        with self.assertNumQueries(1):
+            self.assertRaises(Tag.DoesNotExist, LOOKUP_CACHES[Tag].get,
+                              'nope')
+
+    def test_lookup_cache_size(self):
+        lookups = LOOKUP_CACHES[Tag]
+        size, lookups.size = lookups.size, 2
+        try:
+            for name in ('tag1', 'tag2', 'tag3'):
+                Tag.objects.create(tag=name)
+                lookups.get(name)
+            with self.assertNumQueries(1):
+                lookups.get('tag3')
+                lookups.get('tag2')
+                lookups.get('tag1')
+        finally:
+            lookups.size = size
+
+    def test_lookup_cache_in_transaction(self):
+        """ A row read after the transaction wrote something isn't cached,
+            since it may be gone once the transaction is rolled back.
+        """
+        lookups = LOOKUP_CACHES[Tag]
+        try:
+            with transaction.commit_on_success():
+                Tag.objects.create(tag='tag1')
+                lookups.get('tag1')
+                with self.assertNumQueries(1):
+                    lookups.get('tag1')
+                raise ValueError
+        except ValueError:
+            pass
+
+        self.assertRaises(Tag.DoesNotExist, lookups.get, 'tag1')
+
+    def test_task_relations_in_transaction(self):
+        """ Changing the relations of a task doesn't commit the
+            transaction it's changed in.
+        """
+        task = Task.objects.create(description='foo', user=self.user)
+        task.add_tag('tag1')
+        try:
+            with transaction.commit_on_success():
+                task.add_tag('tag2')
+                task.remove_tag('tag1')
+                task.annotate('note')
+                raise ValueError
+        except ValueError:
+            pass
+
+        task = Task.objects.get(pk=task.pk)
+        self.assertEqual(task.tags_summary, 'tag1')
+        self.assertEqual(task.annotation_count, 0)
+        self.assertEqual(list(task.tags.values_list('tag', flat=True)),
+                         ['tag1'])
+        self.assertEqual(Undo.objects.count(), 2)
+
+    def test_sync_in_transaction(self):
+        """ Syncing is part of the transaction it's called in.
+        """
+        try:
+            with transaction.commit_on_success():
+                Task.sync(Task.objects.filter(user=self.user),
+                          [{'uuid': 'aaaa', 'description': 'foo',
+                            'entry': '12345', 'tags': ['tag1'],
+                            'annotation_1324076995': 'note'}], self.user)
+                Undo.sync([{'time': '12345', 'new': '[description:"foo"]\n'}],
+                          self.user)
+                raise ValueError
+        except ValueError:
+            pass
+
+        self.assertEqual(Task.objects.count(), 0)
+        self.assertEqual(Undo.objects.count(), 0)
+
+    def test_taskdb_PUT_undo_invalid_compressed(self):
+        """ An upload that turns out to be corrupt part way through
+            doesn't leave the entries read before that behind.
+        """
+        import gzip
+        self.client.login(username='foo', password='baz')
+        compressed = StringIO()
+        f = gzip.GzipFile(fileobj=compressed, mode='wb')
+        for n in xrange(5000):
+            f.write('time %s\nnew [description:"%s"]\n---\n'
+                    % (1347125849 + n, os.urandom(16).encode('hex')))
+        f.close()
+        # break the checksum at the end of the stream
+        data = compressed.getvalue()[:-8] + '\0' * 8
+
+        response = self.client.put('/taskdb/undo.data',
+                        content_type='text/plain', data=data,
+                        HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Undo.objects.count(), 0)
@@ -4,6 +4,8 @@ from django.views.generic.simple import redirect_to
 urlpatterns = patterns('task.views',
         (r'^$', redirect_to, {'url': '/pending/'}),
         (r'^pending/$', 'pending_tasks'),
+        (r'^ready/$', 'ready_tasks'),
+        (r'^blocked/$', 'blocked_tasks'),
         (r'^completed/$', 'completed_tasks'),
         (r'^add/task/$', 'add_task'),
         (r'^add/tags/$', 'add_tag'),
@@ -12,5 +14,7 @@ urlpatterns = patterns('task.views',
         (r'^edit/task/(?P<task_id>\d+)/$', 'edit_task'),
         (r'^detail/task/(?P<task_id>\d+)/$', 'detail_task'),
         (r'^detail/project/(?P<proj_id>\d+)/$', 'detail_project'),
-        (r'^taskdb/(?P<filename>.*)$', 'taskdb')
+        (r'^undo/archive/$', 'undo_archive'),
+        (r'^taskdb/(?P<filename>.*)$', 'taskdb'),
+        (r'^api/tasks/$', 'api_tasks'),
         )
@@ -1,24 +1,174 @@
 """ Various utility methods for `taskweb` """
+import zlib
+
+# zlib `wbits` for the content codings we produce; 32 + MAX_WBITS lets
+# zlib detect either a gzip or a zlib header when decompressing
+COMPRESS_WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+    }
+DECOMPRESS_WBITS = 32 + zlib.MAX_WBITS
+
+
+def chunked(iterable, size):
+    """ Yield lists of at most `size` items from `iterable`.
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def group_by_task(rows):
+    """ Group `(task_id, value, ...)` rows, like the `values_list()` of
+        a task relation's through table, into a dict of lists of
+        `(value, ...)` tuples keyed by `task_id`, preserving order.
+    """
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(row[0], []).append(row[1:])
+
+    return grouped
+
+
+def split_tags(tags):
+    """ Return the tag names from a decoded task's `tags` value, which
+        is either a list or a comma-separated string.
+    """
+    if not tags:
+        return []
+
+    if isinstance(tags, basestring):
+        tags = tags.split(',')
+
+    return [tag for tag in tags if tag]
+
+
+def iterparse_undo(lines):
+    """ Yield a dictionary for each entry in the `taskwarrior` undo data
+        read from `lines`, which can be a file-like object or any other
+        iterable of lines.
+    """
+    undo = {}
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            continue
+
+        if line.strip() == '---':
+            if undo:
+                yield undo
+            undo = {}
+            continue
+
+        key, _, value = line.partition(' ')
+        if key == 'time':
+            undo['time'] = value
+        elif key in ('old', 'new'):
+            undo[key] = value + "\n"
+
+    if undo:
+        yield undo
 
 
 def parse_undo(data):
     """ Return a list of dictionaries representing the passed in
         `taskwarrior` undo data.
     """
-    undo_list = []
-    for segment in data.split('---'):
-        parsed = {}
-        undo = [line for line in segment.splitlines() if line.strip()]
-        if not undo:
-            continue
+    return list(iterparse_undo(data.splitlines()))
+
+
+def preferred_encoding(accept_encoding):
+    """ Return the content coding ('gzip' or 'deflate') to use for a
+        response given the request's `Accept-Encoding` header, or None
+        if the response shouldn't be compressed.
+    """
+    accepted = {}
+    for coding in accept_encoding.split(','):
+        params = coding.strip().lower().split(';')
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[params[0]] = q
+
+    for coding in ('gzip', 'deflate'):
+        if accepted.get(coding, accepted.get('*', 0)) > 0:
+            return coding
+
+    return None
+
+
+def compress_chunks(chunks, encoding, level=6):
+    """ Yield the data in `chunks` compressed with the `encoding`
+        content coding.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                  COMPRESS_WBITS[encoding])
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+
+    yield compressor.flush()
+
 
-        parsed['time'] = undo[0].split(' ', 1)[1]
-        if undo[1].startswith('old'):
-            parsed['old'] = undo[1].split(' ', 1)[1] + "\n"
-            parsed['new'] = undo[2].split(' ', 1)[1] + "\n"
-        else:
-            parsed['new'] = undo[1].split(' ', 1)[1] + "\n"
+def decompress_chunks(chunks):
+    """ Yield the decompressed data of gzip or deflate compressed `chunks`,
+        raising `zlib.error` if the compressed stream doesn't end.
+    """
+    decompressor = zlib.decompressobj(DECOMPRESS_WBITS)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+
+    # anything after the end of the stream is kept as unused data, which
+    # is how a truncated stream is told apart (zlib has no `eof` on py2)
+    if not decompressor.unused_data:
+        decompressor.decompress('\0')
+        if not decompressor.unused_data:
+            raise zlib.error('Incomplete compressed data')
+
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+class Reiterable(object):
+    """ An iterable of `func(iterable)` that calls it again, over
+        `iterable` from the start, each time it's iterated.
+    """
+    def __init__(self, func, iterable):
+        self.func = func
+        self.iterable = iterable
+
+    def __iter__(self):
+        return iter(self.func(self.iterable))
+
+
+def iterlines(chunks):
+    """ Yield the lines (with their line endings) in the data split
+        across `chunks`.
+    """
+    partial = ''
+    for chunk in chunks:
+        lines = (partial + chunk).splitlines(True)
+        partial = ''
+        if lines and not lines[-1].endswith(('\n', '\r')):
+            partial = lines.pop()
 
-        undo_list.append(parsed)
+        for line in lines:
+            yield line
 
-    return undo_list
+    if partial:
+        yield partial
@@ -1,20 +1,36 @@
+import datetime
 import logging
+import tempfile
+import urllib
+import zlib
 
 from django.http import (HttpResponse,  HttpResponseRedirect,
-                        HttpResponseNotAllowed,
+                        HttpResponseNotAllowed, HttpResponseBadRequest,
                         HttpResponseNotFound, HttpResponseForbidden)
 from django.shortcuts import render, get_object_or_404
 from django.template import RequestContext
 from django.contrib.auth.decorators import login_required
+from django.db import transaction
+from django.views.decorators.http import condition
+from django.utils.cache import patch_vary_headers
 from django.utils.html import escape
 
 from taskw import decode_task
 
+from task import api
+from task import archive
+from task import filters
 from task import forms
+from task import graph
+from task import cache as taskdb_cache
+from task import search
 from task.decorators import logged_in_or_basicauth
+from task.facets import facets
 from task.grids import TaskDataGrid
-from task.models import Task, Undo, Tag, Project
-from task.util import parse_undo
+from task.models import (Task, Undo, Project, TaskDbVersion,
+                         datetime2ts, ts2datetime, undo_unit)
+from task.util import (iterparse_undo, preferred_encoding, compress_chunks,
+                       decompress_chunks, iterlines, Reiterable)
 from django.conf import settings
 
 TASK_URL = 'taskdb'
@@ -22,61 +38,116 @@ TASK_ROOT = settings.TASKDATA_ROOT
 
 TASK_FNAMES = ('undo.data', 'completed.data', 'pending.data')
 
+# bytes read from the request at a time when receiving a taskdb file
+REQUEST_CHUNK_SIZE = 64 * 1024
+# bytes of a received taskdb file kept in memory before it's spooled to disk
+REQUEST_SPOOL_SIZE = 1024 * 1024
+
 
 class TaskFilter(object):
+    """ Filter tasks by the `project`, `tag`, `filter` (a taskwarrior
+        filter expression) and `q` (a full-text search) parameters of a
+        request. An invalid filter matches no tasks, and is kept in
+        `error`.
+    """
     def __init__(self, request, qs=Task.objects.all()):
         self.qs = qs
         self.request = request
+        self.error = None
 
     def filter(self):
+        qs = self.qs
         proj = self.request.GET.get('project')
+        tag = self.request.GET.get('tag')
         if proj:
-            qs = self.qs.filter(project__name=proj)
-            return qs
+            qs = qs.filter(project__name=proj)
+        elif tag:
+            qs = qs.filter(filters.has_tag(tag))
 
-        tag = self.request.GET.get('tag')
-        if tag:
-            qs = self.qs.filter(tags__tag=tag)
-            return qs
+        expression = self.request.GET.get('filter')
+        if expression:
+            try:
+                qs = qs.filter(filters.parse(expression))
+            except filters.FilterError as e:
+                self.error = e
+                return qs.none()
 
-        return self.qs
+        text = self.request.GET.get('q')
+        if text:
+            qs = search.filter_tasks(qs, text)
 
+        return qs
 
-def get_tags(status=None):
-    if status is None:
-        return Tag.objects.all().values('tag')
 
-    return Tag.objects.filter(task__status=status).values('tag').distinct()
+def get_facets(request, status):
+    """ Return the tags and projects (with task counts) of the tasks
+        with `status` that belong to the logged in user.
+    """
+    user = request.user.is_authenticated() and request.user or None
+    return facets(status, user)
 
 
-def get_projects(status=None):
-    if status is None:
-        return Project.objects.all().values('name')
+def pending_tasks(request, template='task/index.html'):
+    pending = Task.objects.filter(status='pending')
+    task_url = "http://%s/taskdb/" % request.get_host()
+    task_filter = TaskFilter(request, pending)
+    filtered = task_filter.filter()
+    tags, projects = get_facets(request, 'pending')
 
-    return Project.objects.filter(task__status=status).values('name').distinct()
+    grid = TaskDataGrid(request, queryset=filtered)
+    return grid.render_to_response(template,
+            extra_context={'task_url': task_url,
+                           'tags': tags,
+                           'projects': projects,
+                           'filter_error': task_filter.error})
 
 
-def pending_tasks(request, template='task/index.html'):
+def ready_tasks(request, template='task/index.html'):
+    pending = Task.objects.filter(status='pending')
+    task_url = "http://%s/taskdb/" % request.get_host()
+    task_filter = TaskFilter(request, pending)
+    filtered = graph.ready(task_filter.filter())
+    tags, projects = get_facets(request, 'pending')
+
+    grid = TaskDataGrid(request, queryset=filtered)
+    return grid.render_to_response(template,
+            extra_context={'task_url': task_url,
+                           'tags': tags,
+                           'projects': projects,
+                           'filter_error': task_filter.error})
+
+
+def blocked_tasks(request, template='task/index.html'):
     pending = Task.objects.filter(status='pending')
     task_url = "http://%s/taskdb/" % request.get_host()
-    filtered = TaskFilter(request, pending).filter()
+    task_filter = TaskFilter(request, pending)
+    filtered = graph.blocked(task_filter.filter())
+    tags, projects = get_facets(request, 'pending')
 
     grid = TaskDataGrid(request, queryset=filtered)
+    # show what blocks the tasks, without saving the columns for the
+    # other lists
+    grid.default_columns = grid.default_columns + ['blockers']
+    grid.profile_columns_field = None
     return grid.render_to_response(template,
             extra_context={'task_url': task_url,
-                           'tags': get_tags('pending'),
-                            'projects': get_projects('pending')})
+                           'tags': tags,
+                           'projects': projects,
+                           'filter_error': task_filter.error})
 
 
 def completed_tasks(request, template='task/index.html'):
     completed = Task.objects.filter(status='completed')
     task_url = "http://%s/taskdb/" % request.get_host()
-    filtered = TaskFilter(request, completed).filter()
+    task_filter = TaskFilter(request, completed)
+    filtered = task_filter.filter()
+    tags, projects = get_facets(request, 'completed')
     grid = TaskDataGrid(request, queryset=filtered)
     return grid.render_to_response(template,
             extra_context={'task_url': task_url,
-                           'tags': get_tags('completed'),
-                            'projects': get_projects('completed')})
+                           'tags': tags,
+                           'projects': projects,
+                           'filter_error': task_filter.error})
 
 
 @login_required
@@ -85,10 +156,9 @@ def add_task(request, template='task/add.html'):
         task = Task(user=request.user)
         form = forms.TaskForm(request.POST, instance=task)
         if form.is_valid():
-            task = form.save()
-            # silly extra save to create
-            # undo object for m2m fields
-            task.save()
+            # one undo entry for the task and its relations
+            with undo_unit(task):
+                form.save()
             return HttpResponseRedirect('/')
     else:
         form = forms.TaskForm(initial={'user': request.user})
@@ -143,10 +213,9 @@ def edit_task(request, task_id, template='task/add.html'):
     if request.method == 'POST':
         form = forms.TaskForm(request.POST, instance=task)
         if form.is_valid():
-            task = form.save()
-            # silly extra save to create
-            # undo object for m2m fields
-            task.save()
+            # one undo entry for the task and its relations
+            with undo_unit(task):
+                form.save()
             return HttpResponseRedirect('/')
     else:
         form = forms.TaskForm(instance=task)
@@ -162,7 +231,12 @@ def edit_task(request, task_id, template='task/add.html'):
 
 def detail_task(request, task_id, template='task/detail_task.html'):
     task = get_object_or_404(Task, pk=task_id)
-    context = {'task': task}
+    # the blockers and whether the task is on a cycle come from the
+    # same closure, so it's only queried once
+    pks = graph.closure([task.pk]).get(task.pk, set())
+    context = {'task': task,
+               'blockers': Task.objects.filter(pk__in=pks - set([task.pk])),
+               'in_cycle': task.pk in pks}
     return render(request, template, context)
 
 
@@ -172,55 +246,216 @@ def detail_project(request, proj_id, template='task/detail_project.html'):
     return render(request, template, context)
 
 
+def _taskdb_version(request, filename):
+    """ Return the `TaskDbVersion` of the requested file, looking it up
+        only once per request.
+    """
+    if filename not in TASK_FNAMES:
+        return None
+
+    if not hasattr(request, '_taskdb_version'):
+        request._taskdb_version = TaskDbVersion.get_for(request.user,
+                                                        filename)
+    return request._taskdb_version
+
+
+def taskdb_etag(request, filename):
+    version = _taskdb_version(request, filename)
+    return version and version.etag
+
+
+def taskdb_last_modified(request, filename):
+    version = _taskdb_version(request, filename)
+    if version is None:
+        return None
+
+    # `condition` expects UTC, but the version is stored in local time
+    return datetime.datetime.utcfromtimestamp(datetime2ts(version.modified))
+
+
+@condition(etag_func=taskdb_etag, last_modified_func=taskdb_last_modified)
 def get_taskdb(request, filename):
+    user = request.user
+    if filename not in TASK_FNAMES:
+        return HttpResponseNotFound()
+
+    encoding = preferred_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    etag = _taskdb_version(request, filename).etag
+    cached = taskdb_cache.get(user.pk, filename, etag)
+    if cached is not None:
+        if encoding:
+            cached = ''.join(compress_chunks([cached], encoding))
+        response = HttpResponse(cached, mimetype='text/plain')
+        response['Content-Length'] = len(cached)
+        response['X-Taskdb-Cache'] = 'hit'
+        return _encoded(response, encoding)
+
     if filename == 'pending.data':
-        taskstr = Task.serialize('pending')
+        chunks = Task.iterserialize('pending', user)
     elif filename == 'completed.data':
-        taskstr = Task.serialize('completed')
+        chunks = Task.iterserialize('completed', user)
     elif filename == 'undo.data':
-        taskstr = Undo.serialize()
-    else:
-        return HttpResponseNotFound()
-
-    response = HttpResponse(taskstr, mimetype='text/plain')
-    response['Content-Length'] = len(taskstr)
+        chunks = Undo.iterserialize(user)
+
+    # stream the file as it is serialized rather than building it up
+    # in memory first, so no Content-Length is set
+    chunks = taskdb_cache.caching(chunks, user.pk, filename, etag)
+    if encoding:
+        chunks = compress_chunks(chunks, encoding)
+    response = HttpResponse(chunks, mimetype='text/plain')
+    response['X-Taskdb-Cache'] = 'miss'
+    return _encoded(response, encoding)
+
+
+def _encoded(response, encoding):
+    if encoding:
+        response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ('Accept-Encoding',))
     return response
 
 
+class _SpooledBody(object):
+    """ The lines of a request body copied to `body`, a file, decoded on
+        the fly if it was sent compressed. Each iteration reads the file
+        from the start again.
+    """
+    def __init__(self, body, compressed):
+        self.body = body
+        self.compressed = compressed
+
+    def __iter__(self):
+        self.body.seek(0)
+        chunks = iter(lambda: self.body.read(REQUEST_CHUNK_SIZE), '')
+        if self.compressed:
+            chunks = decompress_chunks(chunks)
+        return iterlines(chunks)
+
+
+def _request_body(request):
+    """ Return an iterable of the lines of the request body, decoding it
+        on the fly if it was sent with a `Content-Encoding`. The body is
+        spooled (to a temporary file, if it's large), so the lines can
+        be read more than once.
+    """
+    encoding = request.META.get('HTTP_CONTENT_ENCODING', 'identity').lower()
+    if encoding not in ('gzip', 'x-gzip', 'deflate', 'identity'):
+        raise ValueError('Unsupported Content-Encoding: %s' % encoding)
+
+    body = tempfile.SpooledTemporaryFile(REQUEST_SPOOL_SIZE)
+    for chunk in iter(lambda: request.read(REQUEST_CHUNK_SIZE), ''):
+        body.write(chunk)
+    return _SpooledBody(body, encoding != 'identity')
+
+
 def put_taskdb(request, filename):
     return post_taskdb(request, filename)
 
 
+@transaction.commit_on_success
 def post_taskdb(request, filename):
     if filename not in TASK_FNAMES:
         return HttpResponseForbidden('Forbidden!')
 
     user = request.user
-    data = request.raw_post_data
+    try:
+        lines = _request_body(request)
+    except ValueError as e:
+        return HttpResponse(str(e), status=415)
+
+    try:
+        if filename == 'undo.data':
+            # the undo log is written as it is parsed
+            counts = Undo.sync(Reiterable(iterparse_undo, lines), user)
+            return _sync_response(counts, ('created', 'deleted'))
+
+        parsed = [decode_task(line) for line in lines if line.strip()]
+    except zlib.error:
+        # the undo entries read before the error were already written
+        transaction.rollback()
+        return HttpResponseBadRequest('Invalid compressed data')
 
-    if filename in ['pending.data', 'completed.data']:
-        parsed = [decode_task(line) for line in data.splitlines()]
-        if filename == 'pending.data':
-            tasks = Task.objects.filter(status='pending', user=user)
-        elif filename == 'completed.data':
-            tasks = Task.objects.filter(status__in=['completed', 'deleted'])
+    if filename == 'pending.data':
+        tasks = Task.objects.filter(status='pending', user=user)
+    elif filename == 'completed.data':
+        tasks = Task.objects.filter(status__in=['completed', 'deleted'],
+                                    user=user)
 
-        tasks.delete()
+    counts = Task.sync(tasks, parsed, user)
+    return _sync_response(counts, ('created', 'updated', 'deleted'))
 
-        for task in parsed:
-            task.update({'user': user})
-            Task.fromdict(task)
 
-    elif filename == 'undo.data':
-        Undo.objects.all().delete()
-        parsed = parse_undo(data)
-        for undo_dict in parsed:
-            undo_dict.update({'user': user})
-            Undo.fromdict(undo_dict)
-    else:
-        return HttpResponseNotFound()
+def _sync_response(counts, keys):
+    """ Report the number of rows a sync changed, one `key: count` per line.
+    """
+    lines = ['%s: %s\n' % (key, counts[key]) for key in keys]
+    return HttpResponse(''.join(lines), mimetype='text/plain')
+
+
+@logged_in_or_basicauth()
+def api_tasks(request):
+    """ Stream the user's tasks as JSON lines, one task per line.
+
+        The tasks are filtered like the task lists (`project`, `tag`,
+        `filter` and `q`, plus `status`), `fields` picks the comma-separated
+        fields that are served, and `limit` the size of a page. The URL
+        of the next page is given in the `Link` header.
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+
+    try:
+        fields = api.parse_fields(request.GET.get('fields'))
+        after = request.GET.get('after')
+        after = after and int(after)
+        limit = int(request.GET.get('limit', api.PAGE_SIZE))
+        if not 0 < limit <= api.MAX_PAGE_SIZE:
+            raise ValueError('limit must be between 1 and %d'
+                             % api.MAX_PAGE_SIZE)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    tasks = Task.objects.filter(user=request.user)
+    status = request.GET.get('status')
+    if status:
+        tasks = tasks.filter(status=status)
+    task_filter = TaskFilter(request, tasks)
+    tasks = task_filter.filter()
+    if task_filter.error:
+        return HttpResponseBadRequest(str(task_filter.error))
+
+    ids, last = api.page(tasks, after, limit)
+    response = HttpResponse(api.iterserialize(ids, fields),
+                            mimetype='application/x-ndjson')
+    if last is not None:
+        params = [(key, value) for key, value in request.GET.items()
+                  if key != 'after']
+        params.append(('after', last))
+        response['Link'] = '<%s?%s>; rel="next"' % (request.path,
+                                                    urllib.urlencode(params))
+    return response
 
-    return HttpResponse()
+
+@logged_in_or_basicauth()
+def undo_archive(request):
+    """ Stream the user's archived undo entries, the ones moved out of
+        undo.data, in the same format. With `since` (a unix timestamp),
+        only the archive files with entries from then on are read.
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+
+    since = request.GET.get('since')
+    if since is not None:
+        if not since.isdigit():
+            return HttpResponseBadRequest('since must be a unix timestamp')
+        since = ts2datetime(since)
+
+    encoding = preferred_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    chunks = archive.iterarchive(request.user, since)
+    if encoding:
+        chunks = compress_chunks(chunks, encoding)
+    response = HttpResponse(chunks, mimetype='text/plain')
+    return _encoded(response, encoding)
 
 
 @logged_in_or_basicauth()